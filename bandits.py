@@ -0,0 +1,289 @@
+# -*- coding: utf-8 -*-
+# @File: bandits.py
+""" Thompson sampling over many arms at once, from the Ray actors of ray.ipynb
+
+Each family keeps the posteriors of all its arms in arrays, as a conjugate prior plus the sufficient statistics
+of the rewards seen so far: impressions and conversions for BetaArms, count, sum and sum of squares for
+NormalArms (Normal-Inverse-Gamma) and count, sums and outer products for MultivariateNormalArms
+(Normal-Inverse-Wishart). choose draws every arm for a decision, or for a batch of decisions, in one call, and
+updates take arrays of arms. Statistics only ever add up, so workers can accumulate them locally and merge
+them into a shared ParameterStore every so often instead of a round-trip per event:
+
+    python bandits.py --arms 1000 --decisions 100000 --store /tmp/bandits.sqlite
+"""
+import argparse
+import sqlite3
+import time
+from abc import ABC, abstractmethod
+
+import numpy as np
+
+
+FLUSH_SECONDS = 1.
+
+
+class ParameterStore(object):
+    """ Sufficient statistics of bandit arms in a SQLite file, in place of DynamoDB
+
+    Every process opening the same path shares the statistics: merge adds a process's local updates to the stored
+    totals of a bandit in one transaction, the way an atomic ADD would, and returns the totals of all processes.
+    """
+    def __init__(self, path: str, timeout: float = 30.):
+        self.path = path
+        self.connection = sqlite3.connect(path, timeout=timeout, isolation_level=None)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS bandits '
+                                '(name TEXT PRIMARY KEY, arms INTEGER, stats INTEGER, totals BLOB)')
+
+    def load(self, name: str, shape) -> np.ndarray:
+        """ Stored totals of bandit name, zeros when none are stored """
+        row = self.connection.execute('SELECT arms, stats, totals FROM bandits WHERE name = ?', (name,)).fetchone()
+        return self._totals(name, row, shape)
+
+    def merge(self, name: str, updates: np.ndarray) -> np.ndarray:
+        """ Add updates to the stored totals of bandit name; returns the new totals """
+        self.connection.execute('BEGIN IMMEDIATE')
+        try:
+            row = self.connection.execute('SELECT arms, stats, totals FROM bandits WHERE name = ?',
+                                          (name,)).fetchone()
+            totals = self._totals(name, row, updates.shape) + updates
+            self.connection.execute('INSERT OR REPLACE INTO bandits VALUES (?, ?, ?, ?)',
+                                    (name, totals.shape[0], totals.shape[1], totals.astype('<f8').tobytes()))
+        except BaseException:
+            self.connection.execute('ROLLBACK')
+            raise
+        self.connection.execute('COMMIT')
+        return totals
+
+    @staticmethod
+    def _totals(name, row, shape) -> np.ndarray:
+        if row is None:
+            return np.zeros(shape)
+        if tuple(row[:2]) != tuple(shape):
+            raise ValueError(f'bandit {name} is stored with {row[0]} arms of {row[1]} statistics, not {shape}')
+        return np.frombuffer(row[2], dtype='<f8').reshape(shape).copy()
+
+    def close(self) -> None:
+        self.connection.close()
+
+
+class Arms(ABC):
+    """ Posteriors of n_arms arms, from a prior and the sufficient statistics of each arm
+
+    stats holds the statistics every decision uses: the totals last merged into the store, plus the updates made
+    here since. The updates are merged into the store, under name, once flush_seconds have passed since the last
+    merge, and on flush.
+    """
+    def __init__(self, n_arms: int, n_stats: int, store: ParameterStore = None, name: str = None,
+                 flush_seconds: float = FLUSH_SECONDS, seed: int = None):
+        if store is not None and name is None:
+            raise ValueError('a stored bandit needs a name')
+        self.n_arms = n_arms
+        self.store = store
+        self.name = name
+        self.flush_seconds = flush_seconds
+        self.rng = np.random.RandomState(seed)
+        self.stats = np.zeros((n_arms, n_stats)) if store is None else store.load(name, (n_arms, n_stats))
+        self.pending = np.zeros((n_arms, n_stats))  # Updates not merged into the store yet
+        self._flushed = time.monotonic()
+
+    @abstractmethod
+    def sample(self, size: int = None) -> np.ndarray:
+        """ A draw of the expected reward of every arm, shaped (n_arms,), or (size, n_arms) """
+
+    @abstractmethod
+    def mean(self) -> np.ndarray:
+        """ Posterior mean of the expected reward of every arm """
+
+    def choose(self, decisions: int = None) -> np.ndarray:
+        """ The arm with the best draw, for one decision or each of a batch of decisions """
+        return self.sample(decisions).argmax(axis=-1)
+
+    def _add(self, arms: np.ndarray, stats: np.ndarray) -> None:
+        """ Add stats[k] to the statistics of arms[k], arms repeating as often as they were updated """
+        arms = np.asarray(arms, dtype=int).ravel()
+        stats = np.broadcast_to(stats, (len(arms), self.stats.shape[1]))
+        updates = np.zeros_like(self.pending)
+        np.add.at(updates, arms, stats)
+        self.stats += updates
+        self.pending += updates
+        if self.store is not None and time.monotonic() - self._flushed >= self.flush_seconds:
+            self.flush()
+
+    def flush(self) -> None:
+        """ Merge the pending updates into the store, picking up those of other processes """
+        if self.store is None:
+            return
+        self.stats = self.store.merge(self.name, self.pending)
+        self.pending[:] = 0
+        self._flushed = time.monotonic()
+
+
+class BetaArms(Arms):
+    """ Bernoulli rewards under Beta(alpha, beta) priors; stats are impressions and conversions
+
+    An impression counts as a failure until its conversion comes in, the pessimistic immediate update of the
+    notebook that encourages exploration; the conversion then turns it into a success.
+    """
+    def __init__(self, n_arms: int, alpha=1., beta=1., **kwargs):
+        super().__init__(n_arms, 2, **kwargs)
+        self.alpha0 = np.broadcast_to(np.asarray(alpha, dtype=float), (n_arms,))
+        self.beta0 = np.broadcast_to(np.asarray(beta, dtype=float), (n_arms,))
+        if (self.alpha0 <= 0).any() or (self.beta0 <= 0).any():
+            raise ValueError('Beta priors need alpha > 0 and beta > 0')
+
+    @property
+    def alpha(self) -> np.ndarray:
+        return self.alpha0 + self.stats[:, 1]
+
+    @property
+    def beta(self) -> np.ndarray:
+        return self.beta0 + self.stats[:, 0] - self.stats[:, 1]
+
+    def update_impression(self, arms: np.ndarray) -> None:
+        self._add(arms, [1., 0.])
+
+    def update_conversion(self, arms: np.ndarray) -> None:
+        self._add(arms, [0., 1.])
+
+    def update(self, arms: np.ndarray, rewards: np.ndarray) -> None:
+        """ Impressions of arms with their outcomes at once """
+        rewards = np.asarray(rewards, dtype=float).ravel()
+        self._add(arms, np.stack([np.ones_like(rewards), rewards], axis=1))
+
+    def sample(self, size: int = None) -> np.ndarray:
+        shape = self.n_arms if size is None else (size, self.n_arms)
+        return self.rng.beta(self.alpha, self.beta, shape)
+
+    def mean(self) -> np.ndarray:
+        alpha = self.alpha
+        return alpha / (alpha + self.beta)
+
+
+class NormalArms(Arms):
+    """ Normal rewards of unknown mean and variance under Normal-Inverse-Gamma(mu, lam, alpha, beta) priors
+
+    stats are the count, sum and sum of squares of the rewards of each arm.
+    """
+    def __init__(self, n_arms: int, mu=0., lam=1., alpha=1., beta=1., **kwargs):
+        super().__init__(n_arms, 3, **kwargs)
+        self.mu0, self.lam0, self.alpha0, self.beta0 = (np.broadcast_to(np.asarray(p, dtype=float), (n_arms,))
+                                                        for p in (mu, lam, alpha, beta))
+
+    def update(self, arms: np.ndarray, rewards: np.ndarray) -> None:
+        rewards = np.asarray(rewards, dtype=float).ravel()
+        self._add(arms, np.stack([np.ones_like(rewards), rewards, rewards * rewards], axis=1))
+
+    def posterior(self):
+        """ (mu, lam, alpha, beta) of every arm """
+        n, total, squares = self.stats.T
+        lam = self.lam0 + n
+        mean = total / np.maximum(n, 1)
+        deviations = np.maximum(squares - n * mean * mean, 0.)
+        beta = self.beta0 + deviations / 2 + self.lam0 * n * (mean - self.mu0) ** 2 / (2 * lam)
+        return (self.lam0 * self.mu0 + total) / lam, lam, self.alpha0 + n / 2, beta
+
+    def sample(self, size: int = None) -> np.ndarray:
+        mu, lam, alpha, beta = self.posterior()
+        shape = self.n_arms if size is None else (size, self.n_arms)
+        variance = 1 / self.rng.gamma(alpha, 1 / beta, shape)
+        return mu + np.sqrt(variance / lam) * self.rng.standard_normal(shape)
+
+    def mean(self) -> np.ndarray:
+        return self.posterior()[0]
+
+
+class MultivariateNormalArms(Arms):
+    """ Normal reward vectors under Normal-Inverse-Wishart(mu, kappa, nu, psi) priors
+
+    stats are the count, the sum (dim) and the sum of outer products (dim x dim) of the rewards of each arm. The
+    draw of an arm is weights @ mean, the sum of its components by default.
+    """
+    def __init__(self, n_arms: int, dim: int, mu=0., kappa=1., nu=None, psi=None, weights=None, **kwargs):
+        super().__init__(n_arms, 1 + dim + dim * dim, **kwargs)
+        self.dim = dim
+        self.mu0 = np.broadcast_to(np.asarray(mu, dtype=float), (n_arms, dim))
+        self.kappa0 = np.broadcast_to(np.asarray(kappa, dtype=float), (n_arms,))
+        self.nu0 = np.broadcast_to(np.asarray(dim + 1. if nu is None else nu, dtype=float), (n_arms,))
+        self.psi0 = np.broadcast_to(np.eye(dim) if psi is None else np.asarray(psi, dtype=float), (n_arms, dim, dim))
+        self.weights = np.ones(dim) if weights is None else np.asarray(weights, dtype=float)
+        if (self.nu0 <= dim - 1).any():
+            raise ValueError(f'Inverse-Wishart priors need nu > dim - 1 = {dim - 1}')
+
+    def update(self, arms: np.ndarray, rewards: np.ndarray) -> None:
+        """ rewards[k] is the reward vector of arms[k] """
+        rewards = np.asarray(rewards, dtype=float).reshape(-1, self.dim)
+        outer = rewards[:, :, None] * rewards[:, None, :]
+        self._add(arms, np.hstack([np.ones((len(rewards), 1)), rewards, outer.reshape(len(rewards), -1)]))
+
+    def posterior(self):
+        """ (mu, kappa, nu, psi) of every arm """
+        n = self.stats[:, 0]
+        total = self.stats[:, 1:1 + self.dim]
+        outer = self.stats[:, 1 + self.dim:].reshape(-1, self.dim, self.dim)
+        kappa = self.kappa0 + n
+        mean = total / np.maximum(n, 1)[:, None]
+        deviations = outer - n[:, None, None] * mean[:, :, None] * mean[:, None, :]
+        shift = mean - self.mu0
+        psi = self.psi0 + deviations + (self.kappa0 * n / kappa)[:, None, None] * shift[:, :, None] * shift[:, None, :]
+        return (self.kappa0[:, None] * self.mu0 + total) / kappa[:, None], kappa, self.nu0 + n, psi
+
+    def sample_means(self, size: int = None) -> np.ndarray:
+        """ A draw of the mean vector of every arm, shaped (n_arms, dim), or (size, n_arms, dim) """
+        mu, kappa, nu, psi = self.posterior()
+        shape = (self.n_arms,) if size is None else (size, self.n_arms)
+        # Bartlett decomposition: W = (L A)(L A)' ~ Wishart(nu, psi^-1) and covariance = W^-1 ~ Inverse-Wishart(nu, psi)
+        lower = np.linalg.cholesky(np.linalg.inv(psi))
+        a = np.tril(self.rng.standard_normal(shape + (self.dim, self.dim)), -1)
+        rows = np.arange(self.dim)
+        a[..., rows, rows] = np.sqrt(self.rng.chisquare(nu[:, None] - rows, shape + (self.dim,)))
+        m = lower @ a
+        # mean ~ N(mu, covariance / kappa) with covariance = m'^-1 m^-1
+        z = self.rng.standard_normal(shape + (self.dim, 1))
+        return mu + np.linalg.solve(np.swapaxes(m, -1, -2), z)[..., 0] / np.sqrt(kappa)[:, None]
+
+    def sample(self, size: int = None) -> np.ndarray:
+        return self.sample_means(size) @ self.weights
+
+    def mean(self) -> np.ndarray:
+        return self.posterior()[0] @ self.weights
+
+
+def simulate(arms: BetaArms, true_rewards: np.ndarray, episodes: int = 14, decisions: int = 1000,
+             batch: int = 1) -> np.ndarray:
+    """ Conversions of each episode of the notebook's simulate, choosing batch decisions per posterior update """
+    conversions = np.zeros(episodes, dtype=int)
+    for episode in range(episodes):
+        for start in range(0, decisions, batch):
+            chosen = arms.choose(min(batch, decisions - start))
+            converted = arms.rng.random_sample(len(chosen)) < true_rewards[chosen]
+            arms.update_impression(chosen)
+            arms.update_conversion(chosen[converted])
+            conversions[episode] += np.count_nonzero(converted)
+    return conversions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--arms', type=int, default=1000)
+    parser.add_argument('--decisions', type=int, default=100000)
+    parser.add_argument('--batch', type=int, default=100, help='decisions per posterior update')
+    parser.add_argument('--store', help='SQLite parameter store path')
+    parser.add_argument('--flush-seconds', type=float, default=FLUSH_SECONDS)
+    parser.add_argument('--seed', type=int)
+    args = parser.parse_args()
+
+    store = ParameterStore(args.store) if args.store else None
+    arms = BetaArms(args.arms, store=store, name='simulation' if store else None, flush_seconds=args.flush_seconds,
+                    seed=args.seed)
+    true_rewards = arms.rng.beta(2, 8, args.arms)
+    start = time.perf_counter()
+    conversions = simulate(arms, true_rewards, episodes=1, decisions=args.decisions, batch=args.batch)[0]
+    seconds = time.perf_counter() - start
+    arms.flush()
+    print(f'{args.decisions} decisions over {args.arms} arms in {seconds:.2f}s '
+          f'({1e6 * seconds / args.decisions:.1f}us each): conversion rate {conversions / args.decisions:.3f}, '
+          f'best arm {true_rewards.max():.3f}')
+
+
+if __name__ == '__main__':
+    main()
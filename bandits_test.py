@@ -0,0 +1,101 @@
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+import bandits
+
+
+class BanditsTest(unittest.TestCase):
+    def test_beta_updates(self):
+        arms = bandits.BetaArms(3, alpha=[1, 2, 3], beta=1)
+        arms.update_impression([0, 0, 1, 2, 2, 2])
+        arms.update_conversion([0, 2])
+        assert arms.alpha.tolist() == [2, 2, 4] and arms.beta.tolist() == [2, 2, 3]
+        arms.update([1, 1], [1, 0])
+        assert arms.alpha.tolist() == [2, 3, 4] and arms.beta.tolist() == [2, 3, 3]
+
+    def test_arms_need_sample_and_mean(self):
+        class Incomplete(bandits.Arms):
+            def sample(self, size=None):
+                return np.zeros(self.n_arms)
+
+        with self.assertRaises(TypeError):
+            Incomplete(3, 1)
+
+    def test_beta_choose(self):
+        arms = bandits.BetaArms(4, alpha=[1, 80, 20, 9], beta=[1, 20, 80, 1], seed=0)
+        assert arms.sample().shape == (4,) and arms.sample(5).shape == (5, 4)
+        counts = np.bincount(arms.choose(10000), minlength=4) / 10000
+        assert counts[3] > 0.75 and counts[2] == 0, counts
+
+        true_rewards = np.array([0.5, 0.85, 0.25, 0.99])
+        conversions = bandits.simulate(arms, true_rewards, episodes=3, batch=10)
+        assert conversions[-1] > 950, conversions
+
+    def test_normal_matches_sequential_updates(self):
+        rng = np.random.RandomState(0)
+        arms = bandits.NormalArms(3, mu=1., lam=2., alpha=3., beta=4.)
+        chosen, rewards = rng.randint(3, size=50), rng.normal(5, 2, 50)
+        arms.update(chosen[:20], rewards[:20])
+        arms.update(chosen[20:], rewards[20:])
+
+        mu, lam, alpha, beta = [np.array([1.] * 3), np.array([2.] * 3), np.array([3.] * 3), np.array([4.] * 3)]
+        for arm, x in zip(chosen, rewards):
+            beta[arm] += lam[arm] * (x - mu[arm]) ** 2 / (2 * (lam[arm] + 1))
+            mu[arm] = (lam[arm] * mu[arm] + x) / (lam[arm] + 1)
+            lam[arm] += 1
+            alpha[arm] += 0.5
+        for actual, expected in zip(arms.posterior(), (mu, lam, alpha, beta)):
+            assert np.allclose(actual, expected)
+
+        draws = arms.sample(20000)
+        assert np.allclose(draws.mean(axis=0), arms.mean(), atol=0.05)
+
+    def test_multivariate_normal_matches_sequential_updates(self):
+        rng = np.random.RandomState(0)
+        arms = bandits.MultivariateNormalArms(2, 3, mu=[1., 0., -1.], kappa=2., nu=6., seed=0)
+        chosen, rewards = rng.randint(2, size=40), rng.normal(1, 2, (40, 3))
+        arms.update(chosen, rewards)
+
+        mu, kappa, nu = np.array([[1., 0., -1.]] * 2), np.array([2.] * 2), np.array([6.] * 2)
+        psi = np.array([np.eye(3)] * 2)
+        for arm, x in zip(chosen, rewards):
+            shift = x - mu[arm]
+            psi[arm] += kappa[arm] / (kappa[arm] + 1) * np.outer(shift, shift)
+            mu[arm] = (kappa[arm] * mu[arm] + x) / (kappa[arm] + 1)
+            kappa[arm] += 1
+            nu[arm] += 1
+        for actual, expected in zip(arms.posterior(), (mu, kappa, nu, psi)):
+            assert np.allclose(actual, expected)
+
+        # mean ~ multivariate t: covariance psi / (kappa (nu - dim - 1))
+        draws = arms.sample_means(40000)
+        assert np.allclose(draws.mean(axis=0), mu, atol=0.05)
+        covariance = np.cov(draws[:, 0].T)
+        assert np.allclose(covariance, psi[0] / (kappa[0] * (nu[0] - 4)), atol=0.02), covariance
+        assert arms.sample(7).shape == (7, 2) and arms.choose(7).shape == (7,)
+
+    def test_store_merges_workers(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'bandits.sqlite')
+            stores = [bandits.ParameterStore(path), bandits.ParameterStore(path)]
+            workers = [bandits.BetaArms(3, store=store, name='ads', flush_seconds=60.) for store in stores]
+            workers[0].update_impression([0, 1])
+            workers[1].update_impression([1, 2, 2])
+            workers[1].update_conversion([2])
+            assert bandits.ParameterStore(path).load('ads', (3, 2)).sum() == 0  # Nothing flushed yet
+            for worker in workers:
+                worker.flush()
+            expected = [[1, 0], [2, 0], [2, 1]]
+            assert workers[1].stats.tolist() == expected
+            assert bandits.BetaArms(3, store=bandits.ParameterStore(path), name='ads').stats.tolist() == expected
+
+            workers[0].flush_seconds = 0.
+            workers[0].update_impression([0])  # Flushed right away
+            assert stores[1].load('ads', (3, 2))[0, 0] == 2
+            with self.assertRaises(ValueError):
+                stores[0].load('ads', (4, 2))
+            for store in stores:
+                store.close()
@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+# @File: gridworld.py
+""" Exact solvers for the Gridworld of gridworld_mdp.ipynb (Sutton & Barto Example 3.5/3.8), at any dim
+
+compile_gridworld turns a Gridworld into a SparseMDP once: one sparse row of next-state probabilities per
+(action, state), and the expected reward of each. value_iteration, policy_iteration and solve_lp then work on
+whole arrays instead of stepping the environment state by state, which takes them from the 5x5 board of the
+notebook to boards of a million states:
+
+    python gridworld.py --dim 1000 --solvers vi pi
+"""
+import argparse
+import time
+from enum import Enum
+from typing import Dict, List, Tuple
+
+import numpy as np
+from scipy import sparse
+from scipy.optimize import linprog
+from scipy.sparse.linalg import spsolve
+
+
+# Special states move to their destination with their reward, whatever the action: A and B of the book
+SpecialStates = Dict[Tuple[int, int], Tuple[Tuple[int, int], float]]
+SPECIAL_STATES = {(0, 1): ((4, 1), 10), (0, 3): ((2, 3), 5)}  # type: SpecialStates
+
+
+class Action(Enum):
+    NORTH = 'N', 0, lambda x: (x[0] - 1, x[1]), (0, 1)
+    EAST = 'E', 1, lambda x: (x[0], x[1] + 1), (1, 0)
+    WEST = 'W', 2, lambda x: (x[0], x[1] - 1), (-1, 0)
+    SOUTH = 'S', 3, lambda x: (x[0] + 1, x[1]), (0, -1)
+
+    def __init__(self, display_name, index, transition, direction):
+        self.display_name = display_name
+        self.index = index
+        self.transition = transition  # numpy row-major coordinates
+        self.direction = direction  # matplotlib coordinates
+
+    def __str__(self):
+        return self.display_name
+
+
+class Gridworld(object):
+    def __init__(self, initial_state=(0, 0), dim=5, special_states: SpecialStates = None):
+        self.dim = dim
+        self.state = initial_state
+        self.special_states = SPECIAL_STATES if special_states is None else special_states
+        for state, (new_state, _) in self.special_states.items():
+            if not self._on_board(state) or not self._on_board(new_state):
+                raise ValueError(f'special state {state} -> {new_state} is off the {dim}x{dim} board')
+
+    def _on_board(self, state):
+        return 0 <= state[0] < self.dim and 0 <= state[1] < self.dim
+
+    def set_state(self, state):
+        self.state = state
+
+    def _transition_state(self, action):
+        """Try to apply the ACTION and check whether it is valid"""
+        x, y = action.transition(self.state)
+        if x < 0 or x >= self.dim:
+            return self.state
+        elif y < 0 or y >= self.dim:
+            return self.state
+        return x, y
+
+    def transition(self, action):
+        """Apply the given ACTION to the current state and return the new state and reward."""
+        reward = 0
+        if self.state in self.special_states:
+            new_state, reward = self.special_states[self.state]
+        else:
+            new_state = self._transition_state(action)
+            # invalid move
+            if new_state == self.state:
+                reward = -1
+
+        self.state = new_state
+        return new_state, reward
+
+
+class SparseMDP(object):
+    """ Finite MDP over states 0..n_states - 1 and actions 0..n_actions - 1
+
+    Row a * n_states + s of transitions holds the probabilities of the next states after action a in state s,
+    and rewards[a, s] is the expected reward. States are laid out row-major in shape.
+    """
+    def __init__(self, transitions: sparse.spmatrix, rewards: np.ndarray, shape: Tuple[int, ...] = None):
+        self.rewards = np.asarray(rewards, dtype=float)
+        self.n_actions, self.n_states = self.rewards.shape
+        self.transitions = sparse.csr_matrix(transitions)
+        if self.transitions.shape != (self.n_actions * self.n_states, self.n_states):
+            raise ValueError(f'transitions of shape {self.transitions.shape} for {self.n_actions} actions and '
+                             f'{self.n_states} states')
+        self.shape = shape or (self.n_states,)
+
+    @classmethod
+    def deterministic(cls, next_states: np.ndarray, rewards: np.ndarray, shape: Tuple[int, ...] = None):
+        """ MDP where action a in state s always leads to next_states[a, s] """
+        size = next_states.size
+        transitions = sparse.csr_matrix((np.ones(size), next_states.ravel(), np.arange(size + 1)),
+                                        shape=(size, next_states.shape[1]))
+        return cls(transitions, rewards, shape)
+
+    def action_values(self, values: np.ndarray, gamma: float) -> np.ndarray:
+        """ q(s, a) = r(s, a) + gamma * E[v(s')], shaped (n_actions, n_states) """
+        return self.rewards + gamma * (self.transitions @ values).reshape(self.n_actions, self.n_states)
+
+    def policy_model(self, policy: np.ndarray) -> Tuple[sparse.csr_matrix, np.ndarray]:
+        """ Transitions between states and expected rewards when following policy
+
+        policy is either an action per state or the (n_actions, n_states) probabilities of each action.
+        """
+        states = np.arange(self.n_states)
+        if policy.ndim == 1:
+            return self.transitions[policy * self.n_states + states], self.rewards[policy, states]
+        weighted = sparse.diags(policy.ravel()) @ self.transitions
+        total = sparse.hstack([sparse.identity(self.n_states, format='csr')] * self.n_actions, format='csr')
+        return (total @ weighted).tocsr(), (policy * self.rewards).sum(axis=0)
+
+
+def compile_gridworld(world: Gridworld) -> SparseMDP:
+    """ The SparseMDP of world, states indexed row * dim + col """
+    dim = world.dim
+    states = np.arange(dim * dim)
+    rows, cols = np.divmod(states, dim)
+    next_states = np.empty((len(Action), dim * dim), dtype=int)
+    rewards = np.empty((len(Action), dim * dim))
+    for action in Action:
+        row, col = action.transition((rows, cols))
+        valid = (row >= 0) & (row < dim) & (col >= 0) & (col < dim)
+        next_states[action.index] = np.where(valid, row * dim + col, states)
+        rewards[action.index] = np.where(valid, 0., -1.)
+    for (row, col), ((new_row, new_col), reward) in world.special_states.items():
+        next_states[:, row * dim + col] = new_row * dim + new_col
+        rewards[:, row * dim + col] = reward
+    return SparseMDP.deterministic(next_states, rewards, shape=(dim, dim))
+
+
+class Solution(object):
+    """ State values and greedy policy found by a solver, both shaped like the states of the MDP """
+    def __init__(self, mdp: SparseMDP, values: np.ndarray, gamma: float, iterations: int, seconds: float,
+                 iteration_seconds: List[float] = None):
+        q = mdp.action_values(values, gamma)
+        self.values = values.reshape(mdp.shape)
+        self.policy = q.argmax(axis=0).reshape(mdp.shape)
+        self.residual = np.abs(q.max(axis=0) - values).max()  # Bellman optimality error of values
+        self.iterations = iterations
+        self.seconds = seconds
+        self.iteration_seconds = iteration_seconds or []
+
+    def __str__(self):
+        s = f'{self.iterations} iterations in {self.seconds:.2f}s'
+        if self.iteration_seconds:
+            s += f' ({1000 * np.mean(self.iteration_seconds):.1f}ms each)'
+        return s + f', residual {self.residual:.2g}'
+
+
+def evaluate_policy(mdp: SparseMDP, policy: np.ndarray, gamma: float = 0.9, tol: float = None,
+                    values: np.ndarray = None) -> np.ndarray:
+    """ v of policy (see SparseMDP.policy_model), solved exactly or, given tol, iterated from values until no value
+    moves by more than tol """
+    transitions, rewards = mdp.policy_model(policy)
+    if tol is None:
+        return spsolve((sparse.identity(mdp.n_states, format='csc') - gamma * transitions).tocsc(), rewards)
+    values = np.zeros(mdp.n_states) if values is None else values
+    while True:
+        new_values = rewards + gamma * (transitions @ values)
+        if np.abs(new_values - values).max() < tol:
+            return new_values
+        values = new_values
+
+
+def value_iteration(mdp: SparseMDP, gamma: float = 0.9, tol: float = 1e-6, max_iterations: int = 100000,
+                    values: np.ndarray = None) -> Solution:
+    """ Sweep v(s) = max_a q(s, a) over all states at once until no value moves by more than tol """
+    start = time.perf_counter()
+    values = np.zeros(mdp.n_states) if values is None else values.ravel()
+    iteration_seconds = []
+    for _ in range(max_iterations):
+        iteration_start = time.perf_counter()
+        new_values = mdp.action_values(values, gamma).max(axis=0)
+        delta = np.abs(new_values - values).max()
+        values = new_values
+        iteration_seconds.append(time.perf_counter() - iteration_start)
+        if delta < tol:
+            break
+    return Solution(mdp, values, gamma, len(iteration_seconds), time.perf_counter() - start, iteration_seconds)
+
+
+def policy_iteration(mdp: SparseMDP, gamma: float = 0.9, tol: float = 1e-6, max_iterations: int = 1000,
+                     policy: np.ndarray = None, exact: bool = False) -> Solution:
+    """ Alternate policy evaluation and greedy improvement until the policy is stable
+
+    Evaluation solves the linear system of the policy when exact, and otherwise iterates it to tol starting
+    from the previous values, which is much cheaper on large boards. Improvement only switches the action of a
+    state when another action is better by more than tol.
+    """
+    start = time.perf_counter()
+    states = np.arange(mdp.n_states)
+    policy = np.zeros(mdp.n_states, dtype=int) if policy is None else policy.ravel()
+    values = None
+    iteration_seconds = []
+    for _ in range(max_iterations):
+        iteration_start = time.perf_counter()
+        values = evaluate_policy(mdp, policy, gamma, None if exact else tol, values)
+        q = mdp.action_values(values, gamma)
+        greedy = q.argmax(axis=0)
+        improve = q[greedy, states] > q[policy, states] + tol
+        policy = np.where(improve, greedy, policy)
+        iteration_seconds.append(time.perf_counter() - iteration_start)
+        if not improve.any():
+            break
+    return Solution(mdp, values, gamma, len(iteration_seconds), time.perf_counter() - start, iteration_seconds)
+
+
+def solve_lp(mdp: SparseMDP, gamma: float = 0.9, method: str = 'highs', options: dict = None) -> Solution:
+    """ Minimize sum_s v(s) subject to v(s) >= q(s, a) for every state and action, as one sparse LP
+
+    Uses scipy's linprog in place of the OR-Tools model of the notebook, the constraints being built as one
+    sparse matrix rather than variable by variable. method='highs' needs scipy 1.5; older versions can use
+    'interior-point' with options=dict(sparse=True).
+    """
+    start = time.perf_counter()
+    # v(s) - gamma * E[v(s')] >= r(s, a), as -v(s) + gamma * E[v(s')] <= -r(s, a)
+    states = sparse.vstack([sparse.identity(mdp.n_states, format='csr')] * mdp.n_actions, format='csr')
+    constraints = gamma * mdp.transitions - states
+    result = linprog(np.ones(mdp.n_states), A_ub=constraints, b_ub=-mdp.rewards.ravel(), bounds=(None, None),
+                     method=method, options=options)
+    if result.status != 0:
+        raise RuntimeError(f'LP failed with status {result.status}: {result.message}')
+    return Solution(mdp, result.x, gamma, result.nit, time.perf_counter() - start)
+
+
+SOLVERS = dict(vi=value_iteration, pi=policy_iteration, lp=solve_lp)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--dim', type=int, default=5)
+    parser.add_argument('--gamma', type=float, default=0.9)
+    parser.add_argument('--tol', type=float, default=1e-6)
+    parser.add_argument('--solvers', nargs='+', default=['vi', 'pi'], choices=list(SOLVERS))
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    mdp = compile_gridworld(Gridworld(dim=args.dim))
+    print(f'Compiled {mdp.n_states} states, {mdp.transitions.nnz} transitions in {time.perf_counter() - start:.2f}s')
+    solutions = dict()
+    for name in args.solvers:
+        kwargs = dict() if name == 'lp' else dict(tol=args.tol)
+        solutions[name] = SOLVERS[name](mdp, args.gamma, **kwargs)
+        print(f'{name}: {solutions[name]}')
+    first, *others = solutions
+    for name in others:
+        difference = np.abs(solutions[name].values - solutions[first].values).max()
+        print(f'max |v_{name} - v_{first}| = {difference:.2g}')
+    if args.dim <= 10:
+        print(np.round(solutions[first].values, 1))
+
+
+if __name__ == '__main__':
+    main()
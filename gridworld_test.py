@@ -0,0 +1,56 @@
+import unittest
+from itertools import product
+
+import numpy as np
+
+import gridworld
+
+
+# Sutton & Barto Figure 3.2 and 3.5, gamma=0.9
+EXPECTED_VALUES_RANDOM = np.array([
+    [3.3, 8.8, 4.4, 5.3, 1.5],
+    [1.5, 3.0, 2.3, 1.9, 0.5],
+    [0.1, 0.7, 0.7, 0.4, -0.4],
+    [-1.0, -0.4, -0.4, -0.6, -1.2],
+    [-1.9, -1.3, -1.2, -1.4, -2.0],
+])
+EXPECTED_VALUES = np.array([
+    [22.0, 24.4, 22.0, 19.4, 17.5],
+    [19.8, 22.0, 19.8, 17.8, 16.0],
+    [17.8, 19.8, 17.8, 16.0, 14.4],
+    [16.0, 17.8, 16.0, 14.4, 13.0],
+    [14.4, 16.0, 14.4, 13.0, 11.7],
+])
+
+
+class GridworldTest(unittest.TestCase):
+    def test_compile_matches_transition(self):
+        world = gridworld.Gridworld(dim=7)
+        mdp = gridworld.compile_gridworld(world)
+        for (row, col), action in product(product(range(7), range(7)), gridworld.Action):
+            world.set_state((row, col))
+            (new_row, new_col), reward = world.transition(action)
+            transitions = mdp.transitions[action.index * mdp.n_states + row * 7 + col]
+            assert transitions.indices.tolist() == [new_row * 7 + new_col] and transitions.data.tolist() == [1.]
+            assert mdp.rewards[action.index, row * 7 + col] == reward
+
+    def test_textbook_values(self):
+        mdp = gridworld.compile_gridworld(gridworld.Gridworld())
+        random_values = gridworld.evaluate_policy(mdp, np.full((4, 25), 0.25)).reshape(5, 5)
+        assert np.abs(random_values - EXPECTED_VALUES_RANDOM).max() < 0.051
+        for solver in [gridworld.value_iteration, gridworld.policy_iteration, gridworld.solve_lp]:
+            solution = solver(mdp)
+            assert np.abs(solution.values - EXPECTED_VALUES).max() < 0.051, solver
+            assert solution.residual < 1e-5 and solution.iterations > 0
+
+    def test_solvers_agree(self):
+        mdp = gridworld.compile_gridworld(gridworld.Gridworld(dim=30))
+        vi = gridworld.value_iteration(mdp, tol=1e-8)
+        for solution in [gridworld.policy_iteration(mdp, tol=1e-8), gridworld.policy_iteration(mdp, exact=True),
+                         gridworld.solve_lp(mdp)]:
+            assert np.abs(solution.values - vi.values).max() < 1e-6
+        assert len(vi.iteration_seconds) == vi.iterations
+
+    def test_special_states_on_board(self):
+        with self.assertRaises(ValueError):
+            gridworld.Gridworld(dim=4)
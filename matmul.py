@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+# @File: matmul.py
+""" Tiled matrix multiplication over a process pool, from the par_matmul experiment of ray.ipynb
+
+par_matmul submitted one remote dot per element of the output, each fetching a whole row of A and the whole
+transposed B. TiledMatmul copies A and B into one block of shared memory per call instead, and hands the pool
+nothing but tile coordinates: each task multiplies a tile of A by a tile of B at a time, cache-sized, and adds
+them up into its tile of the output, also in the shared block. When the output has fewer tiles than there are
+workers, as for the tall inner dimension of the notebook, the inner dimension is split as well and the partial
+products summed at the end. time_matmul measures any implementation against np.matmul:
+
+    python matmul.py --shapes 2048,2048,2048 5,10000000,3 --workers 1 2 4
+"""
+import argparse
+import os
+import time
+from contextlib import contextmanager
+from multiprocessing import get_context, shared_memory
+from typing import Callable, Dict, List, Sequence, Tuple
+
+import numpy as np
+
+
+TILE = 256  # 512kB tiles of float64
+BLAS_THREADS = ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS')
+
+Shape = Tuple[int, int, int]
+
+
+def local_matmul(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """ A(l, m) x B(m, n) = C(l, n), one np.dot per element as in the notebook """
+    assert a.shape[1] == b.shape[0]  # m == m
+    res = np.zeros((a.shape[0], b.shape[1]))  # (l,n)
+    b_t = b.T  # for read localility from row-major  # (m, n) -> (n, m)
+    for i in range(a.shape[0]):  # l
+        for j in range(b_t.shape[0]):  # n
+            res[i, j] = np.dot(a[i], b_t[j])
+    return res
+
+
+_attached = dict()  # type: Dict[str, shared_memory.SharedMemory]
+
+
+def _attach(name: str) -> memoryview:
+    """ Buffer of the shared block name, attached once per worker; the previous block is let go """
+    if name not in _attached:
+        for memory in _attached.values():
+            memory.close()
+        _attached.clear()
+        _attached[name] = shared_memory.SharedMemory(name=name)
+    return _attached[name].buf
+
+
+def _views(buffer, shape: Shape, splits: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """ A, B and the partial products, laid out one after another in buffer """
+    l, m, n = shape
+    a = np.ndarray((l, m), buffer=buffer)
+    b = np.ndarray((m, n), buffer=buffer, offset=a.nbytes)
+    partials = np.ndarray((splits, l, n), buffer=buffer, offset=a.nbytes + b.nbytes)
+    return a, b, partials
+
+
+def _multiply_tile(task) -> None:
+    name, shape, splits, tile, (split, i, j, k_start, k_stop) = task
+    a, b, partials = _views(_attach(name), shape, splits)
+    out = partials[split, i:i + tile, j:j + tile]
+    out[:] = 0
+    depth = max(tile, tile * tile // max(out.shape))  # Longer steps for thin tiles, same footprint
+    for k in range(k_start, k_stop, depth):
+        out += a[i:i + tile, k:min(k + depth, k_stop)] @ b[k:min(k + depth, k_stop), j:j + tile]
+
+
+@contextmanager
+def _environment(**variables):
+    previous = {key: os.environ.get(key) for key in variables}
+    os.environ.update(variables)
+    try:
+        yield
+    finally:
+        for key, value in previous.items():
+            if value is None:
+                del os.environ[key]
+            else:
+                os.environ[key] = value
+
+
+class TiledMatmul(object):
+    """ C = A @ B over a pool of workers processes, in tiles of tile x tile
+
+    Each worker runs single-threaded BLAS, so workers is the number of cores used. The pool is started once and
+    reused across calls; close it when done, or use the TiledMatmul as a context manager.
+    """
+    def __init__(self, workers: int = None, tile: int = TILE):
+        self.workers = workers or os.cpu_count()
+        self.tile = tile
+        # Spawned, so that the variables are read when each worker loads its BLAS
+        with _environment(**{variable: '1' for variable in BLAS_THREADS}):
+            self.pool = get_context('spawn').Pool(self.workers)
+
+    def tasks(self, shape: Shape) -> Tuple[int, List[Tuple[int, int, int, int, int]]]:
+        """ Number of splits of the inner dimension, and (split, i, j, k_start, k_stop) of every task """
+        l, m, n = shape
+        tiles = [(i, j) for i in range(0, l, self.tile) for j in range(0, n, self.tile)]
+        splits = min(max(1, self.workers // max(1, len(tiles))), max(1, m // self.tile))
+        bounds = np.linspace(0, m, splits + 1).astype(int) // self.tile * self.tile
+        bounds[-1] = m
+        return splits, [(split, i, j, bounds[split], bounds[split + 1]) for split in range(splits) for i, j in tiles]
+
+    def __call__(self, a: np.ndarray, b: np.ndarray) -> np.ndarray:
+        if a.ndim != 2 or b.ndim != 2 or a.shape[1] != b.shape[0]:
+            raise ValueError(f'cannot multiply {a.shape} by {b.shape}')
+        shape = a.shape + b.shape[1:]
+        splits, tasks = self.tasks(shape)
+        size = 8 * (a.size + b.size + splits * shape[0] * shape[2])
+        memory = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        try:
+            shared_a, shared_b, partials = _views(memory.buf, shape, splits)
+            shared_a[:], shared_b[:] = a, b
+            self.pool.map(_multiply_tile, [(memory.name, shape, splits, self.tile, task) for task in tasks],
+                          chunksize=max(1, len(tasks) // (4 * self.workers)))
+            result = partials.sum(axis=0)
+            del shared_a, shared_b, partials
+        finally:
+            memory.close()
+            memory.unlink()
+        return result
+
+    def close(self) -> None:
+        self.pool.close()
+        self.pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def time_matmul(impl: Callable[[np.ndarray, np.ndarray], np.ndarray], l: int, m: int, n: int, trials: int = 3,
+                seed: int = 0) -> Tuple[float, float]:
+    """ Mean and standard deviation of the seconds impl takes over trials
+
+    Inputs are drawn once, and impl runs once before the timed trials, to check its result against np.matmul and
+    warm up its caches and workers.
+    """
+    rng = np.random.RandomState(seed)
+    a, b = rng.rand(l, m), rng.rand(m, n)
+    np.testing.assert_allclose(impl(a, b), np.matmul(a, b))
+    times = []
+    for _ in range(trials):
+        start = time.perf_counter()
+        impl(a, b)
+        times.append(time.perf_counter() - start)
+    return np.mean(times), np.std(times)
+
+
+def benchmark(shapes: Sequence[Shape], workers: Sequence[int], tile: int = TILE, trials: int = 3,
+              local: bool = False) -> List[dict]:
+    """ Seconds, GFLOP/s and scaling efficiency (relative to the first worker count) of np.matmul, TiledMatmul
+    and, if local, local_matmul """
+    results = []
+    for l, m, n in shapes:
+        flops = 2. * l * m * n
+        for name, impl in [('numpy', np.matmul)] + ([('local', local_matmul)] if local else []):
+            seconds, std = time_matmul(impl, l, m, n, trials)
+            results.append(dict(shape=(l, m, n), impl=name, workers=None, seconds=seconds, std=std,
+                                gflops=flops / seconds / 1e9, efficiency=None))
+        single = None
+        for count in workers:
+            with TiledMatmul(count, tile) as engine:
+                seconds, std = time_matmul(engine, l, m, n, trials)
+            single = single or seconds * count
+            results.append(dict(shape=(l, m, n), impl='tiled', workers=count, seconds=seconds, std=std,
+                                gflops=flops / seconds / 1e9, efficiency=single / (seconds * count)))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--shapes', nargs='+', default=['1024,1024,1024', '5,1000000,3'], help='l,m,n')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--tile', type=int, default=TILE)
+    parser.add_argument('--trials', type=int, default=3)
+    parser.add_argument('--local', action='store_true', help='also time local_matmul, one np.dot per element')
+    args = parser.parse_args()
+
+    shapes = [tuple(int(size) for size in shape.split(',')) for shape in args.shapes]
+    print(f'{"shape":>20} {"impl":>6} {"workers":>7} {"seconds":>16} {"GFLOP/s":>8} {"efficiency":>10}')
+    for result in benchmark(shapes, args.workers, args.tile, args.trials, args.local):
+        efficiency = '' if result['efficiency'] is None else f'{result["efficiency"]:.0%}'
+        print(f'{"x".join(map(str, result["shape"])):>20} {result["impl"]:>6} {result["workers"] or "":>7} '
+              f'{result["seconds"]:>9.4f}±{result["std"]:.4f} {result["gflops"]:>8.2f} {efficiency:>10}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,36 @@
+import unittest
+
+import numpy as np
+
+import matmul
+
+
+class MatmulTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.engine = matmul.TiledMatmul(workers=3, tile=32)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.engine.close()
+
+    def test_tiled_matches_numpy(self):
+        rng = np.random.RandomState(0)
+        for l, m, n in [(70, 100, 45), (5, 10000, 3), (1, 1, 1), (33, 32, 64), (0, 5, 3)]:
+            a, b = rng.rand(l, m), rng.rand(m, n)
+            np.testing.assert_allclose(self.engine(a, b), np.matmul(a, b))
+        with self.assertRaises(ValueError):
+            self.engine(rng.rand(3, 4), rng.rand(3, 4))
+
+    def test_tasks_cover_output_and_inner_dimension(self):
+        splits, tasks = self.engine.tasks((5, 1000, 3))  # One output tile: the inner dimension is split instead
+        assert splits == 3 and len(tasks) == 3
+        assert [task[3:] for task in tasks] == [(0, 320), (320, 640), (640, 1000)]
+        splits, tasks = self.engine.tasks((70, 100, 45))
+        assert splits == 1 and sorted(task[1:3] for task in tasks) == [(i, j) for i in (0, 32, 64) for j in (0, 32)]
+
+    def test_time_matmul(self):
+        a, b = np.random.rand(4, 6), np.random.rand(6, 5)
+        np.testing.assert_allclose(matmul.local_matmul(a, b), np.matmul(a, b))
+        seconds, std = matmul.time_matmul(self.engine, 40, 50, 60, trials=2)
+        assert seconds > 0 and std >= 0
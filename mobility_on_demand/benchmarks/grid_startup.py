@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+# @File: grid_startup.py
+""" Compare Grid startup from the csvs against the compiled binary cache
+
+Each trial runs in a fresh interpreter so module imports and page cache effects are counted the way a new
+worker would see them. Run from the mobility_on_demand folder: python benchmarks/grid_startup.py
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+
+SUBMISSION_DIR = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'model'))
+TRIAL = '''
+import json, sys, time
+start = time.perf_counter()
+sys.path.append({model!r})
+import grid
+g = grid.Grid(cache_dir={cache_dir!r})
+g.grid_ids
+loaded = time.perf_counter()
+g.lookup(104.07, 30.67)
+looked_up = time.perf_counter()
+g.idle_transitions(1488330000, g.grid_ids[0])
+print(json.dumps(dict(load=loaded - start, lookup=looked_up - loaded, transitions=time.perf_counter() - looked_up)))
+'''
+
+
+def trial(cache_dir: str) -> dict:
+    code = TRIAL.format(model=SUBMISSION_DIR, cache_dir=cache_dir)
+    return json.loads(subprocess.check_output([sys.executable, '-c', code]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--trials', type=int, default=5)
+    args = parser.parse_args()
+
+    sys.path.append(SUBMISSION_DIR)
+    import grid
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        grid.compile_cache(cache_dir)
+        results = {'csv': [trial(None) for _ in range(args.trials)],
+                   'cache': [trial(cache_dir) for _ in range(args.trials)]}
+
+    print(f'{"source":<8}{"load ms":>10}{"lookup ms":>12}{"transitions ms":>16}{"total ms":>11}')
+    for source, runs in results.items():
+        phases = {phase: 1000 * statistics.median(run[phase] for run in runs) for phase in runs[0]}
+        print(f'{source:<8}{phases["load"]:>10.1f}{phases["lookup"]:>12.1f}{phases["transitions"]:>16.1f}'
+              f'{sum(phases.values()):>11.1f}')
+
+
+if __name__ == '__main__':
+    main()
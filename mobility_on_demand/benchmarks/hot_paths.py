@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+# @File: hot_paths.py
+""" Latency and peak memory of the dispatch, reposition and grid hot paths at increasing scale
+
+Run from the mobility_on_demand folder:
+
+    python benchmarks/hot_paths.py --save benchmarks/baseline.json    # record a baseline
+    python benchmarks/hot_paths.py --baseline benchmarks/baseline.json  # compare against it
+
+Each stage is timed over --repeats calls after one warm-up call, then run once more under tracemalloc for
+its peak memory. Compared against a baseline, a stage regresses when its median latency or peak memory
+grows by more than --threshold (plus a small absolute noise floor); the exit status is 1 if any stage
+regressed. Baselines are only comparable on the machine that recorded them.
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+from typing import Any, Callable, Dict, List
+
+import numpy as np
+
+SUBMISSION_DIR = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'model'))
+sys.path.append(SUBMISSION_DIR)
+import dispatch  # noqa: E402
+import parse  # noqa: E402
+import reposition  # noqa: E402
+from observations import dispatch_observation, reposition_observation  # noqa: E402
+
+
+ALPHA, GAMMA, IDLE_REWARD, REPOSITION_GAMMA = 2 / (5 * 60), 0.9, -2 / (60 * 60), 0.9997
+# Candidate rows and idle drivers; sample is the size of samples/dispatch_observ
+SCALES = {
+    'sample': dict(rows=28, drivers=23),
+    'small': dict(rows=1000, drivers=100),
+    'medium': dict(rows=10000, drivers=1000),
+    'large': dict(rows=100000, drivers=10000),
+}
+# Growth below these absolute amounts is noise, whatever the relative change
+NOISE_FLOOR = dict(p50_ms=0.05, peak_mb=0.05)
+
+
+def stages(rows: int, drivers: int) -> Dict[str, Callable[[], Any]]:
+    """ Callables for each hot path on observations of the given scale """
+    grid = parse.HEX_GRID
+    observation = dispatch_observation(grid, rows, drivers)
+    batch = parse.parse_batch(observation)
+    repo_observ = reposition_observation(grid, drivers)
+    sarsa = dispatch.Sarsa(ALPHA, GAMMA, IDLE_REWARD)
+    dql = dispatch.Dql(ALPHA, GAMMA, IDLE_REWARD)
+    repositioner = reposition.StateValueGreedy(dispatch.Sarsa(ALPHA, GAMMA, IDLE_REWARD), REPOSITION_GAMMA)
+    repo_data = parse.RepositionData(repo_observ)
+
+    coords = [od['driver_location'] for od in observation[:drivers]]
+    grid_ids = [grid_id for _, grid_id in repo_data.drivers]
+    pairs = list(zip(grid_ids, grid_ids[1:] + grid_ids[:1]))
+
+    def lookup():
+        grid.lookup_cache.clear()
+        for lng, lat in coords:
+            grid.lookup(lng, lat)
+
+    def lookup_indices():
+        grid.lookup_cache.clear()
+        grid.lookup_indices(coords)
+
+    def distance():
+        for x, y in pairs:
+            grid.distance(x, y)
+
+    return {
+        'parse_dispatch': lambda: parse.parse_dispatch(observation),
+        'parse_batch': lambda: parse.parse_batch(observation),
+        'sarsa_dispatch': lambda: sarsa.dispatch_batch(batch),
+        'dql_dispatch': lambda: dql.dispatch_batch(batch),
+        'reposition': lambda: repositioner.reposition(repo_data),
+        'grid_lookup': lookup,
+        'grid_lookup_indices': lookup_indices,
+        'grid_distance': distance,
+    }
+
+
+def measure(fn: Callable[[], Any], repeats: int) -> Dict[str, float]:
+    fn()
+    latency = []  # type: List[float]
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        latency.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    p50, p90, p99 = np.percentile(np.array(latency) * 1000, [50, 90, 99]).tolist()
+    return dict(p50_ms=p50, p90_ms=p90, p99_ms=p99, mean_ms=1000 * float(np.mean(latency)),
+                peak_mb=peak / (1 << 20), repeats=repeats)
+
+
+def regressions(results: Dict[str, Dict[str, Dict[str, float]]], baseline: Dict[str, Dict[str, Dict[str, float]]],
+                threshold: float) -> List[str]:
+    """ Stages whose median latency or peak memory grew by more than threshold over the baseline """
+    flagged = []  # type: List[str]
+    for scale, stage_results in results.items():
+        for stage, result in stage_results.items():
+            previous = baseline.get(scale, dict()).get(stage)
+            if previous is None:
+                continue
+            for metric, floor in NOISE_FLOOR.items():
+                if result[metric] > previous[metric] * (1 + threshold) + floor:
+                    flagged.append(f'{scale}/{stage} {metric}: {previous[metric]:.3f} -> {result[metric]:.3f} '
+                                   f'(+{100 * (result[metric] / previous[metric] - 1):.0f}%)')
+    return flagged
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scales', nargs='+', default=list(SCALES), choices=list(SCALES))
+    parser.add_argument('--stages', nargs='+', help='subset of stages to run (default: all)')
+    parser.add_argument('--repeats', type=int, default=20)
+    parser.add_argument('--save', help='write the results as a baseline json')
+    parser.add_argument('--baseline', help='baseline json to compare against')
+    parser.add_argument('--threshold', type=float, default=0.2, help='allowed relative growth, 0.2 = 20%%')
+    args = parser.parse_args()
+
+    results = dict()  # type: Dict[str, Dict[str, Dict[str, float]]]
+    print(f'{"scale":<8}{"stage":<22}{"p50 ms":>10}{"p90 ms":>10}{"p99 ms":>10}{"peak MB":>10}')
+    for scale in args.scales:
+        results[scale] = dict()
+        for stage, fn in stages(**SCALES[scale]).items():
+            if args.stages and stage not in args.stages:
+                continue
+            # Fewer repeats where one call already takes a while
+            repeats = args.repeats if scale != 'large' else max(args.repeats // 4, 3)
+            result = results[scale][stage] = measure(fn, repeats)
+            print(f'{scale:<8}{stage:<22}{result["p50_ms"]:>10.2f}{result["p90_ms"]:>10.2f}{result["p99_ms"]:>10.2f}'
+                  f'{result["peak_mb"]:>10.2f}')
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(dict(python=platform.python_version(), numpy=np.__version__, results=results), f, indent=2)
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            flagged = regressions(results, json.load(f)['results'], args.threshold)
+        for line in flagged:
+            print(f'REGRESSION {line}')
+        if flagged:
+            sys.exit(1)
+        print(f'No regressions beyond {100 * args.threshold:.0f}% of {args.baseline}')
+
+
+if __name__ == '__main__':
+    main()
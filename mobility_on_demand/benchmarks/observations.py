@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+# @File: observations.py
+""" Synthetic dispatch and reposition observations in the schema of samples/, at any scale """
+from typing import Any, Dict, List
+
+import numpy as np
+
+
+TIMESTAMP = 1488330000
+DAY_OF_WEEK = 2
+
+
+def _coords(centroids: np.ndarray, rng: np.random.RandomState, n: int) -> np.ndarray:
+    """ Points scattered around random hex centroids, so lookups land inside the grid """
+    return centroids[rng.randint(0, len(centroids), n)] + rng.normal(scale=0.003, size=(n, 2))
+
+
+def dispatch_observation(grid, n_rows: int, n_drivers: int, per_order: int = 10, seed: int = 0,
+                         timestamp: int = TIMESTAMP) -> List[Dict[str, Any]]:
+    """ n_rows candidate rows over n_drivers drivers, per_order candidate drivers for each order """
+    rng = np.random.RandomState(seed)
+    centroids = np.asarray(grid.data.centroids)
+    per_order = min(per_order, n_drivers)
+    n_orders = -(-n_rows // per_order)
+    drivers = _coords(centroids, rng, n_drivers).tolist()
+    starts, ends = _coords(centroids, rng, n_orders).tolist(), _coords(centroids, rng, n_orders).tolist()
+    rewards = rng.uniform(0.5, 10, n_orders).tolist()
+    durations = rng.randint(300, 3600, n_orders).tolist()
+
+    # Distinct drivers per order: a random offset walk over a shuffled driver ring
+    ring = rng.permutation(n_drivers)
+    first = rng.randint(0, n_drivers, n_orders)
+    driver_ids = ring[(first[:, None] + np.arange(per_order)) % n_drivers].reshape(-1)[:n_rows].tolist()
+    distances = rng.uniform(0, 3000, n_rows).tolist()
+    etas = rng.uniform(0, 600, n_rows).tolist()
+
+    rows = []  # type: List[Dict[str, Any]]
+    for k, (d, distance, eta) in enumerate(zip(driver_ids, distances, etas)):
+        o = k // per_order
+        rows.append(dict(order_id=o, driver_id=d, order_driver_distance=distance, order_start_location=starts[o],
+                         order_finish_location=ends[o], driver_location=drivers[d], timestamp=timestamp,
+                         order_finish_timestamp=timestamp + durations[o], day_of_week=DAY_OF_WEEK,
+                         reward_units=rewards[o], pick_up_eta=eta))
+    return rows
+
+
+def reposition_observation(grid, n_drivers: int, seed: int = 0, timestamp: int = TIMESTAMP) -> Dict[str, Any]:
+    """ n_drivers idle drivers, with grids drawn like the drivers of dispatch_observation """
+    rng = np.random.RandomState(seed)
+    grid_ids = grid.grid_ids
+    return dict(timestamp=timestamp, day_of_week=DAY_OF_WEEK,
+                driver_info=[dict(driver_id=d, grid_id=grid_ids[g])
+                             for d, g in enumerate(rng.randint(0, len(grid_ids), n_drivers).tolist())])
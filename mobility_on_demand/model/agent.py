@@ -4,24 +4,72 @@
 # @Date:   2020-05-16
 from typing import Any, List, Dict
 
+from assign import Assigner
+import checkpoint
 import dispatch as dispatcher
+from metrics import METRICS
 import parse
 import reposition as repositioner
+import shard
+import steplog
 
 
 class Agent:
     """ Agent for dispatching and repositioning drivers for the 2020 ACM SIGKDD Cup Competition """
-    def __init__(self, alpha=2/(5*60), dispatch_gamma=0.9, idle_reward=0, reposition_gamma=0.9997):
-        self.dispatcher = dispatcher.Sarsa(alpha, dispatch_gamma, idle_reward)
-        self.repositioner = repositioner.StateValueGreedy(self.dispatcher, reposition_gamma)
+    def __init__(self, alpha=2/(5*60), dispatch_gamma=0.9, idle_reward=0, reposition_gamma=0.9997,
+                 assigner: Assigner = None, learning: str = 'sync', checkpoint_dir: str = None,
+                 checkpoint_interval: float = checkpoint.CHECKPOINT_INTERVAL, shards: int = 1,
+                 reposition_top_k: int = repositioner.TOP_K, log_dir: str = None):
+        # Warm start from the latest checkpoint, if any, instead of init_values.csv
+        snapshot = checkpoint.load(checkpoint_dir, parse.HEX_GRID.ids, 'Sarsa') if checkpoint_dir else None
+        initial_values = snapshot.values if snapshot else None
+        if shards > 1:
+            self.dispatcher = shard.ShardedSarsa(alpha, dispatch_gamma, idle_reward, assigner, learning,
+                                                 initial_values, shards)
+        else:
+            self.dispatcher = dispatcher.Sarsa(alpha, dispatch_gamma, idle_reward, assigner, learning,
+                                               initial_values)
+        if snapshot:
+            self.dispatcher.restore_state(snapshot.state)
+        self.checkpointer = checkpoint.Checkpointer(checkpoint_dir, checkpoint_interval) if checkpoint_dir else None
+        self.repositioner = repositioner.StateValueGreedy(self.dispatcher, reposition_gamma, reposition_top_k)
+        # Observations and actions for offline training (steplog.replay)
+        self.step_log = steplog.StepLog(log_dir) if log_dir else None
 
     def dispatch(self, dispatch_input: List[Dict[str, Any]]) -> List[Dict[str, str]]:
         """ Compute the assignment between drivers and passengers at each time step """
-        drivers, requests, candidates = parse.parse_dispatch(dispatch_input)
-        dispatch = self.dispatcher.dispatch(drivers, requests, candidates)
-        return [dict(order_id=order_id, driver_id=d.driver_id) for order_id, d in dispatch.items()]
+        with METRICS.step('agent.dispatch'):
+            with METRICS.timer('parse.batch'):
+                batch = parse.parse_batch(dispatch_input)
+            return self._dispatch(batch)
+
+    def dispatch_batch(self, batch: parse.DispatchBatch) -> List[Dict[str, str]]:
+        """ dispatch for an observation already parsed by parse.parse_batch """
+        with METRICS.step('agent.dispatch'):
+            return self._dispatch(batch)
 
     def reposition(self, reposition_input: Dict[str, Any]) -> List[Dict[str, str]]:
         """ Return target new positions for the given idle drivers """
-        data = parse.RepositionData(reposition_input)
-        return self.repositioner.reposition(data)
\ No newline at end of file
+        with METRICS.step('agent.reposition'):
+            return self._reposition(parse.RepositionData(reposition_input))
+
+    def reposition_data(self, data: parse.RepositionData) -> List[Dict[str, str]]:
+        """ reposition for an observation already parsed into parse.RepositionData """
+        with METRICS.step('agent.reposition'):
+            return self._reposition(data)
+
+    def _dispatch(self, batch: parse.DispatchBatch) -> List[Dict[str, str]]:
+        assigned = self.dispatcher.dispatch_batch(batch)
+        if self.step_log:
+            self.step_log.dispatch(batch, assigned, self.dispatcher.state_values.ids, self.dispatcher.flipped)
+        if self.checkpointer:
+            with METRICS.timer('checkpoint.save'):
+                self.checkpointer.maybe_save(self.dispatcher)
+        return [dict(order_id=batch.request_ids[r], driver_id=batch.driver_ids[d])
+                for r, d in zip(batch.request_idx[assigned].tolist(), batch.driver_idx[assigned].tolist())]
+
+    def _reposition(self, data: parse.RepositionData) -> List[Dict[str, str]]:
+        reposition = self.repositioner.reposition(data)
+        if self.step_log:
+            self.step_log.reposition(data, reposition)
+        return reposition
\ No newline at end of file
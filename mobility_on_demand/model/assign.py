@@ -0,0 +1,195 @@
+import time
+from abc import abstractmethod
+from typing import List, Tuple
+
+import numpy as np
+from scipy.optimize import linear_sum_assignment
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+from metrics import METRICS
+
+
+MAX_DENSE_CELLS = 4000000  # Largest component cost matrix handed to the Hungarian solver
+GREEDY_CHUNK = 1024  # Fewest edges ranked by the first pass of greedy(); each later pass ranks twice as many
+
+
+class AssignmentReport:
+    """ Outcome of the last assignment, comparing the engine against the greedy matcher """
+    def __init__(self, engine: str, objective: float, greedy_objective: float, elapsed: float,
+                 components: int = 0, fallback_components: int = 0, timed_out: bool = False):
+        self.engine = engine
+        self.objective = objective
+        self.greedy_objective = greedy_objective
+        self.gap = objective - greedy_objective
+        self.elapsed = elapsed
+        self.components = components
+        self.fallback_components = fallback_components
+        self.timed_out = timed_out
+
+    def __repr__(self):
+        return f'{self.engine}:{self.objective:.4f}(+{self.gap:.4f} over greedy) in {self.elapsed * 1000:.1f}ms'
+
+
+class Assigner:
+    """ Matches orders to drivers on the sparse candidate graph
+
+    Edges are given as parallel arrays of dense order codes, dense driver codes and scores. assign returns
+    the positions of the chosen edges, in the order the dispatcher should apply their value updates.
+    """
+    def __init__(self):
+        self.report = None  # type: AssignmentReport
+
+    @abstractmethod
+    def assign(self, orders: np.ndarray, drivers: np.ndarray, scores: np.ndarray) -> np.ndarray:
+        ...
+
+
+class Greedy(Assigner):
+    """ Highest score first, skipping edges whose order or driver is taken """
+    def assign(self, orders: np.ndarray, drivers: np.ndarray, scores: np.ndarray) -> np.ndarray:
+        start = time.perf_counter()
+        selected = greedy(orders, drivers, scores)
+        objective = float(np.sum(scores[selected]))
+        self.report = AssignmentReport('greedy', objective, objective, time.perf_counter() - start)
+        if METRICS.enabled and scores.size:
+            # Only computed for the metrics, the greedy matcher does not need the components
+            n_components, labels = components(orders, drivers)
+            observe_components(labels, n_components)
+            self.report.components = n_components
+        return selected
+
+
+class Hungarian(Assigner):
+    """ Maximum weight matching, solved exactly per connected component of the candidate graph
+
+    Components are solved with the Hungarian method on their own dense cost matrix, so cost grows with the
+    largest cluster rather than the whole window. Once budget_seconds is spent, or for components larger
+    than max_cells, the remaining components fall back to the greedy matcher. Edges with negative score are
+    never worth taking, so unlike the greedy matcher they may be left unassigned.
+    """
+    def __init__(self, budget_seconds: float = 0.5, max_cells: int = MAX_DENSE_CELLS):
+        super().__init__()
+        self.budget_seconds = budget_seconds
+        self.max_cells = max_cells
+
+    def assign(self, orders: np.ndarray, drivers: np.ndarray, scores: np.ndarray) -> np.ndarray:
+        start = time.perf_counter()
+        baseline = greedy(orders, drivers, scores)
+        if scores.size == 0:
+            self.report = AssignmentReport('hungarian', 0., 0., time.perf_counter() - start)
+            return baseline
+
+        n_components, edge_labels = components(orders, drivers)
+        observe_components(edge_labels, n_components)
+        by_component = np.argsort(edge_labels, kind='stable')
+        bounds = np.searchsorted(edge_labels[by_component], np.arange(n_components + 1))
+
+        selected = []  # type: List[np.ndarray]
+        fallback, timed_out = 0, False
+        for c in range(n_components):
+            edges = by_component[bounds[c]:bounds[c + 1]]
+            timed_out = timed_out or time.perf_counter() - start > self.budget_seconds
+            component_orders, component_drivers = np.unique(orders[edges]), np.unique(drivers[edges])
+            if edges.size == 1:
+                selected.append(edges[scores[edges] >= 0])
+            elif timed_out or component_orders.size * (component_orders.size + component_drivers.size) > self.max_cells:
+                fallback += 1
+                selected.append(edges[greedy(orders[edges], drivers[edges], scores[edges])])
+            else:
+                selected.append(self._solve(edges, orders, drivers, scores, component_orders, component_drivers))
+
+        selected = np.concatenate(selected) if selected else baseline[:0]
+        selected = selected[np.argsort(-scores[selected], kind='stable')]
+        self.report = AssignmentReport('hungarian', float(np.sum(scores[selected])), float(np.sum(scores[baseline])),
+                                       time.perf_counter() - start, n_components, fallback, timed_out)
+        return selected
+
+    @staticmethod
+    def _solve(edges: np.ndarray, orders: np.ndarray, drivers: np.ndarray, scores: np.ndarray,
+               component_orders: np.ndarray, component_drivers: np.ndarray) -> np.ndarray:
+        """ Exact matching of one component; each order may take its own zero cost dummy driver instead """
+        rows = np.searchsorted(component_orders, orders[edges])
+        cols = np.searchsorted(component_drivers, drivers[edges])
+        n, m = component_orders.size, component_drivers.size
+
+        # Keep the best edge per (order, driver) pair, earliest first among equals
+        best = np.lexsort((-scores[edges], rows * m + cols))
+        pair = (rows * m + cols)[best]
+        best = best[np.r_[True, pair[1:] != pair[:-1]]]
+
+        forbidden = 1 + 2 * np.sum(np.abs(scores[edges]))
+        cost = np.full((n, m + n), forbidden)
+        cost[rows[best], cols[best]] = -scores[edges[best]]
+        cost[np.arange(n), m + np.arange(n)] = 0.
+        row_idx, col_idx = linear_sum_assignment(cost)
+
+        chosen = np.full((n, m), -1)
+        chosen[rows[best], cols[best]] = edges[best]
+        matched = col_idx < m
+        chosen = chosen[row_idx[matched], col_idx[matched]]
+        return chosen[chosen >= 0]
+
+
+def components(orders: np.ndarray, drivers: np.ndarray) -> Tuple[int, np.ndarray]:
+    """ Connected components of the candidate graph: their number, and the component of each edge
+
+    Components are numbered from 0 by their lowest order code; orders and drivers without an edge are ignored.
+    """
+    n_orders, n_nodes = int(orders.max()) + 1, int(orders.max()) + int(drivers.max()) + 2
+    graph = coo_matrix((np.ones(orders.size), (orders, n_orders + drivers)), shape=(n_nodes, n_nodes))
+    labels = connected_components(graph, directed=False)[1][orders]
+    unique, edge_labels = np.unique(labels, return_inverse=True)
+    return unique.size, edge_labels.reshape(-1)
+
+
+def observe_components(edge_labels: np.ndarray, n_components: int) -> None:
+    """ Count the components and record the distribution of their sizes in edges """
+    if METRICS.enabled:
+        METRICS.count('assign.components', n_components)
+        for size in np.bincount(edge_labels, minlength=n_components).tolist():
+            METRICS.observe('assign.component_edges', size)
+
+
+def greedy(orders: np.ndarray, drivers: np.ndarray, scores: np.ndarray) -> np.ndarray:
+    """ Edge positions chosen by the greedy matcher, highest score first (stable among equal scores)
+
+    Same matching as scanning every edge by descending score and taking those whose order and driver are
+    both free, without ranking every edge. An edge whose order and driver have no other edge is a component
+    of its own and taken as is. The rest are ranked a chunk at a time; after each chunk, the edges whose
+    order or driver it took are dropped in bulk, so once drivers (or orders) run out the remaining edges
+    are never ranked or scanned.
+    """
+    if scores.size == 0:
+        return np.empty(0, dtype=int)
+    order_edges, driver_edges = np.bincount(orders), np.bincount(drivers)
+    lone = (order_edges[orders] == 1) & (driver_edges[drivers] == 1)
+    METRICS.count('assign.lone_edges', int(np.sum(lone)))
+
+    # Scanned through the bytearrays, filtered in bulk through the array views
+    order_taken, driver_taken = bytearray(order_edges.size), bytearray(driver_edges.size)
+    order_mask, driver_mask = np.frombuffer(order_taken, dtype=bool), np.frombuffer(driver_taken, dtype=bool)
+    selected = [np.flatnonzero(lone)]  # type: List[np.ndarray]
+    remaining = np.flatnonzero(~lone)
+    chunk = max(GREEDY_CHUNK, 4 * min(np.count_nonzero(order_edges), np.count_nonzero(driver_edges)))
+    while remaining.size:
+        if remaining.size > 2 * chunk:
+            # Every edge scoring at least the chunk-th best, ties included, ranks ahead of every other edge
+            remaining_scores = scores[remaining]
+            k = remaining.size - chunk
+            top = remaining_scores >= np.partition(remaining_scores, k)[k]
+            head, remaining = remaining[top], remaining[~top]
+        else:
+            head, remaining = remaining, remaining[:0]
+        head = head[np.argsort(-scores[head], kind='stable')]  # head is ascending, so ties keep edge order
+        chosen = []  # type: List[int]
+        for i, o, d in zip(head.tolist(), orders[head].tolist(), drivers[head].tolist()):
+            if order_taken[o] or driver_taken[d]:
+                continue
+            order_taken[o] = driver_taken[d] = 1
+            chosen.append(i)
+        selected.append(np.array(chosen, dtype=int))
+        remaining = remaining[~order_mask[orders[remaining]] & ~driver_mask[drivers[remaining]]]
+        chunk *= 2
+    selected = np.concatenate(selected)
+    return selected[np.lexsort((selected, -scores[selected]))]
@@ -0,0 +1,84 @@
+import itertools
+import unittest
+
+import numpy as np
+
+import assign
+
+
+def random_graph(rng: np.random.RandomState, n_orders: int, n_drivers: int, n_edges: int):
+    orders = rng.randint(0, n_orders, n_edges)
+    drivers = rng.randint(0, n_drivers, n_edges)
+    scores = rng.uniform(-1, 3, n_edges)
+    return orders, drivers, scores
+
+
+def sorted_scan(orders, drivers, scores) -> list:
+    """ Greedy matching by its definition: every edge by descending score, stable among ties """
+    selected, taken_orders, taken_drivers = [], set(), set()
+    for i in sorted(range(len(scores)), key=lambda i: scores[i], reverse=True):
+        if orders[i] in taken_orders or drivers[i] in taken_drivers:
+            continue
+        taken_orders.add(orders[i])
+        taken_drivers.add(drivers[i])
+        selected.append(i)
+    return selected
+
+
+def brute_force_objective(orders, drivers, scores) -> float:
+    """ Best total score over every subset of edges that forms a matching """
+    best = 0.
+    for k in range(1, min(len(set(orders)), len(set(drivers))) + 1):
+        for edges in itertools.combinations(range(len(scores)), k):
+            if len(set(orders[list(edges)])) == k and len(set(drivers[list(edges)])) == k:
+                best = max(best, float(np.sum(scores[list(edges)])))
+    return best
+
+
+class AssignTest(unittest.TestCase):
+    def test_greedy_matches_sorted_scan(self):
+        rng = np.random.RandomState(0)
+        orders, drivers, scores = random_graph(rng, 30, 40, 200)
+        scores[:20] = 1.  # ties keep input order
+        assert assign.Greedy().assign(orders, drivers, scores).tolist() == sorted_scan(orders, drivers, scores)
+
+    def test_greedy_chunks(self):
+        # Far more edges than drivers, so most edges are dropped between chunks without being ranked
+        rng = np.random.RandomState(3)
+        orders, drivers, scores = random_graph(rng, 5000, 40, 20000)
+        scores = np.round(scores, 1)  # many ties
+        orders, drivers, scores = [np.r_[x, y] for x, y in zip((orders, drivers, scores), ([5000], [40], [-1.]))]
+        expected = sorted_scan(orders, drivers, scores)
+        assert assign.greedy(orders, drivers, scores).tolist() == expected
+        assert expected[-1] == len(scores) - 1  # the lone edge, taken despite its score
+
+    def test_components(self):
+        orders = np.array([0, 0, 1, 2, 3, 3])
+        drivers = np.array([0, 1, 1, 5, 2, 3])
+        n_components, labels = assign.components(orders, drivers)
+        assert n_components == 3 and labels.tolist() == [0, 0, 0, 1, 2, 2]
+
+    def test_hungarian_optimal(self):
+        rng = np.random.RandomState(1)
+        for _ in range(20):
+            orders, drivers, scores = random_graph(rng, 4, 4, 8)
+            engine = assign.Hungarian()
+            selected = engine.assign(orders, drivers, scores)
+            assert len(set(orders[selected])) == len(selected) and len(set(drivers[selected])) == len(selected)
+            assert abs(np.sum(scores[selected]) - brute_force_objective(orders, drivers, scores)) < 1e-9
+            assert engine.report.gap >= -1e-9, engine.report
+
+    def test_hungarian_fallback(self):
+        rng = np.random.RandomState(2)
+        orders, drivers, scores = random_graph(rng, 50, 50, 300)
+        scores = np.abs(scores)
+        engine = assign.Hungarian(budget_seconds=0.)
+        selected = engine.assign(orders, drivers, scores)
+        assert engine.report.timed_out
+        assert abs(engine.report.gap) < 1e-9, engine.report
+        assert sorted(selected.tolist()) == sorted(assign.greedy(orders, drivers, scores).tolist())
+
+    def test_empty(self):
+        empty = np.empty(0, dtype=int)
+        for engine in [assign.Greedy(), assign.Hungarian()]:
+            assert engine.assign(empty, empty, np.empty(0)).size == 0
@@ -0,0 +1,160 @@
+import json
+import os
+import time
+from typing import Any, Dict, List
+
+import numpy as np
+
+from dispatch import Dispatcher
+from values import DIRTY_CHECKPOINT, ValueTable
+
+
+CHECKPOINT_VERSION = 1
+CHECKPOINT_INTERVAL = 60.  # Wall clock seconds between periodic snapshots
+FULL_EVERY = 30  # Delta snapshots between two full snapshots
+MANIFEST = 'manifest.json'
+
+
+class Snapshot:
+    """ Value table and dispatcher state restored from a checkpoint directory """
+    def __init__(self, dispatcher: str, values: ValueTable, state: Dict[str, Any]):
+        self.dispatcher = dispatcher
+        self.values = values
+        self.state = state
+
+
+class Checkpointer:
+    """ Writes dispatcher snapshots to a directory of .npy files
+
+    A full snapshot holds the values, present mask and grid ids of the table. A delta snapshot holds only
+    the grids written since the previous snapshot, plus the present mask and the grid ids interned since the
+    full snapshot, so it stays small however long the run. Snapshot files are written first and
+    manifest.json, which lists the full snapshot and its deltas in order, is replaced atomically last, so a
+    crash at any point leaves the previous checkpoint intact. The first snapshot of a Checkpointer and every
+    snapshot after full_every deltas is a full one, and files no longer listed are removed.
+    """
+    def __init__(self, directory: str, interval: float = CHECKPOINT_INTERVAL, full_every: int = FULL_EVERY):
+        self.directory = directory
+        self.interval = interval
+        self.full_every = full_every
+        self.manifest = None  # type: Dict[str, Any]
+        previous = read_manifest(directory)
+        self.seq = 0 if previous is None else previous['seq'] + 1
+        self.last_save = time.perf_counter()
+
+    def maybe_save(self, dispatcher: Dispatcher) -> bool:
+        """ Save if interval seconds have passed since the last snapshot """
+        if time.perf_counter() - self.last_save < self.interval:
+            return False
+        self.save(dispatcher)
+        return True
+
+    def save(self, dispatcher: Dispatcher, full: bool = False) -> str:
+        """ Snapshot the dispatcher, as a delta of the current checkpoint where possible; returns its name """
+        dispatcher.flush()
+        table = dispatcher.state_values
+        manifest, seq = self.manifest, self.seq
+        kind = dispatcher.kind
+        full = (full or manifest is None or manifest['dispatcher'] != kind
+                or len(manifest['deltas']) >= self.full_every)
+        n = len(table.ids)
+        dirty = table.take_dirty()
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            if full:
+                name = f'full-{seq:08d}'
+                self._write(name, values=table.values[:, :n], present=table.present[:n], ids=_encode(table.ids))
+                manifest = dict(version=CHECKPOINT_VERSION, dispatcher=kind, full=name, full_ids=n, deltas=[])
+            else:
+                name = f'delta-{seq:08d}'
+                self._write(name, index=dirty, values=table.values[:, dirty], present=table.present[:n],
+                            ids=_encode(table.ids[manifest['full_ids']:]))
+                manifest = dict(manifest, deltas=manifest['deltas'] + [name])
+            manifest.update(seq=seq, n_ids=n, state=dispatcher.checkpoint_state(), saved=time.time())
+            _write_json(os.path.join(self.directory, MANIFEST), manifest)
+        except BaseException:
+            table.dirty[DIRTY_CHECKPOINT, dirty] = True
+            raise
+        self.manifest, self.seq = manifest, seq + 1
+        self.last_save = time.perf_counter()
+        self._remove_unlisted()
+        return name
+
+    def _write(self, name: str, **arrays: np.ndarray) -> None:
+        for field, array in arrays.items():
+            with open(os.path.join(self.directory, f'{name}.{field}.npy'), 'wb') as f:
+                np.save(f, np.ascontiguousarray(array))
+                f.flush()
+                os.fsync(f.fileno())
+
+    def _remove_unlisted(self) -> None:
+        """ Remove snapshot files the manifest no longer lists, including leftovers of interrupted saves """
+        listed = set([self.manifest['full']] + self.manifest['deltas'])
+        for filename in os.listdir(self.directory):
+            if filename.endswith('.npy') and filename.split('.')[0] not in listed:
+                os.remove(os.path.join(self.directory, filename))
+
+
+def read_manifest(directory: str) -> Dict[str, Any]:
+    """ The checkpoint manifest, or None if directory holds no checkpoint """
+    path = os.path.join(directory, MANIFEST)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as f:
+        manifest = json.load(f)
+    if manifest.get('version') != CHECKPOINT_VERSION:
+        raise ValueError(f'{path}: unsupported checkpoint version {manifest.get("version")}')
+    return manifest
+
+
+def load(directory: str, grid_ids: List[str] = None, dispatcher: str = None) -> Snapshot:
+    """ Latest checkpoint in directory, or None if there is none
+
+    The full snapshot values are memory-mapped copy-on-write, so restoring costs no parse and only pages in
+    what is used. Raises ValueError if the checkpoint was not written over grid_ids, since grid indices
+    would then point at different grids, or by another dispatcher class than the one named.
+    """
+    manifest = read_manifest(directory)
+    if manifest is None:
+        return None
+    if dispatcher is not None and manifest['dispatcher'] != dispatcher:
+        raise ValueError(f'{directory}: checkpoint was written by {manifest["dispatcher"]}, not {dispatcher}')
+
+    def array(name: str, field: str, mmap_mode: str = None) -> np.ndarray:
+        return np.load(os.path.join(directory, f'{name}.{field}.npy'), mmap_mode=mmap_mode)
+
+    ids = _decode(array(manifest['full'], 'ids'))
+    values = array(manifest['full'], 'values', mmap_mode='c')
+    present = array(manifest['full'], 'present')
+    if manifest['deltas']:
+        last = manifest['deltas'][-1]
+        ids += _decode(array(last, 'ids'))
+        present = array(last, 'present')
+        if len(ids) > values.shape[1]:
+            grown = np.zeros((values.shape[0], len(ids)))
+            grown[:, :values.shape[1]] = values
+            values = grown
+        for name in manifest['deltas']:
+            values[:, array(name, 'index')] = array(name, 'values')
+    if len(ids) != manifest['n_ids'] or present.size != len(ids):
+        raise ValueError(f'{directory}: checkpoint holds {len(ids)} grids, manifest says {manifest["n_ids"]}')
+    if grid_ids is not None and ids[:len(grid_ids)] != list(grid_ids):
+        raise ValueError(f'{directory}: checkpoint was written for a different grid')
+    return Snapshot(manifest['dispatcher'], ValueTable.from_arrays(ids, values, present), manifest['state'])
+
+
+def _encode(grid_ids: List[str]) -> np.ndarray:
+    return np.array([grid_id.encode() for grid_id in grid_ids], dtype=bytes)
+
+
+def _decode(array: np.ndarray) -> List[str]:
+    return [grid_id.decode() for grid_id in array.tolist()]
+
+
+def _write_json(path: str, obj: Dict[str, Any]) -> None:
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(obj, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
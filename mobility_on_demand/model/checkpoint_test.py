@@ -0,0 +1,73 @@
+import json
+import os
+import random
+import tempfile
+import unittest
+
+import numpy as np
+
+from agent import Agent
+import checkpoint
+import dispatch
+import parse
+
+
+SAMPLE_DIR = os.path.abspath('../samples')
+
+
+class CheckpointTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        with open(os.path.join(SAMPLE_DIR, 'dispatch_observ'), 'r') as f:
+            cls.batch = parse.parse_batch(json.load(f))
+
+    def test_full_and_delta(self):
+        for cls in [dispatch.Sarsa, dispatch.Dql]:
+            dispatcher = cls(2 / 300, 0.9, -2 / 3600)
+            with tempfile.TemporaryDirectory() as directory:
+                checkpointer = checkpoint.Checkpointer(directory, full_every=2)
+                names = []
+                for step in range(5):
+                    random.seed(step)
+                    dispatcher.dispatch_batch(self.batch)
+                    dispatcher.grid_index(f'unknown-{step}')  # Interned after the full snapshot
+                    dispatcher.update_state_value(f'unknown-{step}', 1.)
+                    names.append(checkpointer.save(dispatcher))
+
+                    snapshot = checkpoint.load(directory, parse.HEX_GRID.ids, cls.__name__)
+                    n = len(dispatcher.state_values)
+                    assert snapshot.values.ids == dispatcher.state_values.ids
+                    table = dispatcher.state_values
+                    np.testing.assert_array_equal(snapshot.values.values[:, :n], table.values[:, :n])
+                    np.testing.assert_array_equal(snapshot.values.present[:n], table.present[:n])
+                    assert snapshot.state == dispatcher.checkpoint_state()
+                assert [name.split('-')[0] for name in names] == ['full', 'delta', 'delta', 'full', 'delta']
+                # Only the files of the current full snapshot and its delta remain
+                assert {filename.split('.')[0] for filename in os.listdir(directory)} == {'manifest', *names[3:]}
+
+                # Deltas only hold the grids written since the previous snapshot
+                touched = np.load(os.path.join(directory, names[4] + '.index.npy'))
+                assert 0 < touched.size < 30
+
+    def test_agent_warm_start(self):
+        with open(os.path.join(SAMPLE_DIR, 'dispatch_observ'), 'r') as f:
+            observ = json.load(f)
+        with tempfile.TemporaryDirectory() as directory:
+            agent = Agent(checkpoint_dir=directory, checkpoint_interval=0)
+            for _ in range(3):
+                agent.dispatch(observ)
+            restarted = Agent(checkpoint_dir=directory)
+            expected = agent.dispatcher.state_values
+            n = len(expected)
+            np.testing.assert_array_equal(restarted.dispatcher.state_values.values[:, :n], expected.values[:, :n])
+            assert restarted.dispatch(observ) == agent.dispatch(observ)
+
+            # A partial snapshot without a manifest update leaves the last checkpoint intact
+            with open(os.path.join(directory, 'delta-99999999.values.npy'), 'wb') as f:
+                f.write(b'partial')
+            snapshot = checkpoint.load(directory, parse.HEX_GRID.ids, 'Sarsa')
+            np.testing.assert_array_equal(snapshot.values.values[:, :n], expected.values[:, :n])
+            with self.assertRaises(ValueError):
+                checkpoint.load(directory, dispatcher='Dql')
+            with self.assertRaises(ValueError):
+                checkpoint.load(directory, ['not-a-grid'])
@@ -1,205 +1,339 @@
-import collections
-import csv
-import math
 import os
 import random
 from abc import abstractmethod
-from typing import Dict, List, Set, Tuple
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Dict, List, Set, Tuple, Union
 
-from parse import DispatchCandidate, Driver, HEX_GRID, Request
+import numpy as np
 
+from assign import Assigner, Greedy
+from metrics import METRICS
+from parse import DispatchBatch, DispatchCandidate, Driver, HEX_GRID, Request
+from values import GridKey, TopValues, ValueTable, sequential_rounds
 
-CANCEL_DISTANCE_FIT = lambda x: 0.02880619 * math.exp(0.00075371 * x)
+
+CANCEL_DISTANCE_FIT = lambda x: 0.02880619 * np.exp(0.00075371 * x)
 STEP_SECONDS = 2
+LEARNING_MODES = ('sync', 'deferred', 'background')
+
+
+class PendingUpdate:
+    """ TD updates of one dispatch step, waiting to be applied
+
+    scores holds the per-row values computed from the snapshot the matching was scored on; everything the
+    updates read from the value table is read when they are applied.
+    """
+    __slots__ = ('batch', 'assigned', 'scores')
+
+    def __init__(self, batch: DispatchBatch, assigned: np.ndarray, scores: np.ndarray):
+        self.batch = batch
+        self.assigned = assigned
+        self.scores = scores
 
 
 class Dispatcher:
-    def __init__(self, alpha, gamma, idle_reward):
+    """ Scores and matches each dispatch batch, then learns state values from it
+
+    With learning='sync' the TD updates are applied before dispatch_batch returns. 'deferred' keeps them
+    pending until the next flush(), and 'background' applies them on a worker thread while the caller goes
+    on; either way dispatch_batch and reposition flush first, so every step is scored on the values the
+    synchronous mode would see and learned values stay identical. Other reads of the values must call
+    flush() first.
+    """
+    def __init__(self, alpha, gamma, idle_reward, assigner: Assigner = None, learning: str = 'sync'):
+        assert learning in LEARNING_MODES, learning
         self.alpha = alpha
         self.gamma = gamma
         self.idle_reward = idle_reward
+        self.assigner = assigner or Greedy()
+        self.learning = learning
+        self._pending = None  # type: Union[PendingUpdate, Future]
+        self._top_values = None  # type: TopValues
+        self.flipped = False  # Whether the last step swapped the Dql student and teacher
+        self._worker = ThreadPoolExecutor(1, 'dispatch-learner') if learning == 'background' else None
 
     @staticmethod
-    def _init_state_values() -> Dict[str, float]:
-        state_values = collections.defaultdict(float)
-        value_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'init_values.csv')
-        with open(value_path, 'r') as csvfile:
-            for row in csv.reader(csvfile):
-                grid_id, value = row
-                state_values[grid_id] = float(value)
+    def _init_state_values(rows: int = 1) -> ValueTable:
+        state_values = ValueTable(HEX_GRID.ids, rows)
+        state_values.load_csv(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'init_values.csv'))
         return state_values
 
-    @abstractmethod
     def dispatch(self, drivers: Dict[str, Driver], requests: Dict[str, Request],
                  candidates: Dict[str, Set[DispatchCandidate]]) -> Dict[str, DispatchCandidate]:
-        ...
+        """ Object interface to dispatch_batch """
+        self.flush()
+        rows = [c for cs in candidates.values() for c in cs]  # type: List[DispatchCandidate]
+        batch = DispatchBatch.from_objects(drivers, requests, rows, self.grid_index)
+        return {rows[i].request_id: rows[i] for i in self.dispatch_batch(batch).tolist()}
+
+    def dispatch_batch(self, batch: DispatchBatch) -> np.ndarray:
+        """ Candidate rows of the batch to assign, in the order they were matched """
+        self.flush()
+        assigned, update = self._match(batch)
+        count_dispatch(len(batch), assigned.size, len(batch.driver_ids) - assigned.size)
+        if self.learning == 'sync':
+            self._learn(update)
+        elif self.learning == 'deferred':
+            self._pending = update
+        else:
+            self._pending = self._worker.submit(self._learn, update)
+        return assigned
+
+    def flush(self) -> None:
+        """ Apply pending TD updates; re-raises an exception from the background worker """
+        pending, self._pending = self._pending, None
+        if isinstance(pending, Future):
+            pending.result()
+        elif pending is not None:
+            self._learn(pending)
+
+    def close(self) -> None:
+        self.flush()
+        if self._worker is not None:
+            self._worker.shutdown()
+
+    def replay(self, batch: DispatchBatch, assigned: np.ndarray, flipped: bool = False) -> None:
+        """ Learn from a logged step as dispatch_batch did, given the rows it assigned and whether it flipped
+        the Dql roles """
+        self.flush()
+        self._learn(PendingUpdate(batch, assigned, self._score(batch)[0]))
 
     @abstractmethod
-    def get_grid_ids(self) -> Set[str]:
+    def _match(self, batch: DispatchBatch) -> Tuple[np.ndarray, PendingUpdate]:
+        """ Assigned rows and the updates to learn from them, leaving the values unchanged """
         ...
 
     @abstractmethod
-    def state_value(self, grid_id: str) -> float:
+    def _score(self, batch: DispatchBatch) -> Tuple[np.ndarray, np.ndarray]:
+        """ TD error the step learns from and expected reward of each candidate row """
         ...
 
     @abstractmethod
-    def update_state_value(self, grid_id: str, delta: float) -> None:
+    def _learn(self, pending: PendingUpdate) -> None:
         ...
 
+    @property
+    def kind(self) -> str:
+        """ Learning rule of the dispatcher; a checkpoint only restores into a dispatcher of the same kind """
+        return type(self).__name__
+
+    def checkpoint_state(self) -> Dict[str, Any]:
+        """ Learned state besides the value table, as json-compatible values """
+        return dict()
 
-class ScoredCandidate:
-    def __init__(self, candidate: DispatchCandidate, score: float):
-        self.candidate = candidate
-        self.score = score
+    def restore_state(self, state: Dict[str, Any]) -> None:
+        pass
 
-    def __repr__(self):
-        return f'{self.candidate}|{self.score}'
+    def top_values(self, k: int) -> TopValues:
+        """ Index of the grids with the k highest state values, up to date with every update so far """
+        self.flush()
+        index = self._top_values
+        if index is None or index.k != k or index.table is not self.state_values:
+            index = self._top_values = TopValues(self.state_values, self.state_value, k)
+        if index.refresh():
+            METRICS.count('dispatch.top_values_rebuilds')
+        return index
+
+    def get_grid_ids(self) -> Set[str]:
+        return self.state_values.grid_ids()
+
+    def get_grid_indices(self) -> np.ndarray:
+        """ Interned indices of every grid with a state value, ascending """
+        return self.state_values.grid_indices()
+
+    def grid_index(self, grid_id: str) -> int:
+        return self.state_values.intern(grid_id)
+
+    def grid_id(self, grid_index: int) -> str:
+        return self.state_values.ids[grid_index]
+
+    @abstractmethod
+    def state_value(self, grid: GridKey) -> Union[float, np.ndarray]:
+        ...
+
+    @abstractmethod
+    def update_state_value(self, grid: GridKey, delta: Union[float, np.ndarray]) -> None:
+        ...
 
 
 class Sarsa(Dispatcher):
-    def __init__(self, alpha, gamma, idle_reward):
-        super().__init__(alpha, gamma, idle_reward)
+    def __init__(self, alpha, gamma, idle_reward, assigner: Assigner = None, learning: str = 'sync',
+                 initial_values: ValueTable = None):
+        super().__init__(alpha, gamma, idle_reward, assigner, learning)
         # Expected gain from each driver in (location)
-        self.state_values = Dispatcher._init_state_values()
+        self.state_values = initial_values if initial_values is not None else Dispatcher._init_state_values()
 
-    def dispatch(self, drivers: Dict[str, Driver], requests: Dict[str, Request],
-                 candidates: Dict[str, Set[DispatchCandidate]]) -> Dict[str, DispatchCandidate]:
+    def _match(self, batch: DispatchBatch) -> Tuple[np.ndarray, PendingUpdate]:
         # Rank candidates based on incremental driver value improvement
-        ranking = []  # type: List[ScoredCandidate]
-        for candidate in set(c for cs in candidates.values() for c in cs):  # type: DispatchCandidate
-            request = requests[candidate.request_id]
-            driver = drivers[candidate.driver_id]
-
-            v0 = self.state_value(driver.location)  # Value of the driver current position
-            v1 = self.state_value(request.end_loc)  # Value of the proposed new position
-            expected_reward = completion_rate(candidate.distance) * request.reward
-            if expected_reward > 0:
-                # Best incremental improvement (get the ride AND improve driver position)
-                update = expected_reward + self.gamma * v1 - v0
-                ranking.append(ScoredCandidate(candidate, update))
+        with METRICS.timer('dispatch.score'):
+            scores, expected_reward = self._score(batch)
+            ranked = np.flatnonzero(expected_reward > 0)
 
         # Assign drivers
-        assigned_driver_ids = set()  # type: Set[str]
-        dispatch = dict()  # type: Dict[str, DispatchCandidate]
-        for scored in sorted(ranking, key=lambda x: x.score, reverse=True):  # type: ScoredCandidate
-            candidate = scored.candidate
-            if candidate.request_id in dispatch or candidate.driver_id in assigned_driver_ids:
-                continue
-            assigned_driver_ids.add(candidate.driver_id)
-            request = requests[candidate.request_id]
-            dispatch[request.request_id] = candidate
-
-            # Update value at driver location
-            driver = drivers[candidate.driver_id]
-            self.update_state_value(driver.location, self.alpha * scored.score)
+        with METRICS.timer('dispatch.assign'):
+            assigned = ranked[self.assigner.assign(batch.request_idx[ranked], batch.driver_idx[ranked],
+                                                   scores[ranked])]
+        return assigned, PendingUpdate(batch, assigned, scores)
+
+    def _score(self, batch: DispatchBatch) -> Tuple[np.ndarray, np.ndarray]:
+        locations = batch.driver_grid[batch.driver_idx]
+        v0 = self.state_value(locations)  # Value of the driver current position
+        v1 = self.state_value(batch.end_grid[batch.request_idx])  # Value of the proposed new position
+        expected_reward = completion_rate(batch.distance) * batch.reward[batch.request_idx]
+        # Best incremental improvement (get the ride AND improve driver position)
+        return expected_reward + self.gamma * v1 - v0, expected_reward
+
+    def _learn(self, pending: PendingUpdate) -> None:
+        batch, assigned = pending.batch, pending.assigned
+
+        # Update value at driver location
+        with METRICS.timer('dispatch.update'):
+            locations = batch.driver_grid[batch.driver_idx[assigned]]
+            self.update_state_value(locations, self.alpha * pending.scores[assigned])
 
         # Reward (negative) for idle driver positions
-        for driver in drivers.values():
-            if driver.driver_id in assigned_driver_ids:
-                continue
-            v0 = self.state_value(driver.location)
-            # TODO: idle transition probabilities Expected SARSA
-            v1 = self.state_value(driver.location)  # Assume driver hasn't moved if idle
-            update = self.idle_reward + self.gamma * v1 - v0
-            self.update_state_value(driver.location, self.alpha * update)
-
-        return dispatch
+        with METRICS.timer('dispatch.idle_update'):
+            idle = batch.driver_grid[idle_drivers(batch, assigned)]
+            for rounds in sequential_rounds(idle):
+                v0 = self.state_value(idle[rounds])
+                # TODO: idle transition probabilities Expected SARSA
+                v1 = self.state_value(idle[rounds])  # Assume driver hasn't moved if idle
+                update = self.idle_reward + self.gamma * v1 - v0
+                self.update_state_value(idle[rounds], self.alpha * update)
 
-    def get_grid_ids(self) -> Set[str]:
-        return set(self.state_values.keys())
+    def state_value(self, grid: GridKey) -> Union[float, np.ndarray]:
+        return self.state_values.get(grid)
 
-    def state_value(self, grid_id: str) -> float:
-        return self.state_values[grid_id]
-
-    def update_state_value(self, grid_id: str, delta: float) -> None:
-        self.state_values[grid_id] += delta
+    def update_state_value(self, grid: GridKey, delta: Union[float, np.ndarray]) -> None:
+        self.state_values.add(grid, delta)
 
 
 class Dql(Dispatcher):
-    def __init__(self, alpha, gamma, idle_reward):
-        super().__init__(alpha, gamma, idle_reward)
-        self.student = Dispatcher._init_state_values()
-        self.teacher = Dispatcher._init_state_values()
+    """ Double Q-learning: student and teacher tables swap on a coin flip each step
+
+    The flip happens after flush(), so pending updates always apply with the roles they were scored with.
+    """
+    def __init__(self, alpha, gamma, idle_reward, assigner: Assigner = None, learning: str = 'sync',
+                 initial_values: ValueTable = None):
+        super().__init__(alpha, gamma, idle_reward, assigner, learning)
+        # Student and teacher are rows of one table, swapped by row index
+        if initial_values is not None:
+            assert initial_values.values.shape[0] == 2, initial_values.values.shape
+        self.state_values = initial_values if initial_values is not None else Dispatcher._init_state_values(rows=2)
+        self.student, self.teacher = 0, 1
         self.timestamp = 0
 
-    def dispatch(self, drivers: Dict[str, Driver], requests: Dict[str, Request],
-                 candidates: Dict[str, Set[DispatchCandidate]]) -> Dict[str, DispatchCandidate]:
-        #  Flip a coin
-        if random.random() < 0.5:
+    def checkpoint_state(self) -> Dict[str, Any]:
+        return dict(student=self.student, teacher=self.teacher, timestamp=self.timestamp)
+
+    def restore_state(self, state: Dict[str, Any]) -> None:
+        self.student, self.teacher, self.timestamp = state['student'], state['teacher'], state['timestamp']
+
+    def replay(self, batch: DispatchBatch, assigned: np.ndarray, flipped: bool = False) -> None:
+        self.flush()
+        self._flip(flipped)
+        super().replay(batch, assigned)
+
+    def _flip(self, flipped: bool) -> None:
+        self.flipped = flipped
+        if flipped:
             self.student, self.teacher = self.teacher, self.student
 
-        # Rank candidates
-        updates = dict()  # type: Dict[Tuple[str, str], ScoredCandidate]
-        ranking = []  # type: List[ScoredCandidate]
-        for candidate in set(c for cs in candidates.values() for c in cs):  # type: DispatchCandidate
-            # Teacher provides the destination position value
-            request = requests[candidate.request_id]
-            v1 = self.teacher[request.end_loc]
-            self.timestamp = max(request.request_ts, self.timestamp)
-
-            # Compute student update
-            driver = drivers[candidate.driver_id]
-            v0 = self.student[driver.location]
-            expected_reward = completion_rate(candidate.distance) * request.reward
-            update = expected_reward + self.gamma * v1 - v0
-            updates[(candidate.request_id, candidate.driver_id)] = ScoredCandidate(candidate, update)
+    def _match(self, batch: DispatchBatch) -> Tuple[np.ndarray, PendingUpdate]:
+        #  Flip a coin
+        self._flip(random.random() < 0.5)
 
+        # Rank candidates
+        with METRICS.timer('dispatch.score'):
+            updates, expected_reward = self._score(batch)
             # Joint Ranking for actual driver assignment
-            v1 = self.state_value(request.end_loc)
+            v1 = self.state_value(batch.end_grid[batch.request_idx])
             expected_gain = expected_reward + self.gamma * v1
-            ranking.append(ScoredCandidate(candidate, expected_gain))
 
         # Assign drivers
-        assigned_driver_ids = set()  # type: Set[str]
-        dispatch = dict()  # type: Dict[str, DispatchCandidate]
-        for scored in sorted(ranking, key=lambda x: x.score, reverse=True):  # type: ScoredCandidate
-            candidate = scored.candidate
-            if candidate.request_id in dispatch or candidate.driver_id in assigned_driver_ids:
-                continue
-            assigned_driver_ids.add(candidate.driver_id)
-
-            request = requests[candidate.request_id]
-            driver = drivers[candidate.driver_id]
-            dispatch[request.request_id] = candidate
-
-            # Update student for selected candidate
-            v0 = self.state_value(driver.location)
-            gain = updates[(candidate.request_id, candidate.driver_id)].score
-            self.update_state_value(driver.location, self.alpha * (gain - v0))
+        with METRICS.timer('dispatch.assign'):
+            assigned = self.assigner.assign(batch.request_idx, batch.driver_idx, expected_gain)
+        return assigned, PendingUpdate(batch, assigned, updates)
+
+    def _score(self, batch: DispatchBatch) -> Tuple[np.ndarray, np.ndarray]:
+        locations = batch.driver_grid[batch.driver_idx]
+        destinations = batch.end_grid[batch.request_idx]
+        if len(batch):
+            self.timestamp = max(int(np.max(batch.request_ts)), self.timestamp)
+
+        # Teacher provides the destination position value, student the update baseline
+        v1 = self.state_values.get(destinations, self.teacher)
+        v0 = self.state_values.get(locations, self.student)
+        expected_reward = completion_rate(batch.distance) * batch.reward[batch.request_idx]
+        return expected_reward + self.gamma * v1 - v0, expected_reward
+
+    def _learn(self, pending: PendingUpdate) -> None:
+        batch, assigned = pending.batch, pending.assigned
+        locations = batch.driver_grid[batch.driver_idx]
+
+        # Update student for selected candidate (repeated candidate rows take the last row's update)
+        with METRICS.timer('dispatch.update'):
+            gains = pending.scores[batch.last_pair_rows()[assigned]]
+            for rounds in sequential_rounds(locations[assigned]):
+                v0 = self.state_value(locations[assigned[rounds]])
+                self.update_state_value(locations[assigned[rounds]], self.alpha * (gains[rounds] - v0))
 
         # Reward (negative) for idle driver positions
-        for driver in drivers.values():
-            if driver.driver_id in assigned_driver_ids:
-                continue
-            v0 = self.student[driver.location]
-            # Expected Sarsa
-            v1 = 0
-            for destination, probability in HEX_GRID.idle_transitions(self.timestamp, driver.location).items():
-                v1 += probability * self.teacher[destination]
-            update = self.idle_reward + self.gamma * v1 - v0
-            self.update_state_value(driver.location, self.alpha * update)
+        with METRICS.timer('dispatch.idle_update'):
+            idle = batch.driver_grid[idle_drivers(batch, assigned)]
+            expected = self._expected_idle_values(idle)
+            for rounds in sequential_rounds(idle):
+                v0 = self.state_values.get(idle[rounds], self.student)
+                # Expected Sarsa
+                v1 = expected[rounds]
+                update = self.idle_reward + self.gamma * v1 - v0
+                self.update_state_value(idle[rounds], self.alpha * update)
 
         # Update value (positive) for open requests
-        for request in requests.values():
-            if request.request_id in dispatch:
-                continue
-            v0 = self.student[request.start_loc]
-            v1 = self.teacher[request.end_loc]
+        with METRICS.timer('dispatch.open_update'):
+            open_requests = np.ones(len(batch.request_ids), dtype=bool)
+            open_requests[batch.request_idx[assigned]] = False
+            v0 = self.state_values.get(batch.start_grid[open_requests], self.student)
+            v1 = self.state_values.get(batch.end_grid[open_requests], self.teacher)
             # TODO: open request ablation study
-            update = 0 * (request.reward + self.gamma * v1 - v0)
-            self.update_state_value(request.start_loc, self.alpha * update)
-
-        return dispatch
-
-    def get_grid_ids(self) -> Set[str]:
-        return set(self.student.keys()).union(set(self.teacher.keys()))
-
-    def state_value(self, grid_id: str) -> float:
-        return self.student[grid_id] + self.teacher[grid_id]
-
-    def update_state_value(self, grid_id: str, delta: float) -> None:
-        self.student[grid_id] += delta
-
-
-def completion_rate(distance_meters: float) -> float:
-    return 1 - max(min(CANCEL_DISTANCE_FIT(distance_meters), 1), 0)
\ No newline at end of file
+            update = 0 * (batch.reward[open_requests] + self.gamma * v1 - v0)
+            self.update_state_value(batch.start_grid[open_requests], self.alpha * update)
+
+    def _expected_idle_values(self, locations: np.ndarray) -> np.ndarray:
+        """ Teacher value after one idle transition from each location, as one sparse mat-vec """
+        if locations.size == 0:
+            return np.empty(0)
+        transitions = HEX_GRID.idle_transition_matrix(self.timestamp)
+        n = transitions.shape[0]
+        teacher = self.state_values.row(self.teacher)
+        expected = teacher[locations]  # Grids outside the transition table stay put
+        unique, inverse = np.unique(locations[locations < n], return_inverse=True)
+        rows = transitions[unique]
+        self.state_values.resolve(rows.indices)
+        expected[locations < n] = (rows @ teacher[:n])[inverse.reshape(-1)]
+        return expected
+
+    def state_value(self, grid: GridKey) -> Union[float, np.ndarray]:
+        grid = self.state_values.resolve(grid)
+        return self.state_values.values[self.student, grid] + self.state_values.values[self.teacher, grid]
+
+    def update_state_value(self, grid: GridKey, delta: Union[float, np.ndarray]) -> None:
+        self.state_values.add(grid, delta, self.student)
+
+
+def idle_drivers(batch: DispatchBatch, assigned: np.ndarray) -> np.ndarray:
+    """ Mask of the batch drivers left without an assignment """
+    idle = np.ones(len(batch.driver_ids), dtype=bool)
+    idle[batch.driver_idx[assigned]] = False
+    return idle
+
+
+def count_dispatch(candidates: int, assigned: int, idle: int) -> None:
+    METRICS.count('dispatch.candidates', candidates)
+    METRICS.count('dispatch.assigned', assigned)
+    METRICS.count('dispatch.idle_updates', idle)
+    METRICS.observe('dispatch.batch_rows', candidates)
+
+
+def completion_rate(distance_meters: Union[float, np.ndarray]) -> Union[float, np.ndarray]:
+    return 1 - np.clip(CANCEL_DISTANCE_FIT(distance_meters), 0, 1)
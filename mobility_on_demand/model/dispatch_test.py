@@ -1,7 +1,11 @@
 import json
 import os
+import random
 import unittest
 
+import numpy as np
+
+import assign
 import dispatch
 import parse
 
@@ -36,6 +40,60 @@ class DispatchTest(unittest.TestCase):
             d = dispatcher.dispatch(drivers, requests, candidates)
             assert d
 
+    def test_batch_matches_objects(self):
+        batch = parse.parse_batch(self.dispatch_observ)
+        drivers, requests, candidates = batch.to_objects()
+        assert len(batch) == sum(len(cs) for cs in candidates.values()) == len(self.dispatch_observ)
+        assert set(drivers) == set(batch.driver_ids) and set(requests) == set(batch.request_ids)
+
+        for cls in [dispatch.Sarsa, dispatch.Dql]:
+            by_batch = cls(self.alpha, self.gamma, self.idle_reward)
+            by_objects = cls(self.alpha, self.gamma, self.idle_reward)
+            for step in range(3):
+                random.seed(step)
+                assigned = by_batch.dispatch_batch(batch)
+                expected = {batch.request_ids[r]: batch.driver_ids[d]
+                            for r, d in zip(batch.request_idx[assigned], batch.driver_idx[assigned])}
+                random.seed(step)
+                d = by_objects.dispatch(drivers, requests, candidates)
+                assert {r: c.driver_id for r, c in d.items()} == expected
+            grids = by_batch.get_grid_indices()
+            np.testing.assert_allclose(by_batch.state_value(grids), by_objects.state_value(grids), atol=1e-12)
+
+    def test_deferred_learning(self):
+        rng = np.random.RandomState(0)
+        batches = []
+        for _ in range(6):
+            observ = [dict(od, order_driver_distance=od['order_driver_distance'] * rng.uniform(0.5, 1.5))
+                      for od in self.dispatch_observ]
+            batches.append(parse.parse_batch(observ))
+
+        for cls in [dispatch.Sarsa, dispatch.Dql]:
+            runs = dict()
+            for learning in dispatch.LEARNING_MODES:
+                dispatcher = cls(self.alpha, self.gamma, self.idle_reward, learning=learning)
+                assignments = []
+                for step, batch in enumerate(batches):
+                    random.seed(step)
+                    assignments.append(dispatcher.dispatch_batch(batch).tolist())
+                if learning == 'deferred':
+                    # The last step is still pending until the barrier
+                    assert dispatcher._pending is not None
+                dispatcher.close()
+                runs[learning] = assignments, dispatcher.state_values.values.copy()
+            for learning in ['deferred', 'background']:
+                assert runs[learning][0] == runs['sync'][0]
+                np.testing.assert_array_equal(runs[learning][1], runs['sync'][1])
+
+    def test_hungarian(self):
+        drivers, requests, candidates = parse.parse_dispatch(self.dispatch_observ)
+        for cls in [dispatch.Sarsa, dispatch.Dql]:
+            dispatcher = cls(self.alpha, self.gamma, self.idle_reward, assign.Hungarian())
+            d = dispatcher.dispatch(drivers, requests, candidates)
+            assert d
+            assert len(set(c.driver_id for c in d.values())) == len(d)
+            assert dispatcher.assigner.report.gap >= 0, dispatcher.assigner.report
+
     @staticmethod
     def test_cancel_rate():
         rate = dispatch.completion_rate(0)
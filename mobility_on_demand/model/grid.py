@@ -1,23 +1,87 @@
 import csv
 import collections
+import json
 import math
 import os
+import sys
+import threading
 import time
-from typing import Dict, List, Tuple
+from typing import Dict, List, Sequence, Tuple
 
-from scipy.spatial import KDTree
+import numpy as np
+from scipy.sparse import csr_matrix, identity
+from scipy.spatial import cKDTree
 
 
+DATA_DIR = os.path.dirname(os.path.abspath(__file__))
+CACHE_DIR = os.path.join(DATA_DIR, 'grid_cache')
+CACHE_VERSION = 1
+GRID_CSV = 'hexagon_grid_table.csv'
+TRANSITIONS_CSV = 'idle_transition_probability.csv'
 LNG_FACTOR = 0.685  # Assume latitude ~30.6
+METERS_PER_DEGREE = 111320
+EARTH_RADIUS = 6371000
+UNKNOWN_DISTANCE = 1e12  # Distance to or from a grid outside the hex table
+DISTANCE_BLOCK = 1 << 20  # Cells computed at once by distance_matrix
+NEIGHBOR_FACTOR = 1.25  # Centroids closer than this many grid spacings share an edge
+LOOKUP_CACHE_SIZE = 1 << 16
+LOOKUP_PRECISION = 6  # Decimal places of (lng, lat) lookup cache keys, ~0.1 meters
 
 
-class Grid:
-    def __init__(self):
-        self.grids = collections.OrderedDict()  # type: Dict[str, Tuple[float, float]]
-        self.transitions = dict()  # type: Dict[int, Dict[start_grid_id, Dict[str, float]]
+class LookupCache:
+    """ Bounded LRU cache from rounded (lng, lat) to grid index; hold lock to use it from several threads """
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.entries = collections.OrderedDict()  # type: Dict[Tuple[float, float], int]
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Tuple[float, float]) -> int:
+        """ Cached grid index for key, or -1 """
+        i = self.entries.get(key, -1)
+        if i < 0:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.entries.move_to_end(key)
+        return i
+
+    def put(self, key: Tuple[float, float], i: int) -> None:
+        self.entries[key] = i
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def info(self) -> Dict[str, int]:
+        return dict(hits=self.hits, misses=self.misses, size=len(self.entries), maxsize=self.maxsize)
+
+    def clear(self) -> None:
+        self.entries.clear()
+        self.hits = self.misses = 0
+
+
+class GridData:
+    """ Array form of the grid tables, as parsed from csv or memory-mapped from the compiled cache
 
-        grid_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'hexagon_grid_table.csv')
-        with open(grid_path, 'r') as csvfile:
+    ids holds the hex grid ids followed by any ids that only appear in the transition table. Transitions are
+    parallel arrays sorted by (hour, start), keeping csv order within each (hour, start) block.
+    """
+    def __init__(self, ids: List[str], n_grids: int, centroids: np.ndarray, hours: np.ndarray,
+                 starts: np.ndarray, ends: np.ndarray, probabilities: np.ndarray):
+        self.ids = ids
+        self.n_grids = n_grids
+        self.centroids = centroids
+        self.hours = hours
+        self.starts = starts
+        self.ends = ends
+        self.probabilities = probabilities
+
+    @staticmethod
+    def from_csv(data_dir: str = DATA_DIR) -> 'GridData':
+        index = collections.OrderedDict()  # type: Dict[str, int]
+        centroids = []  # type: List[Tuple[float, float]]
+        with open(os.path.join(data_dir, GRID_CSV), 'r') as csvfile:
             for row in csv.reader(csvfile):
                 if len(row) != 13:
                     continue
@@ -26,38 +90,295 @@ class Grid:
                 # Use centroid for simplicity
                 lng = sum([float(row[i]) for i in range(1, 13, 2)]) / 6
                 lat = sum([float(row[i]) for i in range(2, 13, 2)]) / 6
-                self.grids[grid_id] = (lng, lat)
-
-        assert len(self.grids) == 8518
-        self.grid_ids = list(self.grids.keys())  # type: List[str]
-        self.kdtree = KDTree(list(self.grids.values()))
+                if grid_id in index:
+                    centroids[index[grid_id]] = (lng, lat)
+                else:
+                    index[grid_id] = len(centroids)
+                    centroids.append((lng, lat))
+        n_grids = len(index)
 
-        transitions_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'idle_transition_probability.csv')
-        with open(transitions_path, 'r') as csvfile:
+        seen = set()  # First probability wins for a repeated (hour, start, end)
+        rows = []  # type: List[Tuple[int, int, int, float]]
+        with open(os.path.join(data_dir, TRANSITIONS_CSV), 'r') as csvfile:
             for row in csv.reader(csvfile):
                 # TODO: verify hour in GMT
                 hour, start_grid_id, end_grid_id, probability = row
-                hour = int(hour)
-                if hour not in self.transitions:
-                    self.transitions[hour] = dict()
+                key = (int(hour), index.setdefault(start_grid_id, len(index)), index.setdefault(end_grid_id, len(index)))
+                if key not in seen:
+                    seen.add(key)
+                    rows.append(key + (float(probability),))
+
+        assert len(set(row[0] for row in rows)) == 24
+        transitions = np.array(rows, dtype=float).reshape(-1, 4)
+        order = np.lexsort((transitions[:, 1], transitions[:, 0]))  # stable within (hour, start)
+        transitions = transitions[order]
+        return GridData(list(index), n_grids, np.array(centroids, dtype=float).reshape(-1, 2),
+                        transitions[:, 0].astype(np.int8), transitions[:, 1].astype(np.int32),
+                        transitions[:, 2].astype(np.int32), transitions[:, 3])
+
+    @staticmethod
+    def from_cache(cache_dir: str = CACHE_DIR, data_dir: str = DATA_DIR) -> 'GridData':
+        """ Memory-mapped arrays from the compiled cache, or None if it is missing or older than the csvs """
+        manifest_path = os.path.join(cache_dir, 'manifest.json')
+        if not os.path.exists(manifest_path):
+            return None
+        with open(manifest_path, 'r') as f:
+            manifest = json.load(f)
+        if manifest.get('version') != CACHE_VERSION or manifest.get('sources') != _sources(data_dir, manifest):
+            return None
+
+        def array(name: str) -> np.ndarray:
+            return np.load(os.path.join(cache_dir, name + '.npy'), mmap_mode='r')
+
+        ids = [grid_id.decode() for grid_id in array('ids').tolist()]
+        return GridData(ids, manifest['n_grids'], array('centroids'), array('hours'), array('starts'),
+                        array('ends'), array('probabilities'))
+
+    def save(self, cache_dir: str = CACHE_DIR, data_dir: str = DATA_DIR) -> None:
+        """ Write the arrays as .npy files; the manifest goes last so readers never see a partial cache """
+        os.makedirs(cache_dir, exist_ok=True)
+        arrays = dict(ids=np.array([grid_id.encode() for grid_id in self.ids]), centroids=self.centroids,
+                      hours=self.hours, starts=self.starts, ends=self.ends, probabilities=self.probabilities)
+        for name, values in arrays.items():
+            tmp_path = os.path.join(cache_dir, name + '.tmp.npy')
+            np.save(tmp_path, np.ascontiguousarray(values))
+            os.replace(tmp_path, os.path.join(cache_dir, name + '.npy'))
+
+        manifest = dict(version=CACHE_VERSION, n_grids=self.n_grids, sources=_sources(data_dir))
+        tmp_path = os.path.join(cache_dir, 'manifest.json.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest, f)
+        os.replace(tmp_path, os.path.join(cache_dir, 'manifest.json'))
+
+
+class Grid:
+    """ Hex grid centroids, nearest grid lookup and idle transitions
+
+    Tables load on first use, from the compiled cache when it is present and current (see compile_cache),
+    otherwise from the csvs. Idle transition dicts are only built for the (hour, start) pairs asked for.
+    """
+    def __init__(self, lookup_cache_size: int = LOOKUP_CACHE_SIZE, cache_dir: str = CACHE_DIR,
+                 data_dir: str = DATA_DIR):
+        self.cache_dir = cache_dir
+        self.data_dir = data_dir
+        self.lookup_cache = LookupCache(lookup_cache_size)
+        self._data = None  # type: GridData
+        self._grids = None  # type: Dict[str, Tuple[float, float]]
+        self._grid_ids = None  # type: List[str]
+        self._kdtree = None  # type: cKDTree
+        self._points = None  # type: np.ndarray
+        self._points_kdtree = None  # type: cKDTree
+        self._rings = dict()  # type: Dict[int, csr_matrix]
+        self._regions = dict()  # type: Dict[int, np.ndarray]
+        self._index = None  # type: Dict[str, int]
+        self._transition_keys = None  # type: np.ndarray
+        self._transition_matrices = dict()  # type: Dict[int, csr_matrix]
+        self._transition_dicts = dict()  # type: Dict[Tuple[int, str], Dict[str, float]]
+
+    @property
+    def data(self) -> GridData:
+        if self._data is None:
+            data = GridData.from_cache(self.cache_dir, self.data_dir) if self.cache_dir else None
+            self._data = data or GridData.from_csv(self.data_dir)
+            assert self._data.n_grids == 8518
+        return self._data
+
+    @property
+    def grid_ids(self) -> List[str]:
+        if self._grid_ids is None:
+            self._grid_ids = self.data.ids[:self.data.n_grids]
+        return self._grid_ids
+
+    @property
+    def grids(self) -> Dict[str, Tuple[float, float]]:
+        if self._grids is None:
+            self._grids = collections.OrderedDict(zip(self.grid_ids, map(tuple, self.data.centroids.tolist())))
+        return self._grids
+
+    @property
+    def kdtree(self) -> cKDTree:
+        if self._kdtree is None:
+            self._kdtree = cKDTree(self.data.centroids)
+        return self._kdtree
+
+    @property
+    def centroids(self) -> np.ndarray:
+        """ [lng, lat] of each hex grid, aligned with grid_ids """
+        return self.data.centroids
+
+    @property
+    def points(self) -> np.ndarray:
+        """ Centroids in meters along each axis, so euclidean distance matches distance(fast=True) """
+        if self._points is None:
+            self._points = METERS_PER_DEGREE * self.data.centroids * np.array([LNG_FACTOR, 1.])
+        return self._points
+
+    @property
+    def ids(self) -> List[str]:
+        """ grid_ids followed by the ids that only appear in the transition table """
+        return self.data.ids
+
+    @property
+    def index(self) -> Dict[str, int]:
+        """ Position of each grid id in GridData.ids, including ids only seen in the transition table """
+        if self._index is None:
+            self._index = {grid_id: i for i, grid_id in enumerate(self.data.ids)}
+        return self._index
 
-                hour_dict = self.transitions[hour]
-                if start_grid_id not in hour_dict:
-                    hour_dict[start_grid_id] = dict()
+    @property
+    def transitions(self) -> Dict[int, Dict[str, Dict[str, float]]]:
+        """ Every idle transition as {hour: {start: {end: probability}}} """
+        transitions = dict()  # type: Dict[int, Dict[str, Dict[str, float]]]
+        for hour, start in zip(self.data.hours.tolist(), self.data.starts.tolist()):
+            start_grid_id = self.data.ids[start]
+            if start_grid_id not in transitions.setdefault(hour, dict()):
+                transitions[hour][start_grid_id] = self._transition_dict(hour, start_grid_id)
+        return transitions
 
-                start_dict = hour_dict[start_grid_id]
-                if end_grid_id not in start_dict:
-                    start_dict[end_grid_id] = float(probability)
-        assert len(self.transitions) == 24
+    def _transition_dict(self, hour: int, start_grid_id: str) -> Dict[str, float]:
+        """ Transitions out of start_grid_id at hour, or None without data """
+        key = (hour, start_grid_id)
+        if key not in self._transition_dicts:
+            start = self.index.get(start_grid_id)
+            if self._transition_keys is None:
+                self._transition_keys = self.data.hours.astype(np.int64) * len(self.data.ids) + self.data.starts
+            lo = hi = 0
+            if start is not None:
+                block = hour * len(self.data.ids) + start
+                lo, hi = np.searchsorted(self._transition_keys, [block, block + 1]).tolist()
+            ids = self.data.ids
+            self._transition_dicts[key] = {
+                ids[end]: probability for end, probability in
+                zip(self.data.ends[lo:hi].tolist(), self.data.probabilities[lo:hi].tolist())} or None
+        return self._transition_dicts[key]
 
     def lookup(self, lng: float, lat: float) -> str:
-        _, i = self.kdtree.query([lng, lat])
+        key = (round(lng, LOOKUP_PRECISION), round(lat, LOOKUP_PRECISION))
+        with self.lookup_cache.lock:
+            i = self.lookup_cache.get(key)
+        if i < 0:
+            _, i = self.kdtree.query([lng, lat])
+            with self.lookup_cache.lock:
+                self.lookup_cache.put(key, int(i))
         return self.grid_ids[i]
 
+    def lookup_indices(self, coords: Sequence[Sequence[float]]) -> np.ndarray:
+        """ Grid index of each [lng, lat], resolving all cache misses in one KDTree query """
+        coords = np.asarray(coords, dtype=float).reshape(-1, 2)
+        if coords.size == 0:
+            return np.empty(0, dtype=int)
+        keys, inverse = np.unique(np.round(coords, LOOKUP_PRECISION), axis=0, return_inverse=True)
+        inverse = inverse.reshape(-1)
+        first = np.zeros(len(keys), dtype=int)
+        first[inverse[::-1]] = np.arange(len(coords))[::-1]
+
+        keys = [tuple(key) for key in keys.tolist()]
+        with self.lookup_cache.lock:
+            indices = np.array([self.lookup_cache.get(key) for key in keys], dtype=int)
+        missing = np.flatnonzero(indices < 0)
+        if missing.size:
+            _, indices[missing] = self.kdtree.query(coords[first[missing]])
+            with self.lookup_cache.lock:
+                for j in missing:
+                    self.lookup_cache.put(keys[j], int(indices[j]))
+        return indices[inverse]
+
+    def lookup_many(self, coords: Sequence[Sequence[float]]) -> List[str]:
+        return [self.grid_ids[i] for i in self.lookup_indices(coords)]
+
+    def grid_indices(self, grid_ids: Sequence[str]) -> np.ndarray:
+        """ Position of each id in grid_ids, or -1 for ids outside the hex table """
+        n, index = self.data.n_grids, self.index
+        return np.array([i if i < n else -1 for i in (index.get(grid_id, -1) for grid_id in grid_ids)], dtype=int)
+
+    def distances(self, x: np.ndarray, y: np.ndarray, fast=True) -> np.ndarray:
+        """ Elementwise distance in meters between grid indices x and y, broadcast against each other
+
+        Matches distance() within float rounding, including UNKNOWN_DISTANCE when either index is outside
+        the hex table (negative, or an id only seen in the transition table). A scalar x gives one-to-many.
+        """
+        x, y = np.broadcast_arrays(np.asarray(x, dtype=int), np.asarray(y, dtype=int))
+        n = self.data.n_grids
+        known = (x >= 0) & (x < n) & (y >= 0) & (y < n)
+        a, b = self.data.centroids[np.where(known, x, 0)], self.data.centroids[np.where(known, y, 0)]
+        distances = _fast_distance(a, b) if fast else _haversine_distance(a, b)
+        distances[~known] = UNKNOWN_DISTANCE
+        return distances
+
+    def distance_matrix(self, x: np.ndarray, y: np.ndarray, fast=True, block: int = DISTANCE_BLOCK) -> np.ndarray:
+        """ len(x) by len(y) distances, computed a block of rows at a time to bound temporaries """
+        x, y = np.asarray(x, dtype=int).reshape(-1), np.asarray(y, dtype=int).reshape(-1)
+        matrix = np.empty((x.size, y.size))
+        rows = max(block // max(y.size, 1), 1)
+        for start in range(0, x.size, rows):
+            matrix[start:start + rows] = self.distances(x[start:start + rows, None], y[None, :], fast)
+        return matrix
+
+    def within(self, grid_index: int, radius: float) -> np.ndarray:
+        """ Indices of the hex grids whose centroid is within radius meters (fast metric), ascending """
+        if not 0 <= grid_index < self.data.n_grids:
+            return np.empty(0, dtype=int)
+        if self._points_kdtree is None:
+            self._points_kdtree = cKDTree(self.points)
+        return np.sort(np.asarray(self._points_kdtree.query_ball_point(self.points[grid_index], radius), dtype=int))
+
+    def ring_index(self, k: int) -> csr_matrix:
+        """ Hex grids within k neighbor hops of each grid (itself included), as a boolean CSR matrix
+
+        Neighbors are centroids closer than NEIGHBOR_FACTOR times the typical spacing between neighboring
+        centroids. Each k is built once, by expanding k - 1 rings by one hop.
+        """
+        if k not in self._rings:
+            if k == 0:
+                self._rings[k] = csr_matrix(identity(self.data.n_grids, dtype=bool, format='csr'))
+            elif k == 1:
+                points = self.points
+                spacing = np.median(cKDTree(points).query(points, k=2)[0][:, 1])
+                pairs = cKDTree(points).query_pairs(NEIGHBOR_FACTOR * spacing, output_type='ndarray')
+                n = self.data.n_grids
+                rows = np.concatenate([pairs[:, 0], pairs[:, 1], np.arange(n)])
+                cols = np.concatenate([pairs[:, 1], pairs[:, 0], np.arange(n)])
+                self._rings[k] = csr_matrix((np.ones(rows.size, dtype=bool), (rows, cols)), shape=(n, n))
+            else:
+                self._rings[k] = csr_matrix(self.ring_index(k - 1) @ self.ring_index(1), dtype=bool)
+            self._rings[k].sort_indices()
+        return self._rings[k]
+
+    def ring(self, grid_index: int, k: int) -> np.ndarray:
+        """ Indices of the hex grids within k hops of grid_index, ascending """
+        if not 0 <= grid_index < self.data.n_grids:
+            return np.empty(0, dtype=int)
+        rings = self.ring_index(k)
+        return rings.indices[rings.indptr[grid_index]:rings.indptr[grid_index + 1]].astype(int)
+
+    def regions(self, n: int) -> np.ndarray:
+        """ Region label in [0, n) of each hex grid, aligned with grid_ids
+
+        Regions are compact and hold the same number of grids (to within one): the grids are split in two
+        across the longer side of their bounding box, recursively, with the cut placed in proportion to the
+        number of regions on each side.
+        """
+        if n not in self._regions:
+            labels = np.zeros(self.data.n_grids, dtype=int)
+            parts = [(np.arange(self.data.n_grids), 0, n)]
+            while parts:
+                idx, first, count = parts.pop()
+                if count == 1:
+                    labels[idx] = first
+                    continue
+                points = self.points[idx]
+                axis = int(np.argmax(points.max(axis=0) - points.min(axis=0))) if idx.size else 0
+                idx = idx[np.argsort(points[:, axis], kind='stable')]
+                left = count // 2
+                cut = idx.size * left // count
+                parts += [(idx[:cut], first, left), (idx[cut:], first + left, count - left)]
+            self._regions[n] = labels
+        return self._regions[n]
+
     def distance(self, x: str, y: str, fast=True) -> float:
         """ Return haversine distance in meters """
         if x not in self.grids or y not in self.grids:
-            return 1e12
+            return UNKNOWN_DISTANCE
 
         lng_x, lat_x = self.grids[x]
         lng_y, lat_y = self.grids[y]
@@ -66,7 +387,7 @@ class Grid:
         if fast:
             lat_delta = abs(lat_x - lat_y)
             lng_delta = LNG_FACTOR * abs(lng_x - lng_y)
-            return 111320 * math.pow(math.pow(lat_delta, 2) + math.pow(lng_delta, 2), 0.5)
+            return METERS_PER_DEGREE * math.pow(math.pow(lat_delta, 2) + math.pow(lng_delta, 2), 0.5)
 
         # Haversine
         lng_x, lng_y, lat_x, lat_y = map(math.radians, [lng_x, lng_y, lat_x, lat_y])
@@ -76,6 +397,66 @@ class Grid:
 
     def idle_transitions(self, timestamp: int, start_grid_id: str) -> Dict[str, float]:
         hour = time.gmtime(timestamp).tm_hour
-        if hour in self.transitions and start_grid_id in self.transitions[hour]:
-            return self.transitions[hour][start_grid_id]
-        return {start_grid_id: 1.}
\ No newline at end of file
+        return self._transition_dict(hour, start_grid_id) or {start_grid_id: 1.}
+
+    def idle_transition_matrix(self, timestamp: int) -> csr_matrix:
+        return self.transition_matrix(time.gmtime(timestamp).tm_hour)
+
+    def transition_matrix(self, hour: int) -> csr_matrix:
+        """ Idle transitions at hour as a square CSR matrix over ids, rows summing to 1
+
+        Starts without data keep the {start: 1.} self-loop of idle_transitions. Entries within a row keep csv
+        order, so a row dot product adds terms in the same order as summing over idle_transitions.
+        """
+        if hour not in self._transition_matrices:
+            data, n = self.data, len(self.data.ids)
+            lo, hi = np.searchsorted(data.hours, [hour, hour + 1]).tolist()
+            starts = np.asarray(data.starts[lo:hi], dtype=np.int64)
+            loops = np.flatnonzero(np.bincount(starts, minlength=n) == 0)
+            rows = np.concatenate([starts, loops])
+            order = np.argsort(rows, kind='stable')
+            columns = np.concatenate([data.ends[lo:hi], loops])[order]
+            probabilities = np.concatenate([data.probabilities[lo:hi], np.ones(loops.size)])[order]
+            indptr = np.r_[0, np.cumsum(np.bincount(rows, minlength=n))]
+            self._transition_matrices[hour] = csr_matrix((probabilities, columns, indptr), shape=(n, n))
+        return self._transition_matrices[hour]
+
+
+def _fast_distance(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """ Equirectangular distance between [lng, lat] rows, term by term as in Grid.distance """
+    lat_delta = np.abs(a[..., 1] - b[..., 1])
+    lng_delta = LNG_FACTOR * np.abs(a[..., 0] - b[..., 0])
+    return METERS_PER_DEGREE * np.sqrt(lat_delta * lat_delta + lng_delta * lng_delta)
+
+
+def _haversine_distance(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    lng_x, lat_x = np.radians(a[..., 0]), np.radians(a[..., 1])
+    lng_y, lat_y = np.radians(b[..., 0]), np.radians(b[..., 1])
+    lng_delta, lat_delta = np.abs(lng_x - lng_y), np.abs(lat_x - lat_y)
+    h = np.sin(lat_delta / 2) ** 2 + np.cos(lat_x) * np.cos(lat_y) * np.sin(lng_delta / 2) ** 2
+    return EARTH_RADIUS * 2 * np.arcsin(np.sqrt(h))
+
+
+def _sources(data_dir: str, manifest: Dict = None) -> Dict[str, List[int]]:
+    """ Size and mtime of each csv the cache was compiled from; a missing csv trusts the manifest """
+    sources = dict()  # type: Dict[str, List[int]]
+    for name in [GRID_CSV, TRANSITIONS_CSV]:
+        path = os.path.join(data_dir, name)
+        if os.path.exists(path):
+            stat = os.stat(path)
+            sources[name] = [stat.st_size, int(stat.st_mtime)]
+        elif manifest is not None:
+            sources[name] = manifest.get('sources', dict()).get(name)
+    return sources
+
+
+def compile_cache(cache_dir: str = CACHE_DIR, data_dir: str = DATA_DIR) -> GridData:
+    """ Parse the csvs once and write the binary cache that Grid memory-maps on startup """
+    data = GridData.from_csv(data_dir)
+    data.save(cache_dir, data_dir)
+    return data
+
+
+if __name__ == '__main__':
+    compile_cache(*sys.argv[1:2])
+    print(f'Compiled grid cache to {sys.argv[1] if len(sys.argv) > 1 else CACHE_DIR}')
\ No newline at end of file
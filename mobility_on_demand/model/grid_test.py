@@ -1,5 +1,9 @@
+import tempfile
 import unittest
 
+import numpy as np
+
+import grid
 from grid import Grid
 
 
@@ -16,6 +20,18 @@ class GridTest(unittest.TestCase):
         grid_id = self.grid.lookup(104.52, 30.37)
         assert grid_id == '15948343c6223064', grid_id
 
+    def test_lookup_many(self):
+        coords = [[104.50, 30.71], [103.99, 30.40], [104.52, 30.37], [104.50, 30.71]]
+        expected = [self.grid.grid_ids[self.grid.kdtree.query(coord)[1]] for coord in coords]
+        self.grid.lookup_cache.clear()
+        assert self.grid.lookup_many(coords) == expected
+        assert self.grid.lookup_cache.info()['misses'] == 3, self.grid.lookup_cache.info()
+
+        # Drivers standing still hit the cache on the next step
+        assert self.grid.lookup_many(coords[:2]) == expected[:2]
+        assert self.grid.lookup(104.52, 30.37) == expected[2]
+        assert self.grid.lookup_cache.info()['hits'] == 3, self.grid.lookup_cache.info()
+
     def test_distance_fast(self):
         # SE: (30.65924666666667, 104.12614), NW: (30.73054666666667, 104.04442)
         distance = self.grid.distance('386c78bc3c226d88', '926d27c14e84f5d0')
@@ -54,8 +70,74 @@ class GridTest(unittest.TestCase):
         error = abs(distance - expected)
         assert error < 100, distance
 
+    def test_distances(self):
+        rng = np.random.RandomState(0)
+        grid_ids = self.grid.ids
+        unknown = [grid_id for grid_id in grid_ids[len(self.grid.grid_ids):][:5]] + ['unknown']
+        x = [grid_ids[i] for i in rng.randint(0, len(self.grid.grid_ids), 500)] + unknown
+        y = [grid_ids[i] for i in rng.randint(0, len(self.grid.grid_ids), 500)] + unknown[::-1]
+        x_idx, y_idx = self.grid.grid_indices(x), self.grid.grid_indices(y)
+        assert (x_idx[-len(unknown):] == -1).all()
+        for fast in (True, False):
+            expected = np.array([self.grid.distance(a, b, fast) for a, b in zip(x, y)])
+            np.testing.assert_allclose(self.grid.distances(x_idx, y_idx, fast), expected, rtol=1e-9)
+
+            # One-to-many and blocked many-to-many agree with the elementwise distances
+            expected = np.array([self.grid.distance(x[0], b, fast) for b in y])
+            np.testing.assert_allclose(self.grid.distances(x_idx[0], y_idx, fast), expected, rtol=1e-9)
+            matrix = self.grid.distance_matrix(x_idx[:40], y_idx, fast, block=1000)
+            np.testing.assert_array_equal(matrix, self.grid.distances(x_idx[:40, None], y_idx[None, :], fast))
+
+    def test_rings(self):
+        points = self.grid.points
+        for grid_index in np.random.RandomState(0).randint(0, len(self.grid.grid_ids), 50):
+            assert self.grid.ring(grid_index, 0).tolist() == [grid_index]
+            ring = self.grid.ring(grid_index, 1)
+            assert grid_index in ring and len(ring) <= 7, ring
+            two_rings = self.grid.ring(grid_index, 2)
+            assert set(ring) <= set(two_rings)
+            neighbors = two_rings[two_rings != grid_index]
+            assert neighbors.size and self.grid.distances(grid_index, neighbors).max() < 5000
+
+            # Radius queries are exact, unlike hop counts
+            radius = 3000
+            distances = np.sqrt(np.sum((points - points[grid_index]) ** 2, axis=1))
+            assert self.grid.within(grid_index, radius).tolist() == np.flatnonzero(distances <= radius).tolist()
+        assert self.grid.ring(-1, 1).size == 0 and self.grid.within(len(self.grid.grid_ids), 1000).size == 0
+
+    def test_regions(self):
+        for n in (1, 3, 8):
+            regions = self.grid.regions(n)
+            sizes = np.bincount(regions, minlength=n)
+            assert regions.size == len(self.grid.grid_ids) and sizes.size == n
+            assert sizes.max() - sizes.min() <= 1, sizes
+
     def test_idle_transition(self):
         transitions = self.grid.idle_transitions(148865000, '79365a623250931c')
         assert abs(transitions['d5798236d9cf3f65'] - 0.043478260869565216) < 1e-9, transitions['d5798236d9cf3f65']
         assert abs(transitions['45b05a52ebc86721'] - 0.043478260869565216) < 1e-9, transitions['45b05a52ebc86721']
-        assert abs(sum(transitions.values()) - 1.0) < 1e-9
\ No newline at end of file
+        assert abs(sum(transitions.values()) - 1.0) < 1e-9
+
+    def test_transition_matrix(self):
+        matrix = self.grid.idle_transition_matrix(148865000)
+        assert matrix.shape == (len(self.grid.ids), len(self.grid.ids))
+        np.testing.assert_allclose(np.asarray(matrix.sum(axis=1)).reshape(-1), 1.)
+
+        # Same terms, same summation order as the dict
+        values = np.random.RandomState(0).uniform(-1, 1, len(self.grid.ids))
+        for grid_id in ['79365a623250931c'] + self.grid.grid_ids[:500]:
+            expected = 0
+            for destination, probability in self.grid.idle_transitions(148865000, grid_id).items():
+                expected += probability * values[self.grid.index[destination]]
+            assert (matrix[[self.grid.index[grid_id]]] @ values)[0] == expected, grid_id
+
+    def test_compiled_cache(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            grid.compile_cache(cache_dir)
+            cached = Grid(cache_dir=cache_dir)
+            assert cached.grid_ids == self.grid.grid_ids
+            assert cached.grids == self.grid.grids
+            assert cached.lookup(104.50, 30.71) == self.grid.lookup(104.50, 30.71)
+            transitions = cached.idle_transitions(148865000, '79365a623250931c')
+            assert transitions == self.grid.idle_transitions(148865000, '79365a623250931c')
+            assert list(transitions) == list(self.grid.idle_transitions(148865000, '79365a623250931c'))
@@ -0,0 +1,325 @@
+import atexit
+import collections
+import heapq
+import json
+import math
+import os
+import sys
+import threading
+import time
+from typing import Any, Dict, List, Tuple
+
+
+BUCKETS_PER_OCTAVE = 4  # Histogram bucket bounds grow by 2 ** (1 / 4), ~19% relative error
+SLOWEST_STEPS = 10
+PROFILE_INTERVAL = 0.002
+PROFILE_DEPTH = 24
+
+
+class Histogram:
+    """ Log-bucketed histogram with exact count, sum, min and max """
+    __slots__ = ('buckets', 'count', 'sum', 'min', 'max')
+
+    def __init__(self):
+        self.buckets = collections.Counter()  # type: Dict[int, int]
+        self.count = 0
+        self.sum = 0.
+        self.min = math.inf
+        self.max = -math.inf
+
+    def observe(self, value: float) -> None:
+        self.buckets[math.ceil(math.log2(value) * BUCKETS_PER_OCTAVE) if value > 0 else -sys.maxsize] += 1
+        self.count += 1
+        self.sum += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    @staticmethod
+    def upper_bound(bucket: int) -> float:
+        return 0. if bucket == -sys.maxsize else 2 ** (bucket / BUCKETS_PER_OCTAVE)
+
+    def percentile(self, q: float) -> float:
+        """ Upper bound of the bucket holding the q-th percentile, clamped to the observed range """
+        if self.count == 0:
+            return 0.
+        rank, seen = q / 100 * self.count, 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                return min(max(self.upper_bound(bucket), self.min), self.max)
+        return self.max
+
+    def copy(self) -> 'Histogram':
+        histogram = Histogram()
+        histogram.buckets = self.buckets.copy()
+        histogram.count, histogram.sum, histogram.min, histogram.max = self.count, self.sum, self.min, self.max
+        return histogram
+
+    def to_dict(self) -> Dict[str, float]:
+        if self.count == 0:
+            return dict(count=0)
+        return dict(count=self.count, sum=self.sum, min=self.min, max=self.max, mean=self.sum / self.count,
+                    p50=self.percentile(50), p90=self.percentile(90), p99=self.percentile(99))
+
+
+class Step:
+    """ Phase timings, counters and profiler samples of one dispatch or reposition call """
+    __slots__ = ('name', 'started', 'elapsed', 'phases', 'counters', 'samples', 'thread')
+
+    def __init__(self, name: str):
+        self.name = name
+        self.started = time.time()
+        self.elapsed = 0.
+        self.phases = collections.OrderedDict()  # type: Dict[str, float]
+        self.counters = collections.Counter()  # type: Dict[str, float]
+        self.samples = collections.Counter()  # type: Dict[Tuple[str, ...], int]
+        self.thread = threading.get_ident()
+
+    def to_dict(self) -> Dict[str, Any]:
+        stacks = [dict(samples=n, stack=list(stack)) for stack, n in self.samples.most_common(10)]
+        return dict(name=self.name, started=self.started, elapsed=self.elapsed, phases=dict(self.phases),
+                    counters=dict(self.counters), stacks=stacks)
+
+
+class _Timer:
+    __slots__ = ('metrics', 'name', 'start')
+
+    def __init__(self, metrics: 'Metrics', name: str):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.record(self.name, time.perf_counter() - self.start)
+
+
+class _StepTimer(_Timer):
+    __slots__ = ('previous',)
+
+    def __enter__(self):
+        self.previous = self.metrics.current
+        self.metrics.current = Step(self.name)
+        return super().__enter__()
+
+    def __exit__(self, *exc):
+        step = self.metrics.current
+        step.elapsed = time.perf_counter() - self.start
+        self.metrics.current = self.previous
+        self.metrics.record(self.name, step.elapsed)
+        self.metrics.keep_if_slow(step)
+
+
+class _NullTimer:
+    """ Shared no-op context manager handed out while metrics are disabled """
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+NULL_TIMER = _NullTimer()
+
+
+class Metrics:
+    """ Registry of phase timers, counters and histograms for the agent
+
+    Disabled by default, or enabled at import time with AGENT_METRICS=1 (AGENT_PROFILE=1 also starts the
+    profiler, AGENT_METRICS_DUMP=path writes to_json() there at exit). While disabled, timer() and step()
+    return a shared no-op context manager and count() and observe() return immediately, so instrumented code
+    pays one attribute check per call.
+
+    Timers nest inside steps (one dispatch or reposition call): each timer records into the histogram of its
+    name and into the phases of the current step. The slowest steps of each name are kept with their phases
+    and counters, and with their hottest stacks when the sampling profiler runs.
+
+    Any thread may record: the current step is kept per thread, updates to the shared histograms and counters
+    take a lock, and the exports read a copy taken under it.
+    """
+    def __init__(self, enabled: bool = False, slowest: int = SLOWEST_STEPS):
+        self.enabled = enabled
+        self.slowest = slowest
+        self.histograms = collections.defaultdict(Histogram)  # type: Dict[str, Histogram]
+        self.counters = collections.Counter()  # type: Dict[str, float]
+        self.slow_steps = collections.defaultdict(list)  # type: Dict[str, List[Tuple[float, int, Step]]]
+        self.profiler = None  # type: SamplingProfiler
+        self.lock = threading.Lock()
+        self._local = threading.local()
+        self._running = dict()  # type: Dict[int, Step]  # Current step of each thread, for the profiler
+        self._steps = 0
+
+    @property
+    def current(self) -> Step:
+        """ Step running on the calling thread, if any """
+        return getattr(self._local, 'step', None)
+
+    @current.setter
+    def current(self, step: Step) -> None:
+        self._local.step = step
+        with self.lock:
+            if step is None:
+                self._running.pop(threading.get_ident(), None)
+            else:
+                self._running[threading.get_ident()] = step
+
+    def running_steps(self) -> List[Step]:
+        """ Current step of every thread running one """
+        with self.lock:
+            return list(self._running.values())
+
+    def enable(self) -> None:
+        self.enabled = True
+
+    def disable(self) -> None:
+        self.enabled = False
+        self.stop_profiler()
+
+    def reset(self) -> None:
+        with self.lock:
+            self.histograms.clear()
+            self.counters.clear()
+            self.slow_steps.clear()
+
+    def step(self, name: str):
+        """ Context manager timing one top level call """
+        return _StepTimer(self, name) if self.enabled else NULL_TIMER
+
+    def timer(self, name: str):
+        """ Context manager timing one phase """
+        return _Timer(self, name) if self.enabled else NULL_TIMER
+
+    def record(self, name: str, seconds: float) -> None:
+        with self.lock:
+            self.histograms[name].observe(seconds)
+        step = self.current  # Only ever updated by its own thread
+        if step is not None and step.name != name:
+            step.phases[name] = step.phases.get(name, 0.) + seconds
+
+    def count(self, name: str, n: float = 1) -> None:
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[name] += n
+        step = self.current
+        if step is not None:
+            step.counters[name] += n
+
+    def observe(self, name: str, value: float) -> None:
+        """ Record a size or other non-time value in the histogram of name """
+        if self.enabled:
+            with self.lock:
+                self.histograms[name].observe(value)
+
+    def keep_if_slow(self, step: Step) -> None:
+        with self.lock:
+            self._steps += 1
+            entry, heap = (step.elapsed, self._steps, step), self.slow_steps[step.name]
+            if len(heap) < self.slowest:
+                heapq.heappush(heap, entry)
+            elif step.elapsed > heap[0][0]:
+                heapq.heapreplace(heap, entry)
+
+    def snapshot(self) -> Tuple[Dict[str, float], Dict[str, Histogram], Dict[str, List[Step]]]:
+        """ Copies of the counters, the histograms and the slowest steps of each name (slowest first) """
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {name: histogram.copy() for name, histogram in self.histograms.items()}
+            slow_steps = {name: [step for _, _, step in sorted(heap, key=lambda entry: -entry[0])]
+                          for name, heap in self.slow_steps.items()}
+            # Kept steps are finished, but the profiler may still be counting a last sample into one
+            steps = {name: [step.to_dict() for step in kept] for name, kept in slow_steps.items()}
+        return counters, histograms, steps
+
+    def slowest_steps(self) -> Dict[str, List[Dict[str, Any]]]:
+        """ Slowest steps of each name, slowest first """
+        return self.snapshot()[2]
+
+    def start_profiler(self, interval: float = PROFILE_INTERVAL) -> None:
+        """ Sample the stack of the thread running each step every interval seconds """
+        if self.profiler is None:
+            self.profiler = SamplingProfiler(self, interval)
+            self.profiler.start()
+
+    def stop_profiler(self) -> None:
+        if self.profiler is not None:
+            self.profiler.stop()
+            self.profiler = None
+
+    def to_dict(self) -> Dict[str, Any]:
+        counters, histograms, slowest_steps = self.snapshot()
+        return dict(counters=counters, histograms={name: h.to_dict() for name, h in sorted(histograms.items())},
+                    slowest_steps=slowest_steps)
+
+    def to_json(self) -> str:
+        return json.dumps(self.to_dict(), indent=2)
+
+    def to_prometheus(self, prefix: str = 'agent') -> str:
+        """ Prometheus text exposition: counters as counters, histograms with cumulative le buckets """
+        counters, histograms, _ = self.snapshot()
+        lines = []  # type: List[str]
+        for name, value in sorted(counters.items()):
+            metric = _metric_name(prefix, name) + '_total'
+            lines += [f'# TYPE {metric} counter', f'{metric} {value}']
+        for name, histogram in sorted(histograms.items()):
+            metric = _metric_name(prefix, name)
+            lines.append(f'# TYPE {metric} histogram')
+            cumulative = 0
+            for bucket in sorted(histogram.buckets):
+                cumulative += histogram.buckets[bucket]
+                lines.append(f'{metric}_bucket{{le="{histogram.upper_bound(bucket):.6g}"}} {cumulative}')
+            lines += [f'{metric}_bucket{{le="+Inf"}} {histogram.count}', f'{metric}_sum {histogram.sum}',
+                      f'{metric}_count {histogram.count}']
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, path: str) -> None:
+        """ Write to_json() to path, atomically """
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(self.to_json())
+        os.replace(tmp_path, path)
+
+
+class SamplingProfiler(threading.Thread):
+    """ Daemon thread counting the stacks of the running steps, so slow steps show where they spent time """
+    def __init__(self, metrics: Metrics, interval: float = PROFILE_INTERVAL):
+        super().__init__(name='metrics-profiler', daemon=True)
+        self.metrics = metrics
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            steps = self.metrics.running_steps()
+            if not steps:
+                continue
+            frames = sys._current_frames()
+            for step in steps:
+                frame = frames.get(step.thread)
+                stack = []  # type: List[str]
+                while frame is not None and len(stack) < PROFILE_DEPTH:
+                    code = frame.f_code
+                    stack.append(f'{os.path.basename(code.co_filename)}:{code.co_name}:{frame.f_lineno}')
+                    frame = frame.f_back
+                if stack:
+                    with self.metrics.lock:
+                        step.samples[tuple(stack)] += 1
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+def _metric_name(prefix: str, name: str) -> str:
+    return prefix + '_' + ''.join(c if c.isalnum() else '_' for c in name)
+
+
+METRICS = Metrics(enabled=os.environ.get('AGENT_METRICS', '') not in ('', '0'))
+if METRICS.enabled and os.environ.get('AGENT_PROFILE', '') not in ('', '0'):
+    METRICS.start_profiler()
+if METRICS.enabled and os.environ.get('AGENT_METRICS_DUMP'):
+    atexit.register(METRICS.dump, os.environ['AGENT_METRICS_DUMP'])
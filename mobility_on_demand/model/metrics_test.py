@@ -0,0 +1,122 @@
+import json
+import os
+import threading
+import time
+import unittest
+
+import metrics
+from agent import Agent
+
+
+SAMPLE_DIR = os.path.abspath('../samples')
+
+
+class MetricsTest(unittest.TestCase):
+    def test_histogram(self):
+        histogram = metrics.Histogram()
+        for value in range(1, 101):
+            histogram.observe(value / 1000)
+        histogram.observe(0.)
+        summary = histogram.to_dict()
+        assert summary['count'] == 101 and summary['min'] == 0. and summary['max'] == 0.1
+        # Bucket bounds are within one bucket (2 ** 0.25) of the exact percentile
+        assert 0.050 <= summary['p50'] <= 0.050 * 2 ** 0.25
+        assert 0.099 <= summary['p99'] <= 0.1
+
+    def test_disabled(self):
+        registry = metrics.Metrics()
+        assert registry.timer('a') is metrics.NULL_TIMER and registry.step('b') is metrics.NULL_TIMER
+        with registry.step('b'), registry.timer('a'):
+            registry.count('c')
+            registry.observe('d', 1.)
+        assert not registry.histograms and not registry.counters and not registry.slow_steps
+
+    def test_steps(self):
+        registry = metrics.Metrics(enabled=True, slowest=2)
+        for sleep in [0.001, 0.02, 0.005]:
+            with registry.step('dispatch'):
+                with registry.timer('score'):
+                    time.sleep(sleep)
+                registry.count('candidates', 3)
+        assert registry.histograms['dispatch'].count == 3 and registry.histograms['score'].count == 3
+        assert registry.counters['candidates'] == 9
+
+        slowest = registry.slowest_steps()['dispatch']
+        assert len(slowest) == 2 and slowest[0]['elapsed'] >= slowest[1]['elapsed'] >= 0.005
+        assert slowest[0]['phases']['score'] >= 0.02 and slowest[0]['counters'] == {'candidates': 3}
+
+        text = registry.to_prometheus()
+        assert '# TYPE agent_score histogram' in text and 'agent_candidates_total 9' in text
+        assert 'agent_dispatch_bucket{le="+Inf"} 3' in text and 'agent_dispatch_count 3' in text
+        assert json.loads(registry.to_json())['counters'] == {'candidates': 9}
+
+    def test_threads(self):
+        registry = metrics.Metrics(enabled=True)
+        started, stop = threading.Barrier(5), threading.Event()
+
+        def work(name):
+            started.wait()
+            with registry.step(name):
+                for i in range(2000):
+                    with registry.timer(f'{name}.phase{i % 50}'):
+                        registry.count(name)
+
+        def export():
+            started.wait()
+            while not stop.is_set():
+                registry.to_prometheus()
+                registry.to_json()
+
+        exporter = threading.Thread(target=export)
+        exporter.start()
+        workers = [threading.Thread(target=work, args=(f'step{k}',)) for k in range(4)]
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+        stop.set()
+        exporter.join()
+
+        assert registry.current is None
+        for k in range(4):
+            name = f'step{k}'
+            assert registry.counters[name] == 2000 and registry.histograms[name].count == 1
+            step = registry.slowest_steps()[name][0]
+            # Each step was charged with the phases and counts of its own thread only
+            assert step['counters'] == {name: 2000} and all(phase.startswith(name) for phase in step['phases'])
+            assert len(step['phases']) == 50
+
+    def test_profiler(self):
+        registry = metrics.Metrics(enabled=True)
+        registry.start_profiler(interval=0.001)
+        with registry.step('slow'):
+            deadline = time.perf_counter() + 0.05
+            while time.perf_counter() < deadline:
+                pass
+        registry.stop_profiler()
+        stacks = registry.slowest_steps()['slow'][0]['stacks']
+        assert stacks and any('metrics_test.py:test_profiler' in frame for frame in stacks[0]['stack'])
+
+    def test_agent_phases(self):
+        with open(os.path.join(SAMPLE_DIR, 'dispatch_observ'), 'r') as f:
+            dispatch_observ = json.load(f)
+        with open(os.path.join(SAMPLE_DIR, 'repo_observ'), 'r') as f:
+            repo_observ = json.load(f)
+        agent = Agent()
+        metrics.METRICS.reset()
+        metrics.METRICS.enable()
+        try:
+            assigned = agent.dispatch(dispatch_observ)
+            agent.reposition(repo_observ)
+        finally:
+            metrics.METRICS.disable()
+        counters, histograms = metrics.METRICS.counters, metrics.METRICS.histograms
+        assert counters['dispatch.candidates'] == len(dispatch_observ)
+        assert counters['dispatch.assigned'] == len(assigned)
+        assert counters['reposition.drivers'] == len(repo_observ['driver_info'])
+        for name in ['agent.dispatch', 'parse.batch', 'parse.lookup', 'dispatch.score', 'dispatch.assign',
+                     'dispatch.idle_update', 'agent.reposition', 'reposition.score']:
+            assert histograms[name].count == 1, name
+        components = histograms['assign.component_edges']
+        assert components.count == counters['assign.components'] and components.sum <= len(dispatch_observ)
+        metrics.METRICS.reset()
@@ -1,29 +1,37 @@
 import collections
-from typing import Any, Dict, List, Set, Tuple
+from typing import Any, Callable, Dict, List, Set, Tuple
+
+import numpy as np
 
 from grid import Grid
+from metrics import METRICS
 
 
 HEX_GRID = Grid()
 
 
 class Driver:
-    def __init__(self, od: Dict[str, Any]):
+    __slots__ = ('driver_id', 'coord', 'location')
+
+    def __init__(self, od: Dict[str, Any], location: str = None):
         self.driver_id = od['driver_id']  # type: str
         self.coord = od['driver_location']  # type: Tuple[float, float]
-        self.location = loc_to_grid(od['driver_location'])
+        self.location = location or loc_to_grid(od['driver_location'])
 
     def __repr__(self):
         return f'Driver:{self.driver_id}@{self.location}'
 
 
 class Request:
-    def __init__(self, od: Dict[str, Any]):
+    __slots__ = ('request_id', 'start_coord', 'start_loc', 'end_coord', 'end_loc', 'request_ts', 'finish_ts',
+                 'day_of_week', 'reward')
+
+    def __init__(self, od: Dict[str, Any], start_loc: str = None, end_loc: str = None):
         self.request_id = od['order_id']  # type: str
         self.start_coord = od['order_start_location']  # type: Tuple[float, float]
-        self.start_loc = loc_to_grid(od['order_start_location'])
+        self.start_loc = start_loc or loc_to_grid(od['order_start_location'])
         self.end_coord = od['order_finish_location']  # type: Tuple[float, float]
-        self.end_loc = loc_to_grid(od['order_finish_location'])
+        self.end_loc = end_loc or loc_to_grid(od['order_finish_location'])
         self.request_ts = od['timestamp']  # type: int
         self.finish_ts = od['order_finish_timestamp']  # type: int
         self.day_of_week = od['day_of_week']  # type: int
@@ -34,6 +42,8 @@ class Request:
 
 
 class DispatchCandidate:
+    __slots__ = ('driver_id', 'request_id', 'distance', 'eta')
+
     def __init__(self, od: Dict[str, Any]):
         self.driver_id = od['driver_id']  # type: str
         self.request_id = od['order_id']  # type: str
@@ -44,6 +54,104 @@ class DispatchCandidate:
         return f'Candidate:{self.driver_id},{self.request_id}:{self.distance},{self.eta}'
 
 
+class DispatchBatch:
+    """ Struct-of-arrays dispatch observation
+
+    Candidate columns (driver_idx, request_idx, distance, eta) have one entry per input row, in input order.
+    driver_idx and request_idx point into the per-driver and per-request columns, which hold the last row
+    seen for each id. Grid columns are Grid indices, shared with the dispatcher ValueTable.
+    """
+    def __init__(self, driver_ids: List[str], request_ids: List[str], driver_idx: np.ndarray,
+                 request_idx: np.ndarray, distance: np.ndarray, eta: np.ndarray, driver_coord: np.ndarray,
+                 driver_grid: np.ndarray, start_coord: np.ndarray, start_grid: np.ndarray, end_coord: np.ndarray,
+                 end_grid: np.ndarray, request_ts: np.ndarray, finish_ts: np.ndarray, day_of_week: np.ndarray,
+                 reward: np.ndarray):
+        self.driver_ids = driver_ids
+        self.request_ids = request_ids
+        self.driver_idx = driver_idx
+        self.request_idx = request_idx
+        self.distance = distance
+        self.eta = eta
+        self.driver_coord = driver_coord
+        self.driver_grid = driver_grid
+        self.start_coord = start_coord
+        self.start_grid = start_grid
+        self.end_coord = end_coord
+        self.end_grid = end_grid
+        self.request_ts = request_ts
+        self.finish_ts = finish_ts
+        self.day_of_week = day_of_week
+        self.reward = reward
+
+    def __len__(self):
+        return self.distance.size
+
+    def last_pair_rows(self) -> np.ndarray:
+        """ For each row, the last row with the same (request, driver) pair """
+        pairs = self.request_idx * max(len(self.driver_ids), 1) + self.driver_idx
+        order = np.argsort(pairs, kind='stable')
+        last = np.r_[pairs[order][1:] != pairs[order][:-1], True]
+        group = np.cumsum(np.r_[0, last[:-1]])
+        rows = np.empty(pairs.size, dtype=int)
+        rows[order] = order[np.flatnonzero(last)][group]
+        return rows
+
+    def take(self, rows: np.ndarray) -> 'DispatchBatch':
+        """ Batch of the given candidate rows, with the drivers and requests they reference in batch order """
+        drivers, driver_idx = _compact(self.driver_idx[rows], len(self.driver_ids))
+        requests, request_idx = _compact(self.request_idx[rows], len(self.request_ids))
+        return DispatchBatch(
+            [self.driver_ids[i] for i in drivers.tolist()], [self.request_ids[i] for i in requests.tolist()],
+            driver_idx.reshape(-1), request_idx.reshape(-1), self.distance[rows], self.eta[rows],
+            self.driver_coord[drivers], self.driver_grid[drivers], self.start_coord[requests],
+            self.start_grid[requests], self.end_coord[requests], self.end_grid[requests], self.request_ts[requests],
+            self.finish_ts[requests], self.day_of_week[requests], self.reward[requests])
+
+    @staticmethod
+    def from_objects(drivers: Dict[str, Driver], requests: Dict[str, Request], rows: List[DispatchCandidate],
+                     grid_index: Callable[[str], int]) -> 'DispatchBatch':
+        """ Columns for the object representation, with grid ids resolved by grid_index """
+        driver_pos = {driver_id: i for i, driver_id in enumerate(drivers)}
+        request_pos = {request_id: i for i, request_id in enumerate(requests)}
+        return DispatchBatch(
+            list(drivers), list(requests),
+            np.array([driver_pos[c.driver_id] for c in rows], dtype=int).reshape(-1),
+            np.array([request_pos[c.request_id] for c in rows], dtype=int).reshape(-1),
+            np.array([c.distance for c in rows], dtype=float).reshape(-1),
+            np.array([c.eta for c in rows], dtype=float).reshape(-1),
+            np.array([d.coord for d in drivers.values()], dtype=float).reshape(-1, 2),
+            np.array([grid_index(d.location) for d in drivers.values()], dtype=int).reshape(-1),
+            np.array([r.start_coord for r in requests.values()], dtype=float).reshape(-1, 2),
+            np.array([grid_index(r.start_loc) for r in requests.values()], dtype=int).reshape(-1),
+            np.array([r.end_coord for r in requests.values()], dtype=float).reshape(-1, 2),
+            np.array([grid_index(r.end_loc) for r in requests.values()], dtype=int).reshape(-1),
+            np.array([r.request_ts for r in requests.values()], dtype=np.int64).reshape(-1),
+            np.array([r.finish_ts for r in requests.values()], dtype=np.int64).reshape(-1),
+            np.array([r.day_of_week for r in requests.values()], dtype=int).reshape(-1),
+            np.array([r.reward for r in requests.values()], dtype=float).reshape(-1))
+
+    def to_objects(self) -> (Dict[str, Driver], Dict[str, Request], Dict[str, Set[DispatchCandidate]]):
+        """ Driver, Request and DispatchCandidate view of the batch """
+        drivers = dict()  # type: Dict[str, Driver]
+        for i, driver_id in enumerate(self.driver_ids):
+            od = dict(driver_id=driver_id, driver_location=self.driver_coord[i].tolist())
+            drivers[driver_id] = Driver(od, HEX_GRID.grid_ids[self.driver_grid[i]])
+        requests = dict()  # type: Dict[str, Request]
+        for i, request_id in enumerate(self.request_ids):
+            od = dict(order_id=request_id, order_start_location=self.start_coord[i].tolist(),
+                      order_finish_location=self.end_coord[i].tolist(), timestamp=int(self.request_ts[i]),
+                      order_finish_timestamp=int(self.finish_ts[i]), day_of_week=int(self.day_of_week[i]),
+                      reward_units=float(self.reward[i]))
+            requests[request_id] = Request(od, HEX_GRID.grid_ids[self.start_grid[i]], HEX_GRID.grid_ids[self.end_grid[i]])
+        candidates = collections.defaultdict(set)  # type: Dict[str, Set[DispatchCandidate]]
+        for d, r, distance, eta in zip(self.driver_idx.tolist(), self.request_idx.tolist(), self.distance.tolist(),
+                                       self.eta.tolist()):
+            od = dict(driver_id=self.driver_ids[d], order_id=self.request_ids[r], order_driver_distance=distance,
+                      pick_up_eta=eta)
+            candidates[od['order_id']].add(DispatchCandidate(od))
+        return drivers, requests, candidates
+
+
 class RepositionData:
     def __init__(self, r: Dict[str, Any]):
         self.timestamp = r['timestamp']  # type: int
@@ -53,20 +161,65 @@ class RepositionData:
         self.day_of_week = r['day_of_week']  # type: int
 
 
+def parse_batch(dispatch_input: List[Dict[str, Any]]) -> DispatchBatch:
+    driver_pos = dict()  # type: Dict[str, int]
+    request_pos = dict()  # type: Dict[str, int]
+    driver_rows = []  # type: List[Dict[str, Any]]
+    request_rows = []  # type: List[Dict[str, Any]]
+    driver_idx = np.empty(len(dispatch_input), dtype=int)
+    request_idx = np.empty(len(dispatch_input), dtype=int)
+    for k, od in enumerate(dispatch_input):
+        driver_idx[k] = _position(driver_pos, driver_rows, od['driver_id'], od)
+        request_idx[k] = _position(request_pos, request_rows, od['order_id'], od)
+
+    def column(rows: List[Dict[str, Any]], key: str, dtype) -> np.ndarray:
+        return np.array([od[key] for od in rows], dtype=dtype).reshape(-1)
+
+    # Resolve every distinct driver and order location with one batched grid lookup
+    driver_coord = np.array([od['driver_location'] for od in driver_rows], dtype=float).reshape(-1, 2)
+    start_coord = np.array([od['order_start_location'] for od in request_rows], dtype=float).reshape(-1, 2)
+    end_coord = np.array([od['order_finish_location'] for od in request_rows], dtype=float).reshape(-1, 2)
+    hits, misses = HEX_GRID.lookup_cache.hits, HEX_GRID.lookup_cache.misses
+    with METRICS.timer('parse.lookup'):
+        grids = HEX_GRID.lookup_indices(np.concatenate([driver_coord, start_coord, end_coord]))
+    n_drivers, n_requests = len(driver_rows), len(request_rows)
+    METRICS.count('parse.rows', len(dispatch_input))
+    METRICS.count('grid.lookup_cache_hits', HEX_GRID.lookup_cache.hits - hits)
+    METRICS.count('grid.lookup_cache_misses', HEX_GRID.lookup_cache.misses - misses)
+
+    return DispatchBatch(
+        list(driver_pos), list(request_pos), driver_idx, request_idx,
+        column(dispatch_input, 'order_driver_distance', float), column(dispatch_input, 'pick_up_eta', float),
+        driver_coord, grids[:n_drivers],
+        start_coord, grids[n_drivers:n_drivers + n_requests],
+        end_coord, grids[n_drivers + n_requests:],
+        column(request_rows, 'timestamp', np.int64), column(request_rows, 'order_finish_timestamp', np.int64),
+        column(request_rows, 'day_of_week', int), column(request_rows, 'reward_units', float))
+
+
+def _compact(idx: np.ndarray, n: int) -> (np.ndarray, np.ndarray):
+    """ The distinct values of idx (ascending), and idx as positions among them """
+    used = np.zeros(n, dtype=bool)
+    used[idx] = True
+    return np.flatnonzero(used), (np.cumsum(used) - 1)[idx]
+
+
+def _position(positions: Dict[str, int], rows: List[Dict[str, Any]], key: str, od: Dict[str, Any]) -> int:
+    """ Position of key in first-seen order; rows keeps the last row seen for each key """
+    i = positions.get(key)
+    if i is None:
+        i = positions[key] = len(rows)
+        rows.append(od)
+    else:
+        rows[i] = od
+    return i
+
+
 def parse_dispatch(dispatch_input: List[Dict[str, Any]]) -> (Dict[str, Driver], Dict[str, Request], Dict[str, Set[DispatchCandidate]]):
-    drivers = dict()  # type: Dict[str, Driver]
-    requests = dict()  # type: Dict[str, Request]
-    candidates = collections.defaultdict(set)  # type: Dict[str, Set[DispatchCandidate]]
-    for candidate in dispatch_input:
-        driver = Driver(candidate)
-        drivers[driver.driver_id] = driver
-        request = Request(candidate)
-        requests[request.request_id] = request
-        candidates[request.request_id].add(DispatchCandidate(candidate))
-    return drivers, requests, candidates
+    return parse_batch(dispatch_input).to_objects()
 
 
 def loc_to_grid(location: Tuple[float, float]) -> str:
     # This is actually not bad
     #return f'{location[1]:0.2f},{location[0]:0.2f}'
-    return HEX_GRID.lookup(location[0], location[1])
\ No newline at end of file
+    return HEX_GRID.lookup(location[0], location[1])
@@ -1,12 +1,19 @@
 import math
 from abc import abstractmethod
-from typing import Dict, List
+from typing import Dict, List, Tuple
+
+import numpy as np
+from scipy.spatial import cKDTree
 
 from dispatch import Dispatcher
+from grid import UNKNOWN_DISTANCE
+from metrics import METRICS
 from parse import HEX_GRID, RepositionData
 
 
 SPEED = 6 # 3 m/s @ 2 second interval
+SCORE_TOLERANCE = 1e-9  # Vectorized scores within this of the best are re-checked with the scalar rule
+TOP_K = 256  # Highest value grids tried first for every driver
 
 
 class Repositioner:
@@ -19,34 +26,151 @@ class Repositioner:
         ...
 
 
-class ScoredCandidate:
-    def __init__(self, grid_id: str, score: float):
-        self.grid_id = grid_id
-        self.score = score
+class CandidateGrids:
+    """ Candidate destinations as arrays of interned grid indices, projected so euclidean distance matches
+    Grid.distance(fast=True). Indices past the hex table are grids with a value but no known location. """
+    def __init__(self, grid_idx: np.ndarray, values: np.ndarray):
+        self.grid_idx = grid_idx
+        self.values = values
+        self.known = grid_idx < len(HEX_GRID.grid_ids)
+        self.known_idx = np.flatnonzero(self.known)
+        self.points = np.full((grid_idx.size, 2), np.nan)
+        self.points[self.known_idx] = HEX_GRID.points[grid_idx[self.known_idx]]
+        self.kdtree = cKDTree(self.points[self.known_idx]) if self.known_idx.size else None
+
+    def distances(self, grid_index: int, idx: np.ndarray) -> np.ndarray:
+        """ Distance in meters from grid_index to the candidates at idx """
+        if grid_index >= len(HEX_GRID.grid_ids):
+            return np.full(idx.shape, UNKNOWN_DISTANCE)
+        delta = self.points[idx] - HEX_GRID.points[grid_index]
+        distances = np.sqrt(np.sum(delta * delta, axis=1))
+        distances[~self.known[idx]] = UNKNOWN_DISTANCE
+        return distances
 
-    def __repr__(self):
-        return f'{self.grid_id}|{self.score}'
+    def within(self, grid_index: int, radius: float) -> np.ndarray:
+        """ Candidate positions within radius meters of grid_index, in candidate order """
+        if self.kdtree is None:
+            return np.empty(0, dtype=int)
+        ball = self.kdtree.query_ball_point(HEX_GRID.points[grid_index], radius)
+        return np.sort(self.known_idx[np.asarray(ball, dtype=int)])
 
 
 class StateValueGreedy(Repositioner):
+    """ Moves each driver to the grid with the best discounted value gain, if any gain is positive
+
+    Each grid is first scored against the top_k highest value grids, kept by the dispatcher's TopValues index.
+    A grid outside the index has value v < threshold, so moving there gains at most
+    gamma^(d / SPEED) * max(threshold, 0) - current value. When the best gain in the index beats that bound at
+    d = 0, it is the exact best destination. Otherwise only the grids close enough to beat it are scored
+    with the index, or every grid within reach when the bound gives no radius.
+    """
+    def __init__(self, dispatcher: Dispatcher, gamma: float, top_k: int = TOP_K):
+        super().__init__(dispatcher, gamma)
+        self.top_k = top_k
+
     def reposition(self, data: RepositionData) -> List[Dict[str, str]]:
         # Rank candidates using Dispatcher state values
-        candidate_grid_ids = []  # type: List[ScoredCandidate]
-        for grid_id in self.dispatcher.get_grid_ids():
-            value = self.dispatcher.state_value(grid_id)
-            candidate_grid_ids.append(ScoredCandidate(grid_id, value))
+        with METRICS.timer('reposition.candidates'):
+            index = self.dispatcher.top_values(self.top_k)
+            top = CandidateGrids(index.grid_idx, index.values)
+        candidates = None  # type: CandidateGrids  # Every grid, built when first needed
 
-        # Rank discounted incremental gain
+        # Drivers sharing a grid share a destination, so score each grid once
+        destinations = dict()  # type: Dict[str, str]
         reposition = []  # type: List[Dict[str, str]]
-        for driver_id, current_grid_id in data.drivers:
-            current_value = self.dispatcher.state_value(current_grid_id)
-            best_grid_id, best_value = current_grid_id, 0  # don't move for lower gain
-            for grid_candidate in candidate_grid_ids:
-                time = HEX_GRID.distance(current_grid_id, grid_candidate.grid_id) / SPEED
-                discount = math.pow(self.gamma, time)
-                proposed_value = self.dispatcher.state_value(grid_candidate.grid_id)
-                incremental_value = discount * proposed_value - current_value
-                if incremental_value > best_value:
-                    best_grid_id, best_value = grid_candidate.grid_id, incremental_value
-            reposition.append(dict(driver_id=driver_id, destination=best_grid_id))
-        return reposition
\ No newline at end of file
+        scans = 0
+        with METRICS.timer('reposition.score'):
+            for driver_id, current_grid_id in data.drivers:
+                if current_grid_id not in destinations:
+                    destination, best = self._top_destination(current_grid_id, top, index.threshold)
+                    if destination is None:
+                        if candidates is None:
+                            grid_idx = self.dispatcher.get_grid_indices()
+                            candidates = CandidateGrids(grid_idx, self.dispatcher.state_value(grid_idx))
+                        destination = self._near_destination(current_grid_id, top, index.threshold, best, candidates)
+                        scans += 1
+                    destinations[current_grid_id] = destination
+                reposition.append(dict(driver_id=driver_id, destination=destinations[current_grid_id]))
+        METRICS.count('reposition.drivers', len(data.drivers))
+        METRICS.count('reposition.grids_scored', len(destinations))
+        METRICS.count('reposition.grids_scanned', scans)
+        return reposition
+
+    def _top_destination(self, current_grid_id: str, top: CandidateGrids, threshold: float) -> Tuple[str, float]:
+        """ Best destination among the top grids and the best positive gain there, or no destination if a grid
+        outside them could be better """
+        current_index = self.dispatcher.grid_index(current_grid_id)
+        current_value = self.dispatcher.state_value(current_index)
+        idx = np.arange(top.grid_idx.size)
+        gains = self._gains(current_index, current_value, top, idx)
+        best = max(float(np.max(gains)) if gains.size else 0., 0.)
+        if threshold > -np.inf:
+            bound = max(threshold, 0.) - current_value
+            if best <= bound + SCORE_TOLERANCE * max(1., abs(bound)):
+                return None, best
+        if idx.size == 0:
+            return current_grid_id, best
+        return self._choose(current_grid_id, current_value, top, idx, gains), best
+
+    def _near_destination(self, current_grid_id: str, top: CandidateGrids, threshold: float, best: float,
+                          candidates: CandidateGrids) -> str:
+        """ Best destination among the top grids and the grids near enough to beat their best gain """
+        current_index = self.dispatcher.grid_index(current_grid_id)
+        current_value = self.dispatcher.state_value(current_index)
+        if current_index >= len(HEX_GRID.grid_ids) or not 0 < self.gamma < 1 or threshold <= 0 \
+                or best + current_value <= 0:
+            return self._best_destination(current_grid_id, candidates)
+
+        # A grid outside the index beats best only where gamma^(d / SPEED) * threshold > best + current_value
+        radius = max(SPEED * math.log((best + current_value) / threshold) / math.log(self.gamma), 0.)
+        idx = np.union1d(candidates.within(current_index, radius * (1 + SCORE_TOLERANCE) + 1),
+                         np.searchsorted(candidates.grid_idx, top.grid_idx))
+        gains = self._gains(current_index, current_value, candidates, idx)
+        return self._choose(current_grid_id, current_value, candidates, idx, gains)
+
+    def _best_destination(self, current_grid_id: str, candidates: CandidateGrids) -> str:
+        """ Grid maximizing the discounted incremental gain, or the current grid if no gain is positive """
+        current_index = self.dispatcher.grid_index(current_grid_id)
+        current_value = self.dispatcher.state_value(current_index)
+        idx = self._reachable(current_index, current_value, candidates)
+        if idx.size == 0:
+            return current_grid_id
+        gains = self._gains(current_index, current_value, candidates, idx)
+        return self._choose(current_grid_id, current_value, candidates, idx, gains)
+
+    def _gains(self, current_index: int, current_value: float, candidates: CandidateGrids,
+               idx: np.ndarray) -> np.ndarray:
+        """ Discounted incremental gain of moving to the candidates at idx """
+        time = candidates.distances(current_index, idx) / SPEED
+        return np.power(self.gamma, time) * candidates.values[idx] - current_value
+
+    def _choose(self, current_grid_id: str, current_value: float, candidates: CandidateGrids, idx: np.ndarray,
+                gains: np.ndarray) -> str:
+        """ Candidate with the best gain, or the current grid if no gain is positive """
+        best = np.max(gains)
+        if best < -SCORE_TOLERANCE:
+            return current_grid_id
+
+        # Break near-ties with the scalar rule, in candidate order, so the choice matches the reference loop
+        best_grid_id, best_value = current_grid_id, 0  # don't move for lower gain
+        for i in idx[gains >= best - SCORE_TOLERANCE * max(1., abs(best))]:
+            grid_id = self.dispatcher.grid_id(candidates.grid_idx[i])
+            discount = math.pow(self.gamma, HEX_GRID.distance(current_grid_id, grid_id) / SPEED)
+            incremental_value = discount * candidates.values[i] - current_value
+            if incremental_value > best_value:
+                best_grid_id, best_value = grid_id, incremental_value
+        return best_grid_id
+
+    def _reachable(self, current_index: int, current_value: float, candidates: CandidateGrids) -> np.ndarray:
+        """ Candidate positions that could beat staying put """
+        everything = np.arange(candidates.grid_idx.size)
+        max_value = np.max(candidates.values) if candidates.values.size else 0.
+        if current_index >= len(HEX_GRID.grid_ids) or not 0 < self.gamma < 1 or current_value <= 0:
+            # No finite radius: distant (or unknown) grids still win when the current value is negative
+            return everything
+        if max_value <= current_value:
+            return everything[:0]
+
+        # gamma^(d / SPEED) * max_value > current_value  <=>  d < SPEED * log(current_value / max_value) / log(gamma)
+        radius = SPEED * math.log(current_value / max_value) / math.log(self.gamma)
+        return candidates.within(current_index, radius * (1 + SCORE_TOLERANCE) + 1)
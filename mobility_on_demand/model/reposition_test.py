@@ -0,0 +1,71 @@
+import json
+import math
+import os
+import random
+import unittest
+
+import dispatch
+import parse
+import reposition
+
+
+SAMPLE_DIR = os.path.abspath('../samples')
+
+
+def brute_force(dispatcher: dispatch.Dispatcher, gamma: float, data: parse.RepositionData):
+    """ Reference greedy: every driver against every grid """
+    grid_ids = [dispatcher.grid_id(i) for i in dispatcher.get_grid_indices()]
+    result = []
+    for driver_id, current_grid_id in data.drivers:
+        current_value = dispatcher.state_value(current_grid_id)
+        best_grid_id, best_value = current_grid_id, 0
+        for grid_id in grid_ids:
+            time = parse.HEX_GRID.distance(current_grid_id, grid_id) / reposition.SPEED
+            incremental_value = math.pow(gamma, time) * dispatcher.state_value(grid_id) - current_value
+            if incremental_value > best_value:
+                best_grid_id, best_value = grid_id, incremental_value
+        result.append(dict(driver_id=driver_id, destination=best_grid_id))
+    return result
+
+
+class RepositionTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        with open(os.path.join(SAMPLE_DIR, 'repo_observ'), 'r') as f:
+            cls.repo_observ = json.load(f)
+
+    def test_matches_brute_force(self):
+        rng = random.Random(7)
+        grid_ids = parse.HEX_GRID.grid_ids
+        for low, high, gamma in [(-3, 5, 0.9997), (-5, 0.5, 0.9997), (-1, 1, 0.99)]:
+            dispatcher = dispatch.Sarsa(0.01, 0.9, 0)
+            for grid_id in dispatcher.get_grid_ids():
+                dispatcher.update_state_value(grid_id, rng.uniform(low, high) - dispatcher.state_value(grid_id))
+            observ = dict(self.repo_observ)
+            observ['driver_info'] = self.repo_observ['driver_info'] + [
+                dict(driver_id=1000 + i, grid_id=rng.choice(grid_ids)) for i in range(20)]
+            data = parse.RepositionData(observ)
+
+            expected = brute_force(dispatcher, gamma, data)
+            actual = reposition.StateValueGreedy(dispatcher, gamma).reposition(data)
+            assert actual == expected, (actual, expected)
+
+    def test_top_k_matches_brute_force(self):
+        rng = random.Random(11)
+        grid_ids = parse.HEX_GRID.grid_ids
+        dispatcher = dispatch.Sarsa(0.01, 0.9, 0)
+        for grid_id in dispatcher.get_grid_ids():
+            dispatcher.update_state_value(grid_id, rng.uniform(-2, 4) - dispatcher.state_value(grid_id))
+        observ = dict(self.repo_observ)
+        observ['driver_info'] = [dict(driver_id=i, grid_id=rng.choice(grid_ids)) for i in range(20)]
+        data = parse.RepositionData(observ)
+
+        repositioners = [reposition.StateValueGreedy(dispatcher, 0.9997, top_k) for top_k in (1, 16, 10 ** 9)]
+        for _ in range(3):
+            expected = brute_force(dispatcher, 0.9997, data)
+            for repositioner in repositioners:
+                actual = repositioner.reposition(data)
+                assert actual == expected, (repositioner.top_k, actual, expected)
+            # Raise some grids into the index and drop some out of it between calls
+            for grid_id in rng.sample(grid_ids, 50):
+                dispatcher.update_state_value(grid_id, rng.uniform(-3, 3))
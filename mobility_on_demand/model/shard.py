@@ -0,0 +1,174 @@
+import multiprocessing
+from multiprocessing.sharedctypes import RawArray
+from typing import Any, Callable, List, Tuple
+
+import numpy as np
+
+from assign import Assigner
+from dispatch import PendingUpdate, Sarsa
+from metrics import METRICS
+from parse import DispatchBatch, HEX_GRID
+from values import DIRTY_ROWS, ValueTable
+
+
+SHARDS = 4
+MIN_PARALLEL_ROWS = 20000  # Smaller batches are dispatched shard by shard in process, cheaper than the round trip
+
+_worker = None  # type: Sarsa  # Dispatcher over the shared value table, in each pool process
+
+
+class ShardedSarsa(Sarsa):
+    """ Sarsa with each step matched and learned region by region in a process pool
+
+    The hex grid is split into spatial regions (Grid.regions) and the value table lives in shared memory, so
+    pool processes read and write the same values as this one. Each step runs in three phases:
+
+    1. Candidates whose driver and order start both fall in one region are matched by that region's shard,
+       in parallel. Regions share no driver or order, so this is the same as matching them all at once.
+    2. Candidates crossing regions are matched here, among the drivers and orders left free (reconciliation).
+    3. TD updates are applied by the shard of each driver's region, in parallel. Sarsa only writes the values
+       of driver locations, so shards write disjoint grids, each in the order the single process would, and
+       the merged values do not depend on scheduling.
+
+    Matching differs from Sarsa only through phase 2: a crossing candidate loses to any candidate matched
+    inside a region, whatever their scores. Batches under min_rows skip the pool and run the same phases in
+    this process. If the table outgrows its shared buffer (new grid ids), it is copied to a larger one and
+    the pool restarted.
+    """
+    def __init__(self, alpha, gamma, idle_reward, assigner: Assigner = None, learning: str = 'sync',
+                 initial_values: ValueTable = None, shards: int = SHARDS, processes: int = None,
+                 min_rows: int = MIN_PARALLEL_ROWS):
+        super().__init__(alpha, gamma, idle_reward, assigner, learning, initial_values)
+        self.shards = shards
+        self.processes = processes if processes is not None else shards
+        self.min_rows = min_rows
+        self.regions = HEX_GRID.regions(shards)
+        self._buffers = None  # type: Tuple[Any, Any, Any]
+        self._pool = None  # type: multiprocessing.pool.Pool
+        self._share()
+
+    @property
+    def kind(self) -> str:
+        return 'Sarsa'
+
+    def region(self, grid_idx: np.ndarray) -> np.ndarray:
+        """ Region of each grid index; grids outside the hex table are spread over regions by index """
+        n = self.regions.size
+        return np.where(grid_idx < n, self.regions[np.minimum(grid_idx, n - 1)], grid_idx % self.shards)
+
+    def _match(self, batch: DispatchBatch) -> Tuple[np.ndarray, PendingUpdate]:
+        driver_region = self.region(batch.driver_grid)[batch.driver_idx]
+        request_region = self.region(batch.start_grid)[batch.request_idx]
+        inside = driver_region == request_region
+        METRICS.count('dispatch.crossing_candidates', int(np.sum(~inside)))
+
+        with METRICS.timer('dispatch.shard_match'):
+            shard_rows = [rows for rows in _split(np.flatnonzero(inside), driver_region[inside], self.shards)
+                          if rows.size]
+            results = self._map(_match_shard, [(batch.take(rows),) for rows in shard_rows], len(batch))
+            assigned = [rows[chosen] for rows, (chosen, _) in zip(shard_rows, results)]
+            scores = np.full(len(batch), np.nan)
+            for rows, (chosen, chosen_scores) in zip(assigned, results):
+                scores[rows] = chosen_scores
+
+        with METRICS.timer('dispatch.reconcile'):
+            assigned = np.concatenate(assigned) if assigned else np.empty(0, dtype=int)
+            free_drivers = np.ones(len(batch.driver_ids), dtype=bool)
+            free_drivers[batch.driver_idx[assigned]] = False
+            free_requests = np.ones(len(batch.request_ids), dtype=bool)
+            free_requests[batch.request_idx[assigned]] = False
+            crossing = np.flatnonzero(~inside & free_drivers[batch.driver_idx] & free_requests[batch.request_idx])
+            if crossing.size:
+                chosen, pending = super()._match(batch.take(crossing))
+                scores[crossing[chosen]] = pending.scores[chosen]
+                assigned = np.concatenate([assigned, crossing[chosen]])
+
+        # Highest score first, like a single matcher would apply them
+        assigned = assigned[np.lexsort((assigned, -scores[assigned]))]
+        return assigned, PendingUpdate(batch, assigned, scores)
+
+    def _learn(self, pending: PendingUpdate) -> None:
+        batch = pending.batch
+        driver_region = self.region(batch.driver_grid)[batch.driver_idx]
+        with METRICS.timer('dispatch.shard_learn'):
+            position = np.full(len(batch), -1)
+            tasks = []
+            for rows in _split(np.arange(len(batch)), driver_region, self.shards):
+                if rows.size == 0:
+                    continue
+                position[rows] = np.arange(rows.size)
+                assigned = pending.assigned[driver_region[pending.assigned] == driver_region[rows[0]]]
+                tasks.append((batch.take(rows), position[assigned], pending.scores[rows]))
+            self._map(_learn_shard, tasks, len(batch))
+
+    def _map(self, fn: Callable, tasks: List[Tuple], rows: int) -> List[Any]:
+        """ fn over the shard tasks, in the pool for large enough batches """
+        if rows < self.min_rows or self.processes <= 1 or len(tasks) <= 1:
+            return [fn(self, *task) for task in tasks]
+        if self.state_values.values is not self._buffers[0][1]:
+            self._share()
+        if self._pool is None:
+            (values, _), (present, _), (dirty, _) = self._buffers
+            self._pool = multiprocessing.Pool(
+                self.processes, _init_worker,
+                (self.alpha, self.gamma, self.idle_reward, self.assigner, self.state_values.ids,
+                 self.state_values.values.shape, values, present, dirty))
+        return self._pool.starmap(_in_worker, [(fn, task) for task in tasks])
+
+    def _share(self) -> None:
+        """ Move the value table into shared buffers with room to grow, restarting the pool """
+        self.close_pool()
+        table = self.state_values
+        shape = (table.values.shape[0], 2 * table.values.shape[1])
+        values, present = _shared(np.float64, shape), _shared(np.bool_, shape[1:])
+        dirty = _shared(np.bool_, (DIRTY_ROWS, shape[1]))
+        n = table.values.shape[1]
+        values[1][:, :n], present[1][:n], dirty[1][:, :n] = table.values, table.present, table.dirty
+        self.state_values = ValueTable.from_arrays(table.ids, values[1], present[1], dirty[1])
+        self._buffers = (values, present, dirty)
+
+    def close_pool(self) -> None:
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+
+    def close(self) -> None:
+        super().close()
+        self.close_pool()
+
+
+def _match_shard(dispatcher: Sarsa, batch: DispatchBatch) -> Tuple[np.ndarray, np.ndarray]:
+    """ Assigned rows of one shard's batch and their scores """
+    assigned, pending = Sarsa._match(dispatcher, batch)
+    return assigned, pending.scores[assigned]
+
+
+def _learn_shard(dispatcher: Sarsa, batch: DispatchBatch, assigned: np.ndarray, scores: np.ndarray) -> None:
+    Sarsa._learn(dispatcher, PendingUpdate(batch, assigned, scores))
+
+
+def _split(rows: np.ndarray, labels: np.ndarray, n: int) -> List[np.ndarray]:
+    """ rows grouped by label in [0, n), each group in its original order """
+    order = np.argsort(labels, kind='stable')
+    bounds = np.searchsorted(labels[order], np.arange(n + 1))
+    return [rows[order[bounds[k]:bounds[k + 1]]] for k in range(n)]
+
+
+def _shared(dtype, shape: Tuple[int, ...]) -> Tuple[Any, np.ndarray]:
+    """ Zeroed shared memory buffer and an array view of it """
+    buffer = RawArray('b', int(np.prod(shape)) * np.dtype(dtype).itemsize)
+    return buffer, np.frombuffer(buffer, dtype=dtype).reshape(shape)
+
+
+def _init_worker(alpha, gamma, idle_reward, assigner: Assigner, ids: List[str], shape: Tuple[int, int],
+                 values, present, dirty) -> None:
+    global _worker
+    table = ValueTable.from_arrays(ids, np.frombuffer(values, dtype=np.float64).reshape(shape),
+                                   np.frombuffer(present, dtype=np.bool_),
+                                   np.frombuffer(dirty, dtype=np.bool_).reshape(DIRTY_ROWS, -1))
+    _worker = Sarsa(alpha, gamma, idle_reward, assigner, initial_values=table)
+
+
+def _in_worker(fn: Callable, task: Tuple) -> Any:
+    return fn(_worker, *task)
@@ -0,0 +1,86 @@
+import json
+import os
+import unittest
+
+import numpy as np
+
+import dispatch
+from dispatch import PendingUpdate
+import parse
+import shard
+
+
+SAMPLE_DIR = os.path.abspath('../samples')
+
+
+class ShardTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.args = (2 / (5 * 60), 0.9, -2 / (60 * 60))
+        with open(os.path.join(SAMPLE_DIR, 'dispatch_observ'), 'r') as f:
+            observ = json.load(f)
+        # Drivers of the sample in region 0 of 4 and those of a copy in region 2. The first order of each starts
+        # among its drivers, the second in region 1, so its candidates all cross regions.
+        copy = [dict(od, driver_id=f'{od["driver_id"]}-2', order_id=f'{od["order_id"]}-2') for od in observ]
+        regions = parse.HEX_GRID.regions(4)
+        centroids = [parse.HEX_GRID.centroids[regions == k].tolist() for k in range(3)]
+        rng = np.random.RandomState(0)
+        location_regions = dict()
+        for rows, home in ((observ, 0), (copy, 2)):
+            for od in rows:
+                location_regions[('driver', od['driver_id'])] = home
+            for k, order_id in enumerate(dict.fromkeys(od['order_id'] for od in rows)):
+                location_regions[('order', order_id)] = 1 if k else home
+        locations = {key: centroids[r][rng.randint(len(centroids[r]))] for key, r in location_regions.items()}
+        observ += copy
+        cls.batches = []
+        for _ in range(4):
+            cls.batches.append(parse.parse_batch([
+                dict(od, order_driver_distance=od['order_driver_distance'] * rng.uniform(0.5, 1.5),
+                     driver_location=locations[('driver', od['driver_id'])],
+                     order_start_location=locations[('order', od['order_id'])])
+                for od in observ]))
+
+    def test_take(self):
+        batch = self.batches[0]
+        rows = np.flatnonzero(batch.distance > np.median(batch.distance))
+        taken = batch.take(rows)
+        assert len(taken) == rows.size
+        assert [taken.driver_ids[d] for d in taken.driver_idx] == [batch.driver_ids[d] for d in batch.driver_idx[rows]]
+        assert ([taken.request_ids[r] for r in taken.request_idx]
+                == [batch.request_ids[r] for r in batch.request_idx[rows]])
+        np.testing.assert_array_equal(taken.driver_grid[taken.driver_idx], batch.driver_grid[batch.driver_idx[rows]])
+        np.testing.assert_array_equal(taken.reward[taken.request_idx], batch.reward[batch.request_idx[rows]])
+
+    def test_one_shard_is_sarsa(self):
+        sarsa = dispatch.Sarsa(*self.args)
+        sharded = shard.ShardedSarsa(*self.args, shards=1)
+        for batch in self.batches:
+            np.testing.assert_array_equal(sharded.dispatch_batch(batch), sarsa.dispatch_batch(batch))
+        np.testing.assert_array_equal(sharded.state_values.row(0), sarsa.state_values.row(0))
+
+    def test_sharded(self):
+        serial = shard.ShardedSarsa(*self.args, shards=4, min_rows=len(self.batches[0]) + 1)
+        pooled = shard.ShardedSarsa(*self.args, shards=4, processes=2, min_rows=0)
+        replay = dispatch.Sarsa(*self.args)
+        try:
+            for batch in self.batches:
+                assigned = serial.dispatch_batch(batch)
+                np.testing.assert_array_equal(pooled.dispatch_batch(batch), assigned)
+                assert np.unique(batch.driver_idx[assigned]).size == assigned.size
+                assert np.unique(batch.request_idx[assigned]).size == assigned.size
+
+                # Shards learn what one process learns from the same assignment
+                _, pending = dispatch.Sarsa._match(replay, batch)
+                replay._learn(PendingUpdate(batch, assigned, pending.scores))
+            assert pooled._pool is not None
+        finally:
+            pooled.close()
+        np.testing.assert_array_equal(pooled.state_values.row(0), serial.state_values.row(0))
+        np.testing.assert_array_equal(serial.state_values.row(0), replay.state_values.row(0))
+        assert serial.kind == 'Sarsa'
+
+        # Some candidates were matched by the shards and some in reconciliation
+        driver_region = serial.region(batch.driver_grid)[batch.driver_idx]
+        inside = driver_region == serial.region(batch.start_grid)[batch.request_idx]
+        assert np.any(inside[assigned]) and np.any(~inside[assigned])
@@ -0,0 +1,306 @@
+import json
+import os
+from typing import Dict, Iterator, List, Tuple
+
+import numpy as np
+
+from dispatch import Dispatcher
+from metrics import METRICS
+from parse import DispatchBatch, RepositionData
+
+
+LOG_VERSION = 1
+DISPATCH_STEP, REPOSITION_STEP = 0, 1
+CHUNK_STEPS = 4096  # Steps read from disk at once when replaying
+SCHEMA = 'schema.json'
+GRID_IDS = 'grid_ids.txt'
+# Columns of each table as (name, dtype, width). A step row counts its rows in each other table, in the column
+# named after that table
+TABLES = (
+    ('steps', (('kind', 'u1', 1), ('timestamp', 'i8', 1), ('day_of_week', 'i1', 1), ('flipped', '?', 1),
+               ('rows', 'i4', 1), ('drivers', 'i4', 1), ('requests', 'i4', 1), ('assigned', 'i4', 1),
+               ('moves', 'i4', 1))),
+    ('rows', (('driver_idx', 'i4', 1), ('request_idx', 'i4', 1), ('distance', 'f8', 1), ('eta', 'f8', 1))),
+    ('drivers', (('driver_id', 'i8', 1), ('grid', 'i4', 1), ('coord', 'f8', 2))),
+    ('requests', (('order_id', 'i8', 1), ('start_grid', 'i4', 1), ('start_coord', 'f8', 2), ('end_grid', 'i4', 1),
+                  ('end_coord', 'f8', 2), ('request_ts', 'i8', 1), ('finish_ts', 'i8', 1), ('day_of_week', 'i1', 1),
+                  ('reward', 'f8', 1))),
+    ('assigned', (('row', 'i4', 1),)),
+    ('moves', (('driver_id', 'i8', 1), ('grid', 'i4', 1), ('destination', 'i4', 1))),
+)
+COLUMNS = dict(TABLES)
+COUNTED = tuple(table for table, _ in TABLES[1:])
+GRID_COLUMNS = (('drivers', 'grid'), ('requests', 'start_grid'), ('requests', 'end_grid'), ('moves', 'grid'),
+                ('moves', 'destination'))
+
+
+class LoggedStep:
+    """ One dispatch or reposition step read back from a StepLog
+
+    A dispatch step holds its observation as a DispatchBatch (driver and order ids as int arrays) and the
+    rows assigned, in the order they were matched. A reposition step holds the drivers moved, their grid
+    and their destination.
+    """
+    __slots__ = ('kind', 'timestamp', 'day_of_week', 'flipped', 'batch', 'assigned', 'moves')
+
+    def __init__(self, kind: int, timestamp: int, day_of_week: int, flipped: bool, batch: DispatchBatch,
+                 assigned: np.ndarray, moves: Tuple[np.ndarray, np.ndarray, np.ndarray]):
+        self.kind = kind
+        self.timestamp = timestamp
+        self.day_of_week = day_of_week
+        self.flipped = flipped
+        self.batch = batch
+        self.assigned = assigned
+        self.moves = moves
+
+
+class StepLog:
+    """ Append-only columnar log of the dispatch and reposition steps of an agent
+
+    Each column of each table is a raw binary file of fixed width values, appended to once per step, and the
+    steps table counts the rows every step added to the other tables. Grids are stored as indices into
+    grid_ids.txt, which lists grid ids in the order the log first saw them, so a log stays valid across
+    restarts whatever the order the dispatcher interned its grids in. Driver and order ids must be integers,
+    as in the competition observations.
+
+    Every column of a step is encoded before any is written, and the step is written table by table with the
+    steps row last. A write that fails is truncated back to where the step started, and a crash mid-step leaves
+    at most a partial tail, which readers ignore and the next StepLog over the directory truncates.
+    """
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        if not os.path.exists(os.path.join(directory, SCHEMA)):
+            _write_schema(directory)
+        _check_schema(directory)
+        self.steps = _truncate_partial_step(directory)
+        self.grid_ids = read_grid_ids(directory, truncate=True)
+        self._log_index = {grid_id: i for i, grid_id in enumerate(self.grid_ids)}  # type: Dict[str, int]
+        self._to_log = np.empty(0, dtype=np.int32)  # Log index of each dispatcher grid index seen so far
+        self._added = []  # type: List[str]  # Grid ids seen since the last write to grid_ids.txt
+        self._grid_file = open(os.path.join(directory, GRID_IDS), 'a')
+        self._files = {(table, column): open(_path(directory, table, column), 'ab', buffering=0)
+                       for table, columns in TABLES for column, _, _ in columns}
+
+    def dispatch(self, batch: DispatchBatch, assigned: np.ndarray, grid_ids: List[str], flipped: bool = False) -> None:
+        """ Append a dispatch step: the batch, its assigned rows and the Dql coin flip; grid_ids names the grid
+        indices of the batch """
+        to_log = self._grid_map(grid_ids)
+        timestamp = int(np.max(batch.request_ts)) if len(batch.request_ids) else 0
+        day_of_week = int(batch.day_of_week[0]) if len(batch.request_ids) else 0
+        columns = (
+            self._encode('rows', driver_idx=batch.driver_idx, request_idx=batch.request_idx, distance=batch.distance,
+                         eta=batch.eta) +
+            self._encode('drivers', driver_id=np.asarray(batch.driver_ids, dtype=np.int64),
+                         grid=to_log[batch.driver_grid], coord=batch.driver_coord) +
+            self._encode('requests', order_id=np.asarray(batch.request_ids, dtype=np.int64),
+                         start_grid=to_log[batch.start_grid], start_coord=batch.start_coord,
+                         end_grid=to_log[batch.end_grid], end_coord=batch.end_coord, request_ts=batch.request_ts,
+                         finish_ts=batch.finish_ts, day_of_week=batch.day_of_week, reward=batch.reward) +
+            self._encode('assigned', row=assigned) +
+            self._encode_step(DISPATCH_STEP, timestamp, day_of_week, flipped, rows=len(batch),
+                              drivers=len(batch.driver_ids), requests=len(batch.request_ids), assigned=assigned.size))
+        self._write_step(columns)
+
+    def reposition(self, data: RepositionData, actions: List[Dict[str, str]]) -> None:
+        """ Append a reposition step: the grid and destination of each driver """
+        grid = np.array([self._intern(grid_id) for _, grid_id in data.drivers], dtype=np.int32)
+        destination = np.array([self._intern(action['destination']) for action in actions], dtype=np.int32)
+        columns = (
+            self._encode('moves', driver_id=np.array([action['driver_id'] for action in actions], dtype=np.int64),
+                         grid=grid, destination=destination) +
+            self._encode_step(REPOSITION_STEP, data.timestamp, data.day_of_week, False, moves=len(actions)))
+        self._write_step(columns)
+
+    def close(self) -> None:
+        self._grid_file.close()
+        for f in self._files.values():
+            f.close()
+
+    def _grid_map(self, grid_ids: List[str]) -> np.ndarray:
+        """ Log index of each dispatcher grid index, appending grid ids the log has not seen """
+        seen = self._to_log.size
+        if seen < len(grid_ids):
+            added = np.array([self._intern(grid_id) for grid_id in grid_ids[seen:]], dtype=np.int32)
+            self._to_log = np.concatenate([self._to_log, added])
+        return self._to_log
+
+    def _intern(self, grid_id: str) -> int:
+        i = self._log_index.get(grid_id)
+        if i is None:
+            i = self._log_index[grid_id] = len(self.grid_ids)
+            self.grid_ids.append(grid_id)
+            self._added.append(grid_id)
+        return i
+
+    def _write_grid_ids(self) -> None:
+        """ Write the grid ids seen since the last call, before any step refers to them """
+        if self._added:
+            self._grid_file.write(''.join(grid_id + '\n' for grid_id in self._added))
+            self._grid_file.flush()
+            self._added = []
+
+    def _encode(self, table: str, **arrays: np.ndarray) -> List[Tuple[Tuple[str, str], bytes]]:
+        """ Bytes to append to each column of table """
+        return [((table, column), np.ascontiguousarray(arrays[column], dtype=dtype).tobytes())
+                for column, dtype, _ in COLUMNS[table]]
+
+    def _encode_step(self, kind: int, timestamp: int, day_of_week: int, flipped: bool,
+                     **counts: int) -> List[Tuple[Tuple[str, str], bytes]]:
+        return self._encode('steps', kind=kind, timestamp=timestamp, day_of_week=day_of_week, flipped=flipped,
+                            **{table: counts.get(table, 0) for table in COUNTED})
+
+    def _write_step(self, columns: List[Tuple[Tuple[str, str], bytes]]) -> None:
+        """ Append the encoded columns of a step, truncating every column back to its start if a write fails """
+        self._write_grid_ids()
+        with METRICS.timer('steplog.write'):
+            offsets = {key: f.tell() for key, f in self._files.items()}
+            try:
+                for key, data in columns:
+                    self._files[key].write(data)
+            except BaseException:
+                for key, f in self._files.items():
+                    f.truncate(offsets[key])
+                raise
+        self.steps += 1
+        METRICS.count('steplog.steps')
+
+
+class StepLogReader:
+    """ Steps of a StepLog directory, streamed from disk a chunk of steps at a time """
+    def __init__(self, directory: str):
+        self.directory = directory
+        _check_schema(directory)
+        self.grid_ids = read_grid_ids(directory)
+        self._columns = {table: {column: _column(_path(directory, table, column), dtype, width)
+                                 for column, dtype, width in columns} for table, columns in TABLES}
+        self.n_steps = min(column.shape[0] for column in self._columns['steps'].values())
+
+    def __len__(self):
+        return self.n_steps
+
+    def steps(self, chunk_steps: int = CHUNK_STEPS, grid_index: np.ndarray = None) -> Iterator[LoggedStep]:
+        """ Every complete step in order, with grids mapped through grid_index (log index to grid index) """
+        offsets = dict.fromkeys(COUNTED, 0)
+        for start in range(0, self.n_steps, chunk_steps):
+            stop = min(start + chunk_steps, self.n_steps)
+            steps = {column: np.array(values[start:stop]) for column, values in self._columns['steps'].items()}
+            ends = {table: offsets[table] + np.cumsum(steps[table], dtype=np.int64) for table in COUNTED}
+            chunk = {table: {column: np.array(values[offsets[table]:ends[table][-1]])
+                             for column, values in self._columns[table].items()} for table in COUNTED}
+            if grid_index is not None:
+                for table, column in GRID_COLUMNS:
+                    chunk[table][column] = grid_index[chunk[table][column]]
+            starts = {table: ends[table] - steps[table] - offsets[table] for table in COUNTED}
+            for k in range(stop - start):
+                yield self._step(steps, chunk, {table: (int(starts[table][k]), int(starts[table][k] + steps[table][k]))
+                                                for table in COUNTED}, k)
+            offsets = {table: int(ends[table][-1]) for table in COUNTED}
+
+    @staticmethod
+    def _step(steps: Dict[str, np.ndarray], chunk: Dict[str, Dict[str, np.ndarray]],
+              bounds: Dict[str, Tuple[int, int]], k: int) -> LoggedStep:
+        def columns(table: str) -> Dict[str, np.ndarray]:
+            a, b = bounds[table]
+            return {column: values[a:b] for column, values in chunk[table].items()}
+
+        kind = int(steps['kind'][k])
+        batch, assigned, moves = None, None, None
+        if kind == DISPATCH_STEP:
+            rows, drivers, requests = columns('rows'), columns('drivers'), columns('requests')
+            batch = DispatchBatch(
+                drivers['driver_id'], requests['order_id'], rows['driver_idx'].astype(np.intp),
+                rows['request_idx'].astype(np.intp), rows['distance'], rows['eta'], drivers['coord'],
+                drivers['grid'].astype(np.intp), requests['start_coord'], requests['start_grid'].astype(np.intp),
+                requests['end_coord'], requests['end_grid'].astype(np.intp), requests['request_ts'],
+                requests['finish_ts'], requests['day_of_week'].astype(int), requests['reward'])
+            assigned = columns('assigned')['row'].astype(np.intp)
+        else:
+            moved = columns('moves')
+            moves = (moved['driver_id'], moved['grid'].astype(np.intp), moved['destination'].astype(np.intp))
+        return LoggedStep(kind, int(steps['timestamp'][k]), int(steps['day_of_week'][k]), bool(steps['flipped'][k]),
+                          batch, assigned, moves)
+
+
+def replay(log: StepLogReader, dispatcher: Dispatcher, chunk_steps: int = CHUNK_STEPS) -> int:
+    """ Learn from every logged dispatch step in order, as the dispatcher that logged them did online
+
+    Each step is scored on the values left by the previous one, so steps are applied one after the other;
+    within a step the TD updates are array operations, and no parsing or matching is repeated. Returns the
+    number of dispatch steps replayed.
+    """
+    grid_index = dispatcher.state_values.indices(log.grid_ids)
+    replayed = 0
+    for step in log.steps(chunk_steps, grid_index):
+        if step.kind == DISPATCH_STEP:
+            with METRICS.timer('steplog.replay'):
+                dispatcher.replay(step.batch, step.assigned, step.flipped)
+            replayed += 1
+        else:
+            # Online repositioning read the value of each driver's grid, which makes it present
+            dispatcher.state_values.resolve(step.moves[1])
+    dispatcher.flush()
+    return replayed
+
+
+def read_grid_ids(directory: str, truncate: bool = False) -> List[str]:
+    """ Grid ids of a log, dropping a partially written last line (and truncating it from the file if asked) """
+    path = os.path.join(directory, GRID_IDS)
+    if not os.path.exists(path):
+        return []
+    with open(path, 'rb') as f:
+        data = f.read()
+    complete = data[:data.rfind(b'\n') + 1]
+    if truncate and len(complete) < len(data):
+        os.truncate(path, len(complete))
+    return complete.decode().splitlines()
+
+
+def _path(directory: str, table: str, column: str) -> str:
+    return os.path.join(directory, f'{table}.{column}.bin')
+
+
+def _column(path: str, dtype: str, width: int) -> np.ndarray:
+    """ Read-only memory map of a column file, without a partially written last value """
+    itemsize = np.dtype(dtype).itemsize * width
+    n = os.path.getsize(path) // itemsize if os.path.exists(path) else 0
+    shape = (n, width) if width > 1 else (n,)
+    if n == 0:
+        return np.empty(shape, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='r', shape=shape)
+
+
+def _truncate_partial_step(directory: str) -> int:
+    """ Truncate every column to the rows of the complete steps; returns the number of steps """
+    steps = {column: _column(_path(directory, 'steps', column), dtype, width)
+             for column, dtype, width in COLUMNS['steps']}
+    n_steps = min(values.shape[0] for values in steps.values())
+    rows = dict(steps=n_steps)
+    for table in COUNTED:
+        rows[table] = int(np.sum(steps[table][:n_steps], dtype=np.int64))
+    del steps  # Release the memory maps before truncating
+    for table, columns in TABLES:
+        for column, dtype, width in columns:
+            path = _path(directory, table, column)
+            size = os.path.getsize(path) if os.path.exists(path) else 0
+            expected = rows[table] * np.dtype(dtype).itemsize * width
+            if size < expected:
+                raise ValueError(f'{path}: {size} bytes, the logged steps need {expected}')
+            if size > expected:
+                os.truncate(path, expected)
+    return n_steps
+
+
+def _write_schema(directory: str) -> None:
+    schema = dict(version=LOG_VERSION, tables={table: [[column, dtype, width] for column, dtype, width in columns]
+                                               for table, columns in TABLES})
+    with open(os.path.join(directory, SCHEMA), 'w') as f:
+        json.dump(schema, f)
+
+
+def _check_schema(directory: str) -> None:
+    path = os.path.join(directory, SCHEMA)
+    with open(path, 'r') as f:
+        schema = json.load(f)
+    if schema.get('version') != LOG_VERSION:
+        raise ValueError(f'{path}: unsupported step log version {schema.get("version")}')
@@ -0,0 +1,146 @@
+import copy
+import json
+import os
+import random
+import tempfile
+import unittest
+
+import numpy as np
+
+from agent import Agent
+import dispatch
+import parse
+import steplog
+
+
+SAMPLE_DIR = os.path.abspath('../samples')
+
+
+class FailingFile:
+    """ Column file whose writes fail, as on a full disk """
+    def __init__(self, f):
+        self.f = f
+
+    def write(self, data):
+        raise OSError('No space left on device')
+
+    def __getattr__(self, name):
+        return getattr(self.f, name)
+
+
+class StepLogTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        with open(os.path.join(SAMPLE_DIR, 'dispatch_observ'), 'r') as f:
+            cls.dispatch_observ = json.load(f)
+        with open(os.path.join(SAMPLE_DIR, 'repo_observ'), 'r') as f:
+            cls.repo_observ = json.load(f)
+
+    def observations(self, steps: int):
+        """ Sample dispatch observations with rewards and distances varied from step to step """
+        rng = random.Random(5)
+        for step in range(steps):
+            yield [dict(od, reward_units=od['reward_units'] * rng.uniform(0.5, 2),
+                        order_driver_distance=od['order_driver_distance'] * rng.uniform(0.5, 2),
+                        timestamp=od['timestamp'] + 2 * step) for od in self.dispatch_observ]
+
+    def test_agent_log_replays_to_same_values(self):
+        with tempfile.TemporaryDirectory() as directory:
+            agent = Agent(idle_reward=-2 / 3600, log_dir=directory)
+            actions = []
+            for observ in self.observations(4):
+                actions.append(agent.dispatch(observ))
+                actions.append(agent.reposition(self.repo_observ))
+            agent.step_log.close()
+
+            log = steplog.StepLogReader(directory)
+            assert len(log) == 8
+            for step, action in zip(log.steps(chunk_steps=3), actions):
+                if step.kind == steplog.DISPATCH_STEP:
+                    batch = step.batch
+                    rows = step.assigned
+                    assert [dict(order_id=int(batch.request_ids[r]), driver_id=int(batch.driver_ids[d]))
+                            for r, d in zip(batch.request_idx[rows], batch.driver_idx[rows])] == action
+                else:
+                    driver_ids, _, destination = step.moves
+                    assert [dict(driver_id=int(d), destination=log.grid_ids[g])
+                            for d, g in zip(driver_ids, destination)] == action
+
+            replayed = dispatch.Sarsa(agent.dispatcher.alpha, agent.dispatcher.gamma, agent.dispatcher.idle_reward)
+            assert steplog.replay(log, replayed, chunk_steps=3) == 4
+            online, n = agent.dispatcher.state_values, len(agent.dispatcher.state_values)
+            np.testing.assert_array_equal(replayed.state_values.values[:, :n], online.values[:, :n])
+            np.testing.assert_array_equal(replayed.state_values.present[:n], online.present[:n])
+
+    def test_dql_replays_coin_flips(self):
+        online = dispatch.Dql(2 / 300, 0.9, -2 / 3600)
+        with tempfile.TemporaryDirectory() as directory:
+            log = steplog.StepLog(directory)
+            for step, observ in enumerate(self.observations(6)):
+                random.seed(step)
+                batch = parse.parse_batch(observ)
+                assigned = online.dispatch_batch(batch)
+                log.dispatch(batch, assigned, online.state_values.ids, online.flipped)
+            log.close()
+
+            replayed = dispatch.Dql(2 / 300, 0.9, -2 / 3600)
+            steplog.replay(steplog.StepLogReader(directory), replayed)
+            n = len(online.state_values)
+            np.testing.assert_array_equal(replayed.state_values.values[:, :n], online.state_values.values[:, :n])
+            assert replayed.checkpoint_state() == online.checkpoint_state()
+
+    def test_partial_step_is_dropped(self):
+        batch = parse.parse_batch(self.dispatch_observ)
+        online = dispatch.Sarsa(2 / 300, 0.9, -2 / 3600)
+        with tempfile.TemporaryDirectory() as directory:
+            log = steplog.StepLog(directory)
+            log.dispatch(batch, online.dispatch_batch(batch), online.state_values.ids)
+            log.close()
+
+            # A step interrupted after some of its columns were written
+            with open(os.path.join(directory, 'rows.distance.bin'), 'ab') as f:
+                f.write(b'\0' * 12)
+            with open(os.path.join(directory, 'steps.kind.bin'), 'ab') as f:
+                f.write(b'\0')
+            assert len(steplog.StepLogReader(directory)) == 1
+
+            # Appending again truncates it
+            log = steplog.StepLog(directory)
+            assert log.steps == 1
+            log.dispatch(batch, online.dispatch_batch(batch), online.state_values.ids)
+            log.close()
+
+            replayed = dispatch.Sarsa(2 / 300, 0.9, -2 / 3600)
+            assert steplog.replay(steplog.StepLogReader(directory), replayed) == 2
+            n = len(online.state_values)
+            np.testing.assert_array_equal(replayed.state_values.values[:, :n], online.state_values.values[:, :n])
+
+    def test_failed_step_is_rolled_back(self):
+        batch = parse.parse_batch(self.dispatch_observ)
+        online = dispatch.Sarsa(2 / 300, 0.9, -2 / 3600)
+        with tempfile.TemporaryDirectory() as directory:
+            log = steplog.StepLog(directory)
+            assigned = online.dispatch_batch(batch)
+            log.dispatch(batch, assigned, online.state_values.ids)
+
+            # Ids that are not integers fail before anything is written
+            named = copy.copy(batch)
+            named.driver_ids = [f'driver-{driver_id}' for driver_id in batch.driver_ids]
+            with self.assertRaises(ValueError):
+                log.dispatch(named, assigned, online.state_values.ids)
+
+            # A write failing after the first tables were written is truncated away
+            key = ('requests', 'order_id')
+            log._files[key] = FailingFile(log._files[key])
+            with self.assertRaises(OSError):
+                log.dispatch(batch, assigned, online.state_values.ids)
+            log._files[key] = log._files[key].f
+            assert log.steps == 1
+            assert os.path.getsize(os.path.join(directory, 'rows.distance.bin')) == 8 * len(batch)
+
+            log.dispatch(batch, online.dispatch_batch(batch), online.state_values.ids)
+            log.close()
+            replayed = dispatch.Sarsa(2 / 300, 0.9, -2 / 3600)
+            assert steplog.replay(steplog.StepLogReader(directory), replayed) == 2
+            n = len(online.state_values)
+            np.testing.assert_array_equal(replayed.state_values.values[:, :n], online.state_values.values[:, :n])
@@ -0,0 +1,176 @@
+import csv
+from typing import Callable, Dict, Iterable, List, Set, Union
+
+import numpy as np
+
+
+GridKey = Union[str, int, np.ndarray]  # grid id, interned index, or array of interned indices
+# Rows of ValueTable.dirty, one per consumer of the written grids
+DIRTY_CHECKPOINT = 0
+DIRTY_TOP_VALUES = 1
+DIRTY_ROWS = 2
+
+
+def sequential_rounds(keys: np.ndarray) -> List[np.ndarray]:
+    """ Split positions into rounds of distinct keys, keeping the order of repeated keys
+
+    Applying a read-modify-write update round by round gives the same result as applying it position by
+    position, while each round can be applied as one array operation.
+    """
+    if keys.size == 0:
+        return []
+    order = np.argsort(keys, kind='stable')
+    first = np.r_[True, keys[order][1:] != keys[order][:-1]]
+    rank = np.empty(keys.size, dtype=int)
+    rank[order] = np.arange(keys.size) - np.maximum.accumulate(np.where(first, np.arange(keys.size), 0))
+    if rank.max() == 0:
+        return [np.arange(keys.size)]
+    return [np.flatnonzero(rank == r) for r in range(rank.max() + 1)]
+
+
+class ValueTable:
+    """ State values stored as dense float64 rows over interned grid indices
+
+    Indices follow the order of the grid ids the table is built with, so a table built from Grid.grid_ids
+    shares its indices with the Grid. Unseen grid ids are interned on first use and appended at the end.
+    Like the defaultdict it replaces, any grid that is read or written is reported by grid_ids(). Grids
+    written by add() are flagged dirty until take_dirty(), with one row of flags for each consumer: incremental
+    checkpoints and the TopValues index.
+    """
+    def __init__(self, grid_ids: Iterable[str], rows: int = 1):
+        self.ids = list(grid_ids)  # type: List[str]
+        self.index = {grid_id: i for i, grid_id in enumerate(self.ids)}  # type: Dict[str, int]
+        self.values = np.zeros((rows, max(len(self.ids), 1)), dtype=np.float64)
+        self.present = np.zeros(self.values.shape[1], dtype=bool)
+        self.dirty = np.zeros((DIRTY_ROWS, self.values.shape[1]), dtype=bool)
+
+    @staticmethod
+    def from_arrays(grid_ids: Iterable[str], values: np.ndarray, present: np.ndarray,
+                    dirty: np.ndarray = None) -> 'ValueTable':
+        """ Table over grid_ids using values (rows x at least len(grid_ids)), present and dirty as they are """
+        table = ValueTable(grid_ids, rows=0)
+        table.values = values
+        table.present = present
+        table.dirty = dirty if dirty is not None else np.zeros((DIRTY_ROWS, values.shape[1]), dtype=bool)
+        return table
+
+    def __len__(self):
+        return len(self.ids)
+
+    def intern(self, grid_id: str) -> int:
+        i = self.index.get(grid_id)
+        if i is None:
+            i = len(self.ids)
+            if i == self.values.shape[1]:
+                self._grow(2 * i)
+            self.ids.append(grid_id)
+            self.index[grid_id] = i
+        return i
+
+    def resolve(self, key: GridKey) -> Union[int, np.ndarray]:
+        """ Interned index (or index array) for key, marking it present """
+        if isinstance(key, str):
+            key = self.intern(key)
+        elif isinstance(key, np.ndarray):
+            key = key.astype(np.intp, copy=False)
+        self.present[key] = True
+        return key
+
+    def indices(self, grid_ids: Iterable[str]) -> np.ndarray:
+        return np.fromiter((self.intern(grid_id) for grid_id in grid_ids), dtype=np.intp)
+
+    def get(self, key: GridKey, row: int = 0) -> Union[float, np.ndarray]:
+        key = self.resolve(key)  # may grow self.values
+        return self.values[row, key]
+
+    def add(self, key: GridKey, delta: Union[float, np.ndarray], row: int = 0) -> None:
+        """ Add delta at key; repeated indices in an array accumulate like sequential updates """
+        key = self.resolve(key)  # may grow self.values
+        self.dirty[:, key] = True
+        if isinstance(key, np.ndarray):
+            np.add.at(self.values[row], key, delta)
+        else:
+            self.values[row, key] += delta
+
+    def row(self, row: int) -> np.ndarray:
+        """ View of one row over the interned grids """
+        return self.values[row, :len(self.ids)]
+
+    def grid_indices(self) -> np.ndarray:
+        return np.flatnonzero(self.present[:len(self.ids)])
+
+    def grid_ids(self) -> Set[str]:
+        return set(self.ids[i] for i in self.grid_indices())
+
+    def take_dirty(self, row: int = DIRTY_CHECKPOINT) -> np.ndarray:
+        """ Indices written since the last call for the same row, clearing their flags in that row """
+        dirty = np.flatnonzero(self.dirty[row, :len(self.ids)])
+        self.dirty[row, dirty] = False
+        return dirty
+
+    def load_csv(self, path: str) -> None:
+        """ Set every row from a grid_id,value csv """
+        with open(path, 'r') as csvfile:
+            for row in csv.reader(csvfile):
+                grid_id, value = row
+                i = self.resolve(grid_id)
+                self.values[:, i] = float(value)
+
+    def _grow(self, capacity: int) -> None:
+        values = np.zeros((self.values.shape[0], capacity), dtype=np.float64)
+        values[:, :self.values.shape[1]] = self.values
+        present = np.zeros(capacity, dtype=bool)
+        present[:self.present.size] = self.present
+        dirty = np.zeros((DIRTY_ROWS, capacity), dtype=bool)
+        dirty[:, :self.dirty.shape[1]] = self.dirty
+        self.values, self.present, self.dirty = values, present, dirty
+
+
+class TopValues:
+    """ Every grid whose value is at least threshold, kept up to date from the dirty flags of a ValueTable
+
+    Built from the k highest values, with threshold the k-th highest, so every grid outside the index has a
+    lower value. refresh() moves the grids written since the previous refresh in or out of the index, which
+    costs O(written grids + index size). The index is rebuilt from every grid only when it drifts below k / 2
+    or above 2 k grids, or when grids become present without being written. Values must only change through
+    ValueTable.add for the index to stay exact.
+    """
+    def __init__(self, table: ValueTable, value: Callable[[np.ndarray], np.ndarray], k: int):
+        self.table = table
+        self.value = value  # Value of an array of grid indices
+        self.k = k
+        self.grid_idx = np.empty(0, dtype=np.intp)  # Ascending
+        self.values = np.empty(0)
+        self.threshold = -np.inf  # -inf while the index holds every grid
+        self.rebuilds = 0
+        self._present = -1
+
+    def refresh(self) -> bool:
+        """ Bring the index up to date with the table; True if it was rebuilt """
+        written = self.table.take_dirty(DIRTY_TOP_VALUES)
+        present = int(np.count_nonzero(self.table.present))
+        if present == self._present:
+            kept = ~np.isin(self.grid_idx, written, assume_unique=True)
+            written_values = self.value(written)
+            entered = written_values >= self.threshold
+            grid_idx = np.concatenate([self.grid_idx[kept], written[entered]])
+            if self.threshold == -np.inf or self.k // 2 <= grid_idx.size <= 2 * self.k:
+                order = np.argsort(grid_idx)
+                self.grid_idx = grid_idx[order]
+                self.values = np.concatenate([self.values[kept], written_values[entered]])[order]
+                return False
+        self._rebuild(present)
+        return True
+
+    def _rebuild(self, present: int) -> None:
+        grid_idx = self.table.grid_indices()
+        values = self.value(grid_idx)
+        self.threshold = -np.inf
+        if grid_idx.size > self.k:
+            kth = grid_idx.size - self.k
+            self.threshold = np.partition(values, kth)[kth]
+            top = values >= self.threshold
+            grid_idx, values = grid_idx[top], values[top]
+        self.grid_idx, self.values = grid_idx, values
+        self._present = present
+        self.rebuilds += 1
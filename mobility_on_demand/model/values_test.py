@@ -0,0 +1,74 @@
+import unittest
+
+import numpy as np
+
+from values import TopValues, ValueTable, sequential_rounds
+
+
+class ValueTableTest(unittest.TestCase):
+    def test_scalar_and_array_keys(self):
+        table = ValueTable(['a', 'b', 'c'])
+        table.add('b', 1.5)
+        table.add(2, 0.5)
+        assert table.get('b') == 1.5
+        assert table.get(1) == 1.5
+        np.testing.assert_array_equal(table.get(np.array([0, 1, 2])), [0., 1.5, 0.5])
+
+        # Repeated indices accumulate
+        table.add(np.array([0, 0, 2]), np.array([1., 2., 3.]))
+        np.testing.assert_array_equal(table.row(0), [3., 1.5, 3.5])
+
+    def test_present_like_defaultdict(self):
+        table = ValueTable(['a', 'b', 'c'])
+        assert table.grid_ids() == set()
+        table.get('c')
+        table.add(0, 1.)
+        assert table.grid_ids() == {'a', 'c'}
+        np.testing.assert_array_equal(table.grid_indices(), [0, 2])
+
+    def test_intern_unknown(self):
+        table = ValueTable(['a'], rows=2)
+        table.add('z', 2., row=1)
+        table.add('y', 3.)
+        assert table.index['z'] == 1 and table.index['y'] == 2
+        assert table.get('z', 1) == 2. and table.get('z', 0) == 0.
+        assert table.get('a') == 0.
+        assert table.grid_ids() == {'a', 'y', 'z'}
+
+    def test_sequential_rounds(self):
+        keys = np.array([3, 1, 3, 2, 3, 1])
+        rounds = sequential_rounds(keys)
+        assert [r.tolist() for r in rounds] == [[0, 1, 3], [2, 5], [4]]
+
+        # Round by round read-modify-write matches a sequential loop
+        expected = np.arange(4, dtype=float)
+        for k in keys:
+            expected[k] = 0.5 * expected[k] + 1
+        actual = np.arange(4, dtype=float)
+        for r in rounds:
+            actual[keys[r]] = 0.5 * actual[keys[r]] + 1
+        np.testing.assert_array_equal(actual, expected)
+        assert sequential_rounds(np.empty(0, dtype=int)) == []
+
+    def test_top_values(self):
+        rng = np.random.RandomState(3)
+        table = ValueTable([str(i) for i in range(100)])
+        table.add(np.arange(100), rng.uniform(-1, 1, 100))
+        top = TopValues(table, table.get, 10)
+        assert top.refresh() and top.grid_idx.size == 10
+
+        def check():
+            values = table.get(np.arange(100))
+            np.testing.assert_array_equal(top.grid_idx, np.flatnonzero(values >= top.threshold))
+            np.testing.assert_array_equal(top.values, values[top.grid_idx])
+
+        # Small writes update the index in place, in and out
+        check()
+        table.add(np.array([int(top.grid_idx[0]), 50]), np.array([-5., 5.]))
+        assert not top.refresh()
+        check()
+
+        # Writes dropping most of the index rebuild it
+        table.add(top.grid_idx, np.full(top.grid_idx.size, -10.))
+        assert top.refresh() and top.rebuilds == 2
+        check()
@@ -0,0 +1,11 @@
+# -*- coding: utf-8 -*-
+# @File: __init__.py
+""" Asyncio HTTP front-end serving one Agent to many clients, and a load generator to exercise it """
+import os
+import sys
+
+
+# The folder contains the submission (agent.py and its dependencies)
+SUBMISSION_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'model')
+if SUBMISSION_DIR not in sys.path:
+    sys.path.append(SUBMISSION_DIR)
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+# @File: __main__.py
+""" Serve an Agent over HTTP: python -m serving [--port 8080 | --unix /tmp/agent.sock] """
+import argparse
+import asyncio
+
+from serving import SUBMISSION_DIR  # noqa: F401 (puts the submission on the import path)
+from agent import Agent
+import parse
+from serving.server import ADMISSION_TIMEOUT, PREPARE_THREADS, QUEUE_SIZE, AgentServer
+
+
+async def serve(server: AgentServer, host: str, port: int, path: str) -> None:
+    address = await server.start(host, port, path)
+    print(f'Serving on {address}', flush=True)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await server.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--unix', help='listen on this unix socket path instead of host:port')
+    parser.add_argument('--queue-size', type=int, default=QUEUE_SIZE)
+    parser.add_argument('--admission-timeout', type=float, default=ADMISSION_TIMEOUT)
+    parser.add_argument('--prepare-threads', type=int, default=PREPARE_THREADS)
+    parser.add_argument('--learning', default='sync', choices=['sync', 'deferred', 'background'])
+    parser.add_argument('--checkpoint-dir')
+    parser.add_argument('--log', help='step log directory for train_offline.py')
+    args = parser.parse_args()
+
+    parse.HEX_GRID.kdtree  # Load the grid before the first request
+    agent = Agent(learning=args.learning, checkpoint_dir=args.checkpoint_dir, log_dir=args.log)
+    server = AgentServer(agent, args.queue_size, args.admission_timeout, args.prepare_threads)
+    try:
+        asyncio.run(serve(server, args.host, args.port, args.unix))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+# @File: loadgen.py
+""" Load generator for the agent server: python -m serving.loadgen --address 127.0.0.1:8080
+
+Each step posts one dispatch observation and a burst of reposition calls for the same timestamp, split
+over the drivers, all at once; --concurrency steps run at the same time on their own connections. Latency
+percentiles and status counts are reported per endpoint.
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from serving import SUBMISSION_DIR  # noqa: F401 (puts the submission on the import path)
+import parse
+
+BENCHMARKS_DIR = os.path.join(os.path.dirname(SUBMISSION_DIR), 'benchmarks')
+sys.path.append(BENCHMARKS_DIR)
+from observations import TIMESTAMP, dispatch_observation, reposition_observation  # noqa: E402
+
+
+class Client:
+    """ HTTP/1.1 keep-alive client over one connection to host:port, or to a unix socket path """
+    def __init__(self, address: str):
+        self.address = address
+        self.reader = None  # type: asyncio.StreamReader
+        self.writer = None  # type: asyncio.StreamWriter
+
+    async def connect(self) -> None:
+        if '/' in self.address:
+            self.reader, self.writer = await asyncio.open_unix_connection(self.address)
+        else:
+            host, port = self.address.rsplit(':', 1)
+            self.reader, self.writer = await asyncio.open_connection(host, int(port))
+
+    async def request(self, method: str, path: str, body: bytes = b'') -> Tuple[int, bytes]:
+        """ Status and body of the response """
+        if self.writer is None:
+            await self.connect()
+        self.writer.write(f'{method} {path} HTTP/1.1\r\nHost: agent\r\nContent-Length: {len(body)}\r\n\r\n'.encode()
+                          + body)
+        await self.writer.drain()
+        head = (await self.reader.readuntil(b'\r\n\r\n')).decode('latin-1').split('\r\n')
+        status = int(head[0].split(' ')[1])
+        headers = {name.strip().lower(): value.strip() for name, _, value in
+                   (line.partition(':') for line in head[1:] if line)}
+        response = await self.reader.readexactly(int(headers.get('content-length', 0)))
+        if headers.get('connection', '').lower() == 'close':
+            await self.close()
+        return status, response
+
+    async def post(self, path: str, observation) -> Tuple[int, object]:
+        status, response = await self.request('POST', path, json.dumps(observation).encode())
+        return status, json.loads(response)
+
+    async def close(self) -> None:
+        if self.writer is not None:
+            self.writer.close()
+            self.writer, self.reader = None, None
+
+
+class LoadReport:
+    def __init__(self):
+        self.latency = {endpoint: [] for endpoint in ('dispatch', 'reposition')}  # type: Dict[str, List[float]]
+        self.status = {endpoint: dict() for endpoint in self.latency}  # type: Dict[str, Dict[int, int]]
+        self.seconds = 0.
+
+    def add(self, endpoint: str, status: int, seconds: float) -> None:
+        self.status[endpoint][status] = self.status[endpoint].get(status, 0) + 1
+        if status == 200:
+            self.latency[endpoint].append(seconds)
+
+    def __str__(self):
+        lines = []
+        for endpoint, latency in self.latency.items():
+            requests = sum(self.status[endpoint].values())
+            line = f'{endpoint:<11}{requests:>7} requests {requests / max(self.seconds, 1e-9):>8.1f}/s'
+            if latency:
+                p50, p90, p99 = np.percentile(np.array(latency) * 1000, [50, 90, 99]).tolist()
+                line += f'  p50 {p50:.2f}ms p90 {p90:.2f}ms p99 {p99:.2f}ms'
+            lines.append(line + f'  status {dict(sorted(self.status[endpoint].items()))}')
+        return '\n'.join(lines)
+
+
+def step_bodies(steps: int, rows: int, drivers: int, reposition_calls: int,
+                seed: int = 0) -> List[List[Tuple[str, bytes]]]:
+    """ Encoded requests of each step: one dispatch, then reposition calls sharing the step timestamp """
+    bodies = []
+    for step in range(steps):
+        timestamp = TIMESTAMP + 2 * step
+        dispatch = dispatch_observation(parse.HEX_GRID, rows, drivers, seed=seed + step, timestamp=timestamp)
+        reposition = reposition_observation(parse.HEX_GRID, drivers, seed=seed + step, timestamp=timestamp)
+        requests = [('/dispatch', json.dumps(dispatch).encode())]
+        for k in range(reposition_calls):
+            part = dict(reposition, driver_info=reposition['driver_info'][k::reposition_calls])
+            requests.append(('/reposition', json.dumps(part).encode()))
+        bodies.append(requests)
+    return bodies
+
+
+async def run_load(address: str, bodies: List[List[Tuple[str, bytes]]], concurrency: int = 1) -> LoadReport:
+    """ Send every step, concurrency steps at a time, each request of a step on its own connection """
+    report = LoadReport()
+    width = max(len(requests) for requests in bodies)
+    clients = [[Client(address) for _ in range(width)] for _ in range(concurrency)]
+
+    async def send(client: Client, path: str, body: bytes) -> None:
+        start = time.perf_counter()
+        status, _ = await client.request('POST', path, body)
+        report.add(path.strip('/'), status, time.perf_counter() - start)
+
+    async def lane(k: int) -> None:
+        for requests in bodies[k::concurrency]:
+            await asyncio.gather(*[send(client, path, body) for client, (path, body) in zip(clients[k], requests)])
+
+    start = time.perf_counter()
+    try:
+        await asyncio.gather(*[lane(k) for k in range(concurrency)])
+    finally:
+        report.seconds = time.perf_counter() - start
+        for lane_clients in clients:
+            for client in lane_clients:
+                await client.close()
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--address', default='127.0.0.1:8080', help='host:port or unix socket path')
+    parser.add_argument('--steps', type=int, default=100)
+    parser.add_argument('--rows', type=int, default=1000, help='candidate rows per dispatch')
+    parser.add_argument('--drivers', type=int, default=100, help='drivers per step')
+    parser.add_argument('--reposition-calls', type=int, default=4, help='reposition calls per step')
+    parser.add_argument('--concurrency', type=int, default=1, help='steps in flight')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    bodies = step_bodies(args.steps, args.rows, args.drivers, args.reposition_calls, args.seed)
+    report = asyncio.run(run_load(args.address, bodies, args.concurrency))
+    print(report)
+    status, metrics = asyncio.run(_metrics(args.address))
+    if status == 200:
+        print(metrics.decode())
+
+
+async def _metrics(address: str) -> Tuple[int, bytes]:
+    client = Client(address)
+    try:
+        return await client.request('GET', '/metrics')
+    finally:
+        await client.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,306 @@
+# -*- coding: utf-8 -*-
+# @File: server.py
+""" HTTP/1.1 server in front of one stateful Agent
+
+POST /dispatch and POST /reposition take the observations of Agent.dispatch and Agent.reposition as json and
+answer with the actions as json; GET /metrics answers with Prometheus text and GET /health with ok.
+"""
+import asyncio
+import concurrent.futures
+import json
+import time
+from typing import Any, Dict, List, Tuple
+
+from serving import SUBMISSION_DIR  # noqa: F401 (puts the submission on the import path)
+from agent import Agent
+from metrics import METRICS, Metrics
+import parse
+
+
+QUEUE_SIZE = 64  # Calls admitted and waiting for the agent
+ADMISSION_TIMEOUT = 1.  # Seconds a call waits for room in the queue before it is answered 503
+PREPARE_THREADS = 4
+MAX_HEADER = 1 << 16
+MAX_BODY = 1 << 28
+ENDPOINTS = ('dispatch', 'reposition')
+REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed', 413: 'Payload Too Large',
+           500: 'Internal Server Error', 503: 'Service Unavailable'}
+
+
+class HttpError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+class Call:
+    """ One dispatch or reposition observation waiting for the agent """
+    __slots__ = ('endpoint', 'data', 'future', 'admitted')
+
+    def __init__(self, endpoint: str, data: Any, future: asyncio.Future):
+        self.endpoint = endpoint
+        self.data = data  # DispatchBatch or RepositionData
+        self.future = future
+        self.admitted = time.perf_counter()
+
+
+class AgentServer:
+    """ Serves one Agent to concurrent clients without blocking the event loop
+
+    Each request goes through three stages:
+
+    1. The body is decoded and parsed (grid lookups included) on a pool of prepare threads.
+    2. The parsed call waits in a bounded queue. When the queue is full, the request waits up to
+       admission_timeout for room and is then answered 503, so a burst slows clients down instead of
+       piling up work.
+    3. A single consumer hands calls to the agent one at a time on its own thread, in arrival order. Reposition
+       calls queued back to back for the same timestamp are coalesced into one Agent.reposition over all their
+       drivers, which gives every driver the destination it would get alone.
+
+    Responses are encoded on the prepare threads. Per-endpoint latency of each stage, queue depth at
+    admission and request counters are kept in metrics, and GET /metrics renders them with the agent's own
+    METRICS when those are enabled.
+    """
+    def __init__(self, agent: Agent, queue_size: int = QUEUE_SIZE, admission_timeout: float = ADMISSION_TIMEOUT,
+                 prepare_threads: int = PREPARE_THREADS, max_body: int = MAX_BODY):
+        self.agent = agent
+        self.queue_size = queue_size
+        self.admission_timeout = admission_timeout
+        self.max_body = max_body
+        self.metrics = Metrics(enabled=True)
+        self.queue = None  # type: asyncio.Queue
+        self._prepare = concurrent.futures.ThreadPoolExecutor(prepare_threads, 'serving-prepare')
+        self._agent_thread = concurrent.futures.ThreadPoolExecutor(1, 'serving-agent')
+        self._consumer = None  # type: asyncio.Task
+        self._servers = []  # type: List[asyncio.AbstractServer]
+
+    async def start(self, host: str = '127.0.0.1', port: int = 0, path: str = None) -> str:
+        """ Listen on host:port, or on the unix socket path if given; returns the address listened on """
+        if self.queue is None:
+            self.queue = asyncio.Queue(self.queue_size)
+            self._consumer = asyncio.get_running_loop().create_task(self._consume())
+        if path:
+            server = await asyncio.start_unix_server(self._connection, path, limit=MAX_HEADER)
+            address = path
+        else:
+            server = await asyncio.start_server(self._connection, host, port, limit=MAX_HEADER)
+            address = '%s:%d' % server.sockets[0].getsockname()[:2]
+        self._servers.append(server)
+        return address
+
+    async def close(self) -> None:
+        for server in self._servers:
+            server.close()
+            await server.wait_closed()
+        self._servers = []
+        if self._consumer is not None:
+            self._consumer.cancel()
+            try:
+                await self._consumer
+            except asyncio.CancelledError:
+                pass
+            self._consumer = None
+        while self.queue is not None and not self.queue.empty():
+            call = self.queue.get_nowait()
+            call.future.set_exception(HttpError(503, 'server closed'))
+        self._prepare.shutdown()
+        self._agent_thread.shutdown()
+
+    async def _connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        """ Answer the requests of one keep-alive connection in order """
+        try:
+            while True:
+                try:
+                    request = await _read_request(reader, self.max_body)
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    break
+                except HttpError as e:
+                    await _write_response(writer, e.status, _error_body(e), close=True)
+                    break
+                method, path, body, keep_alive = request
+                status, response = await self._handle(method, path, body)
+                await _write_response(writer, status, response, close=not keep_alive,
+                                      text=status == 200 and (path.startswith('/metrics') or path == '/health'))
+                if not keep_alive:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def _handle(self, method: str, path: str, body: bytes) -> Tuple[int, bytes]:
+        endpoint = path.strip('/')
+        if endpoint == 'health':
+            return 200, b'ok\n'
+        if endpoint == 'metrics':
+            try:
+                return 200, self.render_metrics().encode()
+            except Exception as e:
+                return self._failed(endpoint, e)
+        if endpoint not in ENDPOINTS:
+            return 404, _error_body(HttpError(404, f'no endpoint {path}'))
+        if method != 'POST':
+            return 405, _error_body(HttpError(405, f'{path} takes POST'))
+
+        loop = asyncio.get_running_loop()
+        start = time.perf_counter()
+        self.metrics.count(f'serving.{endpoint}.requests')
+        try:
+            data = await loop.run_in_executor(self._prepare, _prepare, endpoint, body)
+            self.metrics.record(f'serving.{endpoint}.prepare', time.perf_counter() - start)
+            call = Call(endpoint, data, loop.create_future())
+            await self._admit(call)
+            actions = await call.future
+            response = await loop.run_in_executor(self._prepare, _encode, actions)
+        except Exception as e:
+            return self._failed(endpoint, e)
+        self.metrics.record(f'serving.{endpoint}', time.perf_counter() - start)
+        return 200, response
+
+    def _failed(self, endpoint: str, e: Exception) -> Tuple[int, bytes]:
+        """ Status and body answering a request to endpoint that raised e: its own status for an HttpError, 500
+        otherwise """
+        if not isinstance(e, HttpError):
+            e = HttpError(500, f'{type(e).__name__}: {e}')
+        self.metrics.count(f'serving.{endpoint}.status_{e.status}')
+        return e.status, _error_body(e)
+
+    async def _admit(self, call: Call) -> None:
+        """ Queue the call, waiting up to admission_timeout for room """
+        self.metrics.observe('serving.queue_depth', self.queue.qsize())
+        try:
+            self.queue.put_nowait(call)
+        except asyncio.QueueFull:
+            try:
+                await asyncio.wait_for(self.queue.put(call), self.admission_timeout)
+            except asyncio.TimeoutError:
+                raise HttpError(503, f'agent queue full ({self.queue_size} calls)') from None
+        call.admitted = time.perf_counter()
+
+    async def _consume(self) -> None:
+        """ Hand queued calls to the agent one at a time, coalescing reposition bursts
+
+        When close cancels it, the calls it took from the queue but has not answered are failed with 503.
+        """
+        loop = asyncio.get_running_loop()
+        calls = []  # type: List[Call]
+        held = None  # type: Call  # Taken from the queue while coalescing, but not coalesced
+        try:
+            while True:
+                calls = [held if held is not None else await self.queue.get()]
+                held = None
+                if calls[0].endpoint == 'reposition':
+                    while not self.queue.empty():
+                        call = self.queue.get_nowait()
+                        if call.endpoint != 'reposition' or not _same_step(call.data, calls[0].data):
+                            held = call
+                            break
+                        calls.append(call)
+                    self.metrics.count('serving.reposition.coalesced', len(calls) - 1)
+
+                start = time.perf_counter()
+                for call in calls:
+                    self.metrics.record(f'serving.{call.endpoint}.queue_wait', start - call.admitted)
+                try:
+                    results = await loop.run_in_executor(self._agent_thread, self._run_agent, calls)
+                except Exception as e:
+                    for call in calls:
+                        if not call.future.done():
+                            call.future.set_exception(e)
+                    continue
+                self.metrics.record(f'serving.{calls[0].endpoint}.agent', time.perf_counter() - start)
+                for call, result in zip(calls, results):
+                    if not call.future.done():
+                        call.future.set_result(result)
+        except asyncio.CancelledError:
+            for call in calls + ([held] if held is not None else []):
+                if not call.future.done():
+                    call.future.set_exception(HttpError(503, 'server closed'))
+            raise
+
+    def _run_agent(self, calls: List[Call]) -> List[List[Dict[str, str]]]:
+        """ Actions for each call, from one agent call; runs on the agent thread """
+        if calls[0].endpoint == 'dispatch':
+            return [self.agent.dispatch_batch(calls[0].data)]
+        if len(calls) == 1:
+            return [self.agent.reposition_data(calls[0].data)]
+        merged = parse.RepositionData(dict(timestamp=calls[0].data.timestamp, day_of_week=calls[0].data.day_of_week,
+                                           driver_info=[]))
+        merged.drivers = [driver for call in calls for driver in call.data.drivers]
+        actions = self.agent.reposition_data(merged)
+        results, start = [], 0
+        for call in calls:
+            results.append(actions[start:start + len(call.data.drivers)])
+            start += len(call.data.drivers)
+        return results
+
+    def render_metrics(self) -> str:
+        """ Prometheus text of the server metrics, and of the agent metrics when enabled """
+        text = self.metrics.to_prometheus(prefix='agent')
+        if METRICS.enabled:
+            text += METRICS.to_prometheus()
+        return text
+
+
+def _prepare(endpoint: str, body: bytes) -> Any:
+    """ Decoded and parsed observation; runs on a prepare thread """
+    try:
+        observation = json.loads(body)
+        if endpoint == 'dispatch':
+            return parse.parse_batch(observation)
+        return parse.RepositionData(observation)
+    except (ValueError, KeyError, TypeError) as e:
+        raise HttpError(400, f'bad {endpoint} observation: {type(e).__name__}: {e}') from None
+
+
+def _encode(actions: List[Dict[str, str]]) -> bytes:
+    return json.dumps(actions).encode()
+
+
+def _same_step(a: parse.RepositionData, b: parse.RepositionData) -> bool:
+    return a.timestamp == b.timestamp and a.day_of_week == b.day_of_week
+
+
+def _error_body(e: HttpError) -> bytes:
+    return json.dumps(dict(error=str(e))).encode()
+
+
+async def _read_request(reader: asyncio.StreamReader, max_body: int) -> Tuple[str, str, bytes, bool]:
+    """ Method, path, body and keep-alive flag of the next request on the connection """
+    try:
+        head = await reader.readuntil(b'\r\n\r\n')
+    except asyncio.LimitOverrunError:
+        raise HttpError(413, 'request header too large') from None
+    lines = head.decode('latin-1').split('\r\n')
+    try:
+        method, path, version = lines[0].split(' ')
+    except ValueError:
+        raise HttpError(400, f'bad request line {lines[0]!r}') from None
+    headers = dict()  # type: Dict[str, str]
+    for line in lines[1:]:
+        if line:
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+    if 'chunked' in headers.get('transfer-encoding', ''):
+        raise HttpError(400, 'chunked requests are not supported, send Content-Length')
+    try:
+        length = int(headers.get('content-length', 0))
+    except ValueError:
+        raise HttpError(400, f'bad Content-Length {headers["content-length"]!r}') from None
+    if length < 0:
+        raise HttpError(400, f'bad Content-Length {length}')
+    if length > max_body:
+        raise HttpError(413, f'request body over {max_body} bytes')
+    body = await reader.readexactly(length) if length else b''
+    connection = headers.get('connection', '').lower()
+    keep_alive = connection == 'keep-alive' if version == 'HTTP/1.0' else connection != 'close'
+    return method, path, body, keep_alive
+
+
+async def _write_response(writer: asyncio.StreamWriter, status: int, body: bytes, close: bool = False,
+                          text: bool = False) -> None:
+    content_type = 'text/plain; version=0.0.4' if text else 'application/json'
+    head = (f'HTTP/1.1 {status} {REASONS.get(status, "")}\r\nContent-Type: {content_type}\r\n'
+            f'Content-Length: {len(body)}\r\nConnection: {"close" if close else "keep-alive"}\r\n\r\n')
+    writer.write(head.encode() + body)
+    await writer.drain()
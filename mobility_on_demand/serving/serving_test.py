@@ -0,0 +1,168 @@
+import asyncio
+import json
+import os
+import threading
+import unittest
+
+from serving import SUBMISSION_DIR  # noqa: F401
+from agent import Agent
+from serving.loadgen import Client, run_load, step_bodies
+from serving.server import AgentServer
+
+
+SAMPLE_DIR = os.path.join(os.path.dirname(SUBMISSION_DIR), 'samples')
+
+
+class ServingTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        with open(os.path.join(SAMPLE_DIR, 'dispatch_observ'), 'r') as f:
+            cls.dispatch_observ = json.load(f)
+        with open(os.path.join(SAMPLE_DIR, 'repo_observ'), 'r') as f:
+            cls.repo_observ = json.load(f)
+
+    def serve(self, test, **kwargs):
+        """ Run test(server, address) against a server over a fresh Agent """
+        async def run():
+            server = AgentServer(Agent(), **kwargs)
+            address = await server.start()
+            try:
+                return await test(server, address)
+            finally:
+                await server.close()
+        return asyncio.run(run())
+
+    @staticmethod
+    async def post(address: str, path: str, observation):
+        client = Client(address)
+        try:
+            return await client.post(path, observation)
+        finally:
+            await client.close()
+
+    @staticmethod
+    def block_agent(server: AgentServer) -> threading.Event:
+        """ Hold the agent thread until the returned event is set """
+        release = threading.Event()
+        server._agent_thread.submit(release.wait)
+        return release
+
+    @staticmethod
+    async def wait_for_queue(server: AgentServer, depth: int) -> None:
+        while server.queue.qsize() < depth:
+            await asyncio.sleep(0.01)
+
+    def test_matches_agent(self):
+        agent = Agent()
+        expected = [(agent.dispatch(self.dispatch_observ), agent.reposition(self.repo_observ)) for _ in range(3)]
+
+        async def test(server, address):
+            client = Client(address)
+            actual = []
+            for _ in range(3):
+                dispatch_status, dispatched = await client.post('/dispatch', self.dispatch_observ)
+                reposition_status, repositioned = await client.post('/reposition', self.repo_observ)
+                assert dispatch_status == reposition_status == 200
+                actual.append((dispatched, repositioned))
+            status, response = await client.request('GET', '/metrics')
+            await client.close()
+            return actual, status, response.decode()
+
+        actual, status, metrics = self.serve(test)
+        assert actual == expected
+        assert status == 200
+        assert 'agent_serving_dispatch_count 3' in metrics and 'agent_serving_queue_depth_count 6' in metrics
+
+    def test_coalesces_reposition_burst(self):
+        drivers = self.repo_observ['driver_info']
+        parts = [dict(self.repo_observ, driver_info=drivers[k::3]) for k in range(3)]
+        expected = [Agent().reposition(part) for part in parts]
+
+        async def test(server, address):
+            release = self.block_agent(server)
+            first = asyncio.ensure_future(self.post(address, '/reposition', self.repo_observ))
+            await asyncio.sleep(0.2)  # Taken by the consumer, waiting for the agent
+            burst = [asyncio.ensure_future(self.post(address, '/reposition', part)) for part in parts]
+            await self.wait_for_queue(server, len(parts))
+            release.set()
+            await first
+            return await asyncio.gather(*burst), server.metrics.counters['serving.reposition.coalesced']
+
+        responses, coalesced = self.serve(test)
+        assert [actions for _, actions in responses] == expected
+        assert coalesced == len(parts) - 1
+
+    def test_full_queue_answers_503(self):
+        async def test(server, address):
+            release = self.block_agent(server)
+            calls = [asyncio.ensure_future(self.post(address, '/dispatch', self.dispatch_observ)) for _ in range(4)]
+            await self.wait_for_queue(server, 1)
+            await asyncio.sleep(0.2)  # The calls past the queue time out
+            release.set()
+            return [status for status, _ in await asyncio.gather(*calls)]
+
+        statuses = self.serve(test, queue_size=1, admission_timeout=0.05)
+        assert sorted(statuses) == [200, 200, 503, 503], statuses
+
+    def test_close_fails_calls_in_flight(self):
+        async def test(server, address):
+            release = self.block_agent(server)
+            calls = [asyncio.ensure_future(self.post(address, '/dispatch', self.dispatch_observ))]
+            while not server.metrics.histograms['serving.dispatch.queue_wait'].count:  # Until it waits on the agent
+                await asyncio.sleep(0.01)
+            calls.append(asyncio.ensure_future(self.post(address, '/dispatch', self.dispatch_observ)))
+            await self.wait_for_queue(server, 1)
+            threading.Timer(0.2, release.set).start()  # So that close can shut the agent thread down
+            await server.close()
+            return [status for status, _ in await asyncio.wait_for(asyncio.gather(*calls), 5)]
+
+        assert self.serve(test) == [503, 503]
+
+    def test_bad_requests(self):
+        async def test(server, address):
+            client = Client(address)
+            statuses = [(await client.request('POST', '/dispatch', b'{'))[0],
+                        (await client.request('GET', '/dispatch'))[0],
+                        (await client.request('POST', '/nowhere', b'{}'))[0],
+                        (await client.request('GET', '/health'))[0]]
+            await client.close()
+            return statuses
+
+        assert self.serve(test) == [400, 405, 404, 200]
+
+    def test_bad_content_length_answers_400(self):
+        async def test(server, address):
+            statuses = []
+            for length in ['abc', '-5']:
+                reader, writer = await asyncio.open_connection(*address.rsplit(':', 1))
+                writer.write(f'POST /dispatch HTTP/1.1\r\nContent-Length: {length}\r\n\r\n'.encode())
+                await writer.drain()
+                statuses.append(int((await reader.readline()).split()[1]))
+                writer.close()
+            return statuses
+
+        assert self.serve(test) == [400, 400]
+
+    def test_metrics_error_answers_500(self):
+        async def test(server, address):
+            def render_metrics():
+                raise RuntimeError('broken exporter')
+            server.render_metrics = render_metrics
+            client = Client(address)
+            status, response = await client.request('GET', '/metrics')
+            health = (await client.request('GET', '/health'))[0]  # The connection is still open
+            await client.close()
+            return status, json.loads(response), health, server.metrics.counters['serving.metrics.status_500']
+
+        status, response, health, errors = self.serve(test)
+        assert status == 500 and 'broken exporter' in json.dumps(response) and health == 200 and errors == 1
+
+    def test_load(self):
+        bodies = step_bodies(steps=6, rows=200, drivers=40, reposition_calls=3)
+
+        async def test(server, address):
+            return await run_load(address, bodies, concurrency=2)
+
+        report = self.serve(test)
+        assert report.status == dict(dispatch={200: 6}, reposition={200: 18}), report.status
+        assert len(report.latency['dispatch']) == 6
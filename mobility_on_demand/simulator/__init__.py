@@ -0,0 +1,11 @@
+# -*- coding: utf-8 -*-
+# @File: __init__.py
+""" Offline event-driven ride-hailing simulator for driving an Agent end to end """
+import os
+import sys
+
+
+# The folder contains the submission (agent.py and its dependencies)
+SUBMISSION_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'model')
+if SUBMISSION_DIR not in sys.path:
+    sys.path.append(SUBMISSION_DIR)
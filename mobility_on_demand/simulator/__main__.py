@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+# @File: __main__.py
+""" Run a simulated day: python -m simulator [--orders N] [--drivers N] [--replay orders.csv] """
+import argparse
+import json
+
+from simulator import SUBMISSION_DIR  # noqa: F401 (puts the submission on the import path)
+from agent import Agent
+import parse
+from simulator.engine import SimulationConfig, Simulator
+from simulator.fleet import synthetic_fleet
+from simulator.orders import load_orders, synthetic_orders
+
+
+START_TS = 1477929600  # 2016-11-01 00:00 GMT+8
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--orders', type=int, default=200000)
+    parser.add_argument('--drivers', type=int, default=20000)
+    parser.add_argument('--hours', type=float, default=24.)
+    parser.add_argument('--start', type=int, default=START_TS)
+    parser.add_argument('--replay', help='GAIA order csv to replay instead of synthetic orders')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--learning', default='sync', choices=['sync', 'deferred', 'background'],
+                        help='when the agent applies its TD updates (see dispatch.Dispatcher)')
+    parser.add_argument('--log', help='step log directory for train_offline.py')
+    parser.add_argument('--json', action='store_true', help='print the report as json')
+    args = parser.parse_args()
+
+    seconds = int(args.hours * 3600)
+    if args.replay:
+        orders = load_orders(args.replay)
+    else:
+        orders = synthetic_orders(parse.HEX_GRID, args.orders, args.start, seconds, args.seed)
+    fleet = synthetic_fleet(parse.HEX_GRID, args.drivers, args.seed)
+    agent = Agent(learning=args.learning, log_dir=args.log)
+    simulator = Simulator(agent, orders, fleet, parse.HEX_GRID, SimulationConfig(seed=args.seed))
+    report = simulator.run(args.start, args.start + seconds)
+    if args.json:
+        print(json.dumps(report.to_dict(), indent=2))
+    else:
+        print(f"{args.start} +{args.hours}h: {report}")
+
+
+if __name__ == '__main__':
+    main()
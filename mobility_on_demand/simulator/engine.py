@@ -0,0 +1,239 @@
+import time
+from typing import Any, Dict, List
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+from dispatch import STEP_SECONDS, completion_rate
+from grid import Grid, LNG_FACTOR, METERS_PER_DEGREE
+from simulator.events import EventQueue
+from simulator.fleet import BUSY, REPOSITIONING, Fleet
+from simulator.orders import OrderStream
+
+
+class SimulationConfig:
+    def __init__(self, step_seconds: int = STEP_SECONDS, order_patience: int = 120, dispatch_radius: float = 2000.,
+                 max_candidates: int = 10, pickup_speed: float = 3., reposition_interval: int = 300,
+                 reposition_fraction: float = 0.5, reposition_speed: float = 6., idle_transition_seconds: int = 60,
+                 seed: int = 0):
+        self.step_seconds = step_seconds
+        self.order_patience = order_patience  # Seconds an unanswered order waits before it expires
+        self.dispatch_radius = dispatch_radius  # Meters between a driver and an order start to be a candidate
+        self.max_candidates = max_candidates  # Nearest idle drivers offered per order
+        self.pickup_speed = pickup_speed  # Meters per second to the pickup, for pick_up_eta
+        self.reposition_interval = reposition_interval
+        self.reposition_fraction = reposition_fraction  # Share of idle drivers in the reposition treatment group
+        self.reposition_speed = reposition_speed
+        self.idle_transition_seconds = idle_transition_seconds
+        self.seed = seed
+
+
+class SimulationReport:
+    def __init__(self):
+        self.orders = 0
+        self.answered = 0
+        self.cancelled = 0
+        self.expired = 0
+        self.gmv = 0.
+        self.steps = 0
+        self.candidates = 0
+        self.dispatch_latency = []  # type: List[float]
+        self.reposition_latency = []  # type: List[float]
+        self.elapsed = 0.
+
+    @property
+    def answer_rate(self) -> float:
+        return self.answered / max(self.orders, 1)
+
+    @staticmethod
+    def percentiles(latency: List[float]) -> Dict[str, float]:
+        if not latency:
+            return dict(p50=0., p90=0., p99=0., max=0.)
+        p50, p90, p99, p100 = np.percentile(np.array(latency) * 1000, [50, 90, 99, 100]).tolist()
+        return dict(p50=p50, p90=p90, p99=p99, max=p100)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return dict(orders=self.orders, answered=self.answered, cancelled=self.cancelled, expired=self.expired,
+                    answer_rate=self.answer_rate, gmv=self.gmv, steps=self.steps, candidates=self.candidates,
+                    dispatch_ms=self.percentiles(self.dispatch_latency),
+                    reposition_ms=self.percentiles(self.reposition_latency), elapsed=self.elapsed)
+
+    def __repr__(self):
+        dispatch_ms = self.percentiles(self.dispatch_latency)
+        return (f'answer rate {self.answer_rate:.4f} ({self.answered}/{self.orders}), GMV {self.gmv:.1f}, '
+                f'dispatch p50 {dispatch_ms["p50"]:.2f}ms p99 {dispatch_ms["p99"]:.2f}ms over {self.steps} steps')
+
+
+class Simulator:
+    """ Steps an Agent through an order stream at step_seconds resolution
+
+    Each step releases drivers whose trips or repositions end, offers every pending order to its nearest
+    idle drivers and calls agent.dispatch. Assigned orders are cancelled with probability
+    1 - completion_rate(distance), otherwise the driver is busy until the pickup plus the trip is done.
+    Idle drivers follow the idle transition probabilities, and a share of them is handed to agent.reposition
+    every reposition_interval seconds.
+    """
+    def __init__(self, agent, orders: OrderStream, fleet: Fleet, grid: Grid, config: SimulationConfig = None):
+        self.agent = agent
+        self.orders = orders
+        self.fleet = fleet
+        self.grid = grid
+        self.config = config or SimulationConfig()
+        self.rng = np.random.RandomState(self.config.seed)
+        self.events = EventQueue()
+        self.pending = np.empty(0, dtype=int)
+        self.report = SimulationReport()
+        self.origin = None  # type: int
+
+    def run(self, start_ts: int, end_ts: int) -> SimulationReport:
+        """ Step from start_ts to end_ts; later calls continue the same simulation from where it stopped """
+        started = time.perf_counter()
+        step_seconds = self.config.step_seconds
+        if self.origin is None:
+            self.origin = start_ts
+            self.fleet.idle_since[:] = start_ts
+        for timestamp in range(start_ts, end_ts, step_seconds):
+            self.step((timestamp - self.origin) // step_seconds, timestamp)
+        self.report.elapsed += time.perf_counter() - started
+        return self.report
+
+    def step(self, step: int, timestamp: int) -> None:
+        config = self.config
+        self.fleet.arrive(self.events.pop(step), timestamp, self.grid)
+
+        # Pending orders: new arrivals join, orders past their patience expire
+        arrivals = self.orders.between(timestamp, timestamp + config.step_seconds)
+        self.report.orders += arrivals.size
+        self.pending = np.concatenate([self.pending, arrivals])
+        waiting = self.orders.request_ts[self.pending] + config.order_patience > timestamp
+        self.report.expired += int(np.sum(~waiting))
+        self.pending = self.pending[waiting]
+
+        self._dispatch(step, timestamp)
+        if timestamp % config.reposition_interval < config.step_seconds:
+            self._reposition(step, timestamp)
+        self._idle_transitions(timestamp)
+        self.report.steps += 1
+
+    def _dispatch(self, step: int, timestamp: int) -> None:
+        config = self.config
+        idle = self.fleet.idle()
+        if self.pending.size == 0 or idle.size == 0:
+            return
+
+        # Nearest idle drivers of each pending order within the dispatch radius
+        tree = cKDTree(project(self.fleet.coords[idle]))
+        k = min(config.max_candidates, idle.size)
+        distance, nearest = tree.query(project(self.orders.start[self.pending]), k=k,
+                                       distance_upper_bound=config.dispatch_radius)
+        distance, nearest = distance.reshape(self.pending.size, k), nearest.reshape(self.pending.size, k)
+        order_pos, rank = np.nonzero(np.isfinite(distance))
+        if order_pos.size == 0:
+            return
+        orders, drivers, distance = self.pending[order_pos], idle[nearest[order_pos, rank]], distance[order_pos, rank]
+        eta = distance / config.pickup_speed
+        self.report.candidates += orders.size
+
+        observation = self._observation(orders, drivers, distance, eta, timestamp)
+        started = time.perf_counter()
+        actions = self.agent.dispatch(observation)
+        self.report.dispatch_latency.append(time.perf_counter() - started)
+
+        # Keep the first action for each order and driver, and only for offered pairs
+        rows = {(o, d): i for i, (o, d) in enumerate(zip(orders.tolist(), drivers.tolist()))}
+        chosen, seen_orders, seen_drivers = [], set(), set()
+        for action in actions:
+            i = rows.get((action['order_id'], action['driver_id']))
+            if i is None or orders[i] in seen_orders or drivers[i] in seen_drivers:
+                continue
+            seen_orders.add(orders[i])
+            seen_drivers.add(drivers[i])
+            chosen.append(i)
+        chosen = np.array(chosen, dtype=int)
+        self.pending = self.pending[~np.isin(self.pending, orders[chosen])]
+
+        # Assigned orders cancel with the distance fit, otherwise the driver serves the trip
+        served = chosen[self.rng.rand(chosen.size) < completion_rate(distance[chosen])]
+        self.report.cancelled += chosen.size - served.size
+        self.report.answered += served.size
+        order_served, driver_served = orders[served], drivers[served]
+        self.report.gmv += float(np.sum(self.orders.reward[order_served]))
+        trip = self.orders.finish_ts[order_served] - self.orders.request_ts[order_served]
+        finish = step + np.ceil((eta[served] + trip) / config.step_seconds).astype(np.int64)
+        self.fleet.depart(driver_served, BUSY, self.orders.end[order_served])
+        self.events.push(np.maximum(finish, step + 1), driver_served)
+
+    def _observation(self, orders: np.ndarray, drivers: np.ndarray, distance: np.ndarray, eta: np.ndarray,
+                     timestamp: int) -> List[Dict[str, Any]]:
+        """ Candidate rows in the dispatch_observ format of the competition simulator """
+        day_of_week = time.gmtime(timestamp).tm_wday
+        start, end = self.orders.start[orders].tolist(), self.orders.end[orders].tolist()
+        finish = (timestamp + self.orders.finish_ts[orders] - self.orders.request_ts[orders]).tolist()
+        reward = self.orders.reward[orders].tolist()
+        driver_coords = self.fleet.coords[drivers].tolist()
+        return [dict(order_id=o, driver_id=d, order_driver_distance=dist, order_start_location=start[i],
+                     order_finish_location=end[i], driver_location=driver_coords[i], timestamp=timestamp,
+                     order_finish_timestamp=finish[i], day_of_week=day_of_week, reward_units=reward[i],
+                     pick_up_eta=e)
+                for i, (o, d, dist, e) in enumerate(zip(orders.tolist(), drivers.tolist(), distance.tolist(),
+                                                        eta.tolist()))]
+
+    def _reposition(self, step: int, timestamp: int) -> None:
+        idle = self.fleet.idle()
+        idle = idle[self.rng.rand(idle.size) < self.config.reposition_fraction]
+        if idle.size == 0:
+            return
+        ids = self.grid.data.ids
+        observation = dict(timestamp=timestamp, day_of_week=time.gmtime(timestamp).tm_wday,
+                           driver_info=[dict(driver_id=d, grid_id=ids[g])
+                                        for d, g in zip(idle.tolist(), self.fleet.grid[idle].tolist())])
+        started = time.perf_counter()
+        actions = self.agent.reposition(observation)
+        self.report.reposition_latency.append(time.perf_counter() - started)
+
+        # Drivers travel to the destination centroid; unknown or unchanged destinations stay idle
+        treatment = set(idle.tolist())
+        drivers, destinations = [], []
+        for action in actions:
+            g = self.grid.index.get(action['destination'], -1)
+            if action['driver_id'] in treatment and 0 <= g < self.grid.data.n_grids:
+                treatment.discard(action['driver_id'])
+                drivers.append(action['driver_id'])
+                destinations.append(g)
+        drivers, destinations = np.array(drivers, dtype=int), np.array(destinations, dtype=int)
+        moving = destinations != self.fleet.grid[drivers]
+        drivers, destinations = drivers[moving], destinations[moving]
+        target = np.asarray(self.grid.data.centroids)[destinations]
+        meters = np.hypot(*(project(target) - project(self.fleet.coords[drivers])).T)
+        arrival = step + np.ceil(meters / self.config.reposition_speed / self.config.step_seconds).astype(np.int64)
+        self.fleet.depart(drivers, REPOSITIONING, target)
+        self.events.push(np.maximum(arrival, step + 1), drivers)
+
+    def _idle_transitions(self, timestamp: int) -> None:
+        """ Drivers idle for idle_transition_seconds move to a grid drawn from the idle transition matrix """
+        idle = self.fleet.idle()
+        idle = idle[timestamp - self.fleet.idle_since[idle] >= self.config.idle_transition_seconds]
+        if idle.size == 0:
+            return
+        destinations = sample_transitions(self.grid.idle_transition_matrix(timestamp), self.fleet.grid[idle], self.rng)
+        # Transition-only ids have no centroid to move to
+        known = destinations < self.grid.data.n_grids
+        idle, destinations = idle[known], destinations[known]
+        moved = destinations != self.fleet.grid[idle]
+        self.fleet.move(idle[moved], np.asarray(self.grid.data.centroids)[destinations[moved]], destinations[moved])
+        self.fleet.idle_since[idle] = timestamp
+
+
+def project(coords: np.ndarray) -> np.ndarray:
+    """ [lng, lat] to planar meters, matching Grid.distance """
+    return np.asarray(coords, dtype=float).reshape(-1, 2) * np.array([LNG_FACTOR, 1.]) * METERS_PER_DEGREE
+
+
+def sample_transitions(transitions, starts: np.ndarray, rng: np.random.RandomState) -> np.ndarray:
+    """ One destination per start, drawn from the rows of a CSR transition matrix """
+    rows = transitions[starts]
+    cumulative = np.cumsum(rows.data)
+    before = np.r_[0., cumulative][rows.indptr[:-1]]
+    totals = np.r_[0., cumulative][rows.indptr[1:]] - before
+    picks = np.searchsorted(cumulative, before + rng.rand(starts.size) * totals, side='right')
+    return rows.indices[np.clip(picks, rows.indptr[:-1], rows.indptr[1:] - 1)]
@@ -0,0 +1,36 @@
+from typing import Dict, List
+
+import numpy as np
+
+
+class EventQueue:
+    """ Calendar queue of entity ids keyed by simulation step
+
+    Events are pushed and popped as arrays, so scheduling a whole batch of trip completions costs one
+    grouping pass instead of one heap operation per driver.
+    """
+    def __init__(self):
+        self.buckets = dict()  # type: Dict[int, List[np.ndarray]]
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def push(self, steps: np.ndarray, ids: np.ndarray) -> None:
+        steps, ids = np.asarray(steps, dtype=np.int64).reshape(-1), np.asarray(ids, dtype=np.int64).reshape(-1)
+        if steps.size == 0:
+            return
+        order = np.argsort(steps, kind='stable')
+        unique, starts = np.unique(steps[order], return_index=True)
+        for step, group in zip(unique.tolist(), np.split(ids[order], starts[1:])):
+            self.buckets.setdefault(step, []).append(group)
+        self.size += ids.size
+
+    def pop(self, step: int) -> np.ndarray:
+        """ Ids scheduled at step, in push order """
+        groups = self.buckets.pop(step, None)
+        if not groups:
+            return np.empty(0, dtype=np.int64)
+        ids = groups[0] if len(groups) == 1 else np.concatenate(groups)
+        self.size -= ids.size
+        return ids
@@ -0,0 +1,54 @@
+import numpy as np
+
+from grid import Grid
+
+
+IDLE = 0
+BUSY = 1
+REPOSITIONING = 2
+
+
+class Fleet:
+    """ Driver state as parallel arrays indexed by driver id
+
+    Drivers on a trip or a reposition move to target when their completion event fires; coords and grid
+    only change at that point, or on an idle transition.
+    """
+    def __init__(self, coords: np.ndarray, grid: Grid):
+        self.coords = np.array(coords, dtype=float).reshape(-1, 2)  # [lng, lat]
+        self.grid = grid.lookup_indices(self.coords)
+        self.target = self.coords.copy()
+        self.status = np.full(len(self.coords), IDLE, dtype=np.int8)
+        self.idle_since = np.zeros(len(self.coords), dtype=np.int64)
+
+    def __len__(self):
+        return len(self.coords)
+
+    def idle(self) -> np.ndarray:
+        return np.flatnonzero(self.status == IDLE)
+
+    def depart(self, ids: np.ndarray, status: int, target: np.ndarray) -> None:
+        self.status[ids] = status
+        self.target[ids] = target
+
+    def arrive(self, ids: np.ndarray, timestamp: int, grid: Grid) -> None:
+        """ Drivers reach their target and become idle """
+        if ids.size == 0:
+            return
+        self.coords[ids] = self.target[ids]
+        self.grid[ids] = grid.lookup_indices(self.coords[ids])
+        self.status[ids] = IDLE
+        self.idle_since[ids] = timestamp
+
+    def move(self, ids: np.ndarray, coords: np.ndarray, grids: np.ndarray) -> None:
+        self.coords[ids] = coords
+        self.target[ids] = coords
+        self.grid[ids] = grids
+
+
+def synthetic_fleet(grid: Grid, n_drivers: int, seed: int = 0) -> Fleet:
+    """ Drivers spread uniformly over the hex centroids """
+    rng = np.random.RandomState(seed)
+    centroids = np.asarray(grid.data.centroids)
+    coords = centroids[rng.randint(0, len(centroids), n_drivers)] + rng.normal(scale=0.002, size=(n_drivers, 2))
+    return Fleet(coords, grid)
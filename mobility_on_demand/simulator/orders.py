@@ -0,0 +1,72 @@
+import csv
+from typing import Sequence
+
+import numpy as np
+
+from grid import Grid, LNG_FACTOR, METERS_PER_DEGREE
+
+
+# Relative order volume for each hour of the day (GMT+8 shaped, indexed by GMT hour)
+HOURLY_DEMAND = np.array([1.6, 1.4, 1.2, 1.2, 1.3, 1.3, 1.2, 1.1, 1.2, 1.4, 1.7, 1.6,
+                          1.2, 0.8, 0.5, 0.3, 0.2, 0.2, 0.3, 0.5, 0.7, 1.0, 1.2, 1.4])
+
+
+class OrderStream:
+    """ Orders of a simulated period as parallel arrays sorted by request time """
+    def __init__(self, request_ts: np.ndarray, finish_ts: np.ndarray, start: np.ndarray, end: np.ndarray,
+                 reward: np.ndarray):
+        order = np.argsort(request_ts, kind='stable')
+        self.request_ts = np.asarray(request_ts, dtype=np.int64)[order]
+        self.finish_ts = np.asarray(finish_ts, dtype=np.int64)[order]
+        self.start = np.asarray(start, dtype=float).reshape(-1, 2)[order]  # [lng, lat]
+        self.end = np.asarray(end, dtype=float).reshape(-1, 2)[order]
+        self.reward = np.asarray(reward, dtype=float)[order]
+
+    def __len__(self):
+        return self.request_ts.size
+
+    def between(self, start_ts: int, end_ts: int) -> np.ndarray:
+        """ Positions of the orders requested in [start_ts, end_ts) """
+        lo, hi = np.searchsorted(self.request_ts, [start_ts, end_ts]).tolist()
+        return np.arange(lo, hi)
+
+
+def synthetic_orders(grid: Grid, n_orders: int, start_ts: int, seconds: int, seed: int = 0,
+                     hotspots: Sequence[int] = None, trip_speed: float = 8.) -> OrderStream:
+    """ Orders with an hourly demand profile, pickups drawn around hex centroids (optionally biased to
+    hotspot grid indices) and trips of a few kilometers """
+    rng = np.random.RandomState(seed)
+    hours = (start_ts + np.arange(seconds)) // 3600 % 24
+    weights = HOURLY_DEMAND[hours]
+    request_ts = start_ts + np.sort(rng.choice(seconds, n_orders, p=weights / weights.sum()))
+
+    centroids = np.asarray(grid.data.centroids)
+    if hotspots is None:
+        pickups = rng.randint(0, len(centroids), n_orders)
+    else:
+        hotspots = np.asarray(hotspots)
+        pickups = np.where(rng.rand(n_orders) < 0.5, hotspots[rng.randint(0, hotspots.size, n_orders)],
+                           rng.randint(0, len(centroids), n_orders))
+    start = centroids[pickups] + rng.normal(scale=0.002, size=(n_orders, 2))
+
+    # Trip length ~ lognormal around 5 km in a uniform direction
+    meters = rng.lognormal(np.log(5000), 0.6, n_orders)
+    angle = rng.uniform(0, 2 * np.pi, n_orders)
+    offset = np.stack([np.cos(angle) / LNG_FACTOR, np.sin(angle)], axis=1) * (meters / METERS_PER_DEGREE)[:, None]
+    end = start + offset
+    finish_ts = request_ts + (meters / trip_speed).astype(np.int64)
+    reward = 0.8 + meters / 2500
+    return OrderStream(request_ts, finish_ts, start, end, reward)
+
+
+def load_orders(path: str) -> OrderStream:
+    """ Replay a GAIA order file: order_id, ride_start_ts, ride_stop_ts, pickup lng, lat, dropoff lng, lat, reward """
+    rows = []
+    with open(path, 'r') as csvfile:
+        for row in csv.reader(csvfile):
+            if len(row) < 8:
+                continue
+            rows.append([float(x) for x in row[1:8]])
+    table = np.array(rows, dtype=float).reshape(-1, 7)
+    return OrderStream(table[:, 0].astype(np.int64), table[:, 1].astype(np.int64), table[:, 2:4], table[:, 4:6],
+                       table[:, 6])
@@ -0,0 +1,70 @@
+import json
+import os
+import tempfile
+import unittest
+
+import numpy as np
+from scipy.sparse import csr_matrix
+
+from simulator import SUBMISSION_DIR  # noqa: F401
+from agent import Agent
+import parse
+from simulator.engine import SimulationConfig, Simulator, sample_transitions
+from simulator.events import EventQueue
+from simulator.fleet import BUSY, IDLE, synthetic_fleet
+from simulator.orders import synthetic_orders
+from simulator import sweep
+
+
+START_TS = 1477929600
+
+
+class SimulatorTest(unittest.TestCase):
+    def test_event_queue(self):
+        events = EventQueue()
+        events.push(np.array([3, 1, 3]), np.array([10, 11, 12]))
+        events.push(np.array([3]), np.array([13]))
+        assert len(events) == 4
+        assert events.pop(1).tolist() == [11]
+        assert events.pop(2).size == 0
+        assert events.pop(3).tolist() == [10, 12, 13]
+        assert len(events) == 0
+
+    def test_sample_transitions(self):
+        transitions = csr_matrix(np.array([[0., 1., 0.], [0.25, 0., 0.75], [0., 0., 1.]]))
+        rng = np.random.RandomState(0)
+        starts = np.repeat([0, 1, 2], 4000)
+        destinations = sample_transitions(transitions, starts, rng)
+        assert np.all(destinations[starts == 0] == 1) and np.all(destinations[starts == 2] == 2)
+        assert abs(np.mean(destinations[starts == 1] == 2) - 0.75) < 0.03
+        assert set(destinations[starts == 1].tolist()) == {0, 2}
+
+    def test_run(self):
+        orders = synthetic_orders(parse.HEX_GRID, 2000, START_TS, 1800, seed=1)
+        fleet = synthetic_fleet(parse.HEX_GRID, 500, seed=1)
+        simulator = Simulator(Agent(), orders, fleet, parse.HEX_GRID, SimulationConfig(seed=1))
+        report = simulator.run(START_TS, START_TS + 1800)
+        assert report.steps == 900 and report.orders == len(orders)
+        assert report.answered > 0 and report.answered + report.cancelled <= report.orders
+        assert 0 < report.answer_rate <= 1 and report.gmv > 0
+        assert len(report.dispatch_latency) > 0 and len(report.reposition_latency) == 6
+
+        # Every busy or repositioning driver has exactly one pending completion
+        assert len(simulator.events) == np.sum(fleet.status != IDLE)
+        assert np.sum(fleet.status == BUSY) <= report.answered
+
+    def test_sweep_resume(self):
+        grid_trials = sweep.trials(dict(alpha=[0.01, 0.02], dispatch_gamma=[0.9]), [0, 1])
+        assert [(t.params['alpha'], t.seed) for t in grid_trials] == [(0.01, 0), (0.01, 1), (0.02, 0), (0.02, 1)]
+
+        settings = sweep.SweepSettings(n_orders=500, n_drivers=100, hours=0.25, checkpoint_hours=0.1)
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'results.jsonl')
+            first = sweep.run_trial((grid_trials[0], settings))
+            assert len(first['curve']) == 3 and first['stopped_at'] is None
+            with open(path, 'w') as f:
+                f.write(json.dumps(first) + '\n' + '{"trial": ')  # Interrupted mid-write
+
+            results = list(sweep.sweep(grid_trials, settings, path, workers=2))
+            assert sorted(r['trial'] for r in results) == sorted(t.key for t in grid_trials[1:])
+            assert set(sweep.load_results(path)) == {t.key for t in grid_trials}
@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+# @File: sweep.py
+""" Parallel Agent hyperparameter sweep over simulated days
+
+    python -m simulator.sweep --alpha 0.005 0.01 --dispatch-gamma 0.9 0.95 --seeds 0 1 --results sweep.jsonl
+
+Every (configuration, seed) trial runs in a process pool and appends one json line to the results file as
+soon as it finishes, so an interrupted sweep picks up where it left off. The grid tables are compiled to
+the memory-mapped grid cache and loaded before the pool forks, so workers share one copy of the centroids,
+KD-tree and transition matrices instead of each parsing the csvs.
+
+Trials report their metric at every checkpoint. With the median stopping rule, a trial whose metric falls
+below the median of the other trials on the same seed at the same checkpoint stops early and is recorded as
+stopped.
+"""
+import argparse
+import collections
+import itertools
+import json
+import multiprocessing
+import os
+import statistics
+from typing import Any, Dict, Iterator, List
+
+from simulator import SUBMISSION_DIR  # noqa: F401 (puts the submission on the import path)
+from agent import Agent
+import grid
+import parse
+from simulator.engine import SimulationConfig, Simulator
+from simulator.fleet import synthetic_fleet
+from simulator.orders import synthetic_orders
+
+
+START_TS = 1477929600
+PARAMETERS = ('alpha', 'dispatch_gamma', 'idle_reward', 'reposition_gamma')
+
+_progress = None  # Checkpoint metrics shared between workers, {(checkpoint, seed, trial key): metric}
+
+
+class Trial:
+    def __init__(self, params: Dict[str, float], seed: int):
+        self.params = params
+        self.seed = seed
+
+    @property
+    def key(self) -> str:
+        return json.dumps(dict(params=self.params, seed=self.seed), sort_keys=True)
+
+
+class SweepSettings:
+    def __init__(self, n_orders: int = 200000, n_drivers: int = 20000, hours: float = 24.,
+                 checkpoint_hours: float = 2., metric: str = 'gmv', min_trials: int = 3, early_stopping: bool = True,
+                 start_ts: int = START_TS):
+        self.n_orders = n_orders
+        self.n_drivers = n_drivers
+        self.hours = hours
+        self.checkpoint_hours = checkpoint_hours
+        self.metric = metric  # SimulationReport.to_dict key to maximize
+        self.min_trials = min_trials  # Other trials needed at a checkpoint before the stopping rule applies
+        self.early_stopping = early_stopping
+        self.start_ts = start_ts
+
+
+def trials(grid_params: Dict[str, List[float]], seeds: List[int]) -> List[Trial]:
+    """ Cartesian product of the parameter values, crossed with seeds """
+    names = sorted(grid_params)
+    return [Trial(dict(zip(names, values)), seed)
+            for values in itertools.product(*(grid_params[name] for name in names)) for seed in seeds]
+
+
+def load_results(path: str) -> Dict[str, Dict[str, Any]]:
+    """ Finished trials by key; a truncated last line from an interrupted run is ignored """
+    results = dict()  # type: Dict[str, Dict[str, Any]]
+    if not os.path.exists(path):
+        return results
+    with open(path, 'r') as f:
+        for line in f:
+            try:
+                result = json.loads(line)
+            except ValueError:
+                continue
+            results[result['trial']] = result
+    return results
+
+
+def run_trial(args) -> Dict[str, Any]:
+    trial, settings = args  # type: Trial, SweepSettings
+    seconds = int(settings.hours * 3600)
+    checkpoint = max(int(settings.checkpoint_hours * 3600), 1)
+    orders = synthetic_orders(parse.HEX_GRID, settings.n_orders, settings.start_ts, seconds, trial.seed)
+    fleet = synthetic_fleet(parse.HEX_GRID, settings.n_drivers, trial.seed)
+    simulator = Simulator(Agent(**trial.params), orders, fleet, parse.HEX_GRID, SimulationConfig(seed=trial.seed))
+
+    end_ts = settings.start_ts + seconds
+    curve, stopped_at = [], None  # type: List[float], int
+    for k, start in enumerate(range(settings.start_ts, end_ts, checkpoint)):
+        report = simulator.run(start, min(start + checkpoint, end_ts))
+        curve.append(report.to_dict()[settings.metric])
+        if settings.early_stopping and start + checkpoint < end_ts and _should_stop(trial, k, curve[-1], settings):
+            stopped_at = k
+            break
+    return dict(trial=trial.key, params=trial.params, seed=trial.seed, metrics=simulator.report.to_dict(),
+                curve=curve, stopped_at=stopped_at)
+
+
+def _should_stop(trial: Trial, checkpoint: int, value: float, settings: SweepSettings) -> bool:
+    """ Median stopping rule against the other trials on the same seed that reached this checkpoint """
+    if _progress is None:
+        return False
+    _progress[(checkpoint, trial.seed, trial.key)] = value
+    others = [v for (c, seed, key), v in _progress.items()
+              if c == checkpoint and seed == trial.seed and key != trial.key]
+    return len(others) >= settings.min_trials and value < statistics.median(others)
+
+
+def _init_worker(progress) -> None:
+    global _progress
+    _progress = progress
+
+
+def warm_grid() -> None:
+    """ Load the shared grid tables in this process so forked workers inherit them """
+    if grid.GridData.from_cache() is None:
+        grid.compile_cache()
+    assert parse.HEX_GRID.kdtree is not None and parse.HEX_GRID.index
+    for hour in range(24):
+        parse.HEX_GRID.transition_matrix(hour)
+
+
+def sweep(pending: List[Trial], settings: SweepSettings, results_path: str,
+          workers: int = None) -> Iterator[Dict[str, Any]]:
+    """ Run trials not yet in results_path, appending and yielding each result as it finishes """
+    done = load_results(results_path)
+    pending = [trial for trial in pending if trial.key not in done]
+    if not pending:
+        return
+    warm_grid()
+    _end_line(results_path)
+    with multiprocessing.Manager() as manager:
+        progress = manager.dict()
+        for result in done.values():
+            for k, value in enumerate(result['curve']):
+                progress[(k, result['seed'], result['trial'])] = value
+        with multiprocessing.Pool(workers, _init_worker, (progress,)) as pool, open(results_path, 'a') as f:
+            for result in pool.imap_unordered(run_trial, [(trial, settings) for trial in pending]):
+                f.write(json.dumps(result) + '\n')
+                f.flush()
+                yield result
+
+
+def _end_line(path: str) -> None:
+    """ Terminate a partial last line so appended results start on their own line """
+    if os.path.exists(path) and os.path.getsize(path):
+        with open(path, 'rb+') as f:
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b'\n':
+                f.write(b'\n')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    for name in PARAMETERS:
+        parser.add_argument('--' + name.replace('_', '-'), type=float, nargs='+')
+    parser.add_argument('--seeds', type=int, nargs='+', default=[0])
+    parser.add_argument('--results', default='sweep.jsonl')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--orders', type=int, default=200000)
+    parser.add_argument('--drivers', type=int, default=20000)
+    parser.add_argument('--hours', type=float, default=24.)
+    parser.add_argument('--checkpoint-hours', type=float, default=2.)
+    parser.add_argument('--metric', default='gmv')
+    parser.add_argument('--min-trials', type=int, default=3)
+    parser.add_argument('--no-early-stopping', action='store_true')
+    args = parser.parse_args()
+
+    grid_params = {name: getattr(args, name) for name in PARAMETERS if getattr(args, name)}
+    settings = SweepSettings(args.orders, args.drivers, args.hours, args.checkpoint_hours, args.metric,
+                             args.min_trials, not args.no_early_stopping)
+    for result in sweep(trials(grid_params, args.seeds), settings, args.results, args.workers):
+        status = 'complete' if result['stopped_at'] is None else f'stopped at checkpoint {result["stopped_at"]}'
+        print(f'{result["params"]} seed={result["seed"]}: {args.metric}={result["curve"][-1]:.4f} ({status})')
+
+    # Rank configurations by their mean over seeds that ran to the end
+    by_params = collections.defaultdict(list)  # type: Dict[str, List[float]]
+    for result in load_results(args.results).values():
+        if result['stopped_at'] is None:
+            by_params[json.dumps(result['params'], sort_keys=True)].append(result['metrics'][args.metric])
+    if by_params:
+        best = max(by_params, key=lambda params: statistics.mean(by_params[params]))
+        mean = statistics.mean(by_params[best])
+        print(f'best: {best} mean {args.metric}={mean:.4f} over {len(by_params[best])} seeds')
+
+if __name__ == '__main__':
+    main()
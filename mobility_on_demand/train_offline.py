@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+# @File: train_offline.py
+""" Learn state values offline from the step logs of Agent(log_dir=...)
+
+Run from the mobility_on_demand folder:
+
+    python train_offline.py logs/day1 logs/day2 --checkpoint-dir checkpoints
+
+Logs are replayed in the order given, through the same TD updates the agent applied online, starting from
+init_values.csv or from the checkpoint already in --checkpoint-dir with --resume. The learned values are
+saved as a full checkpoint, which Agent(checkpoint_dir=...) restores on startup.
+"""
+import argparse
+import os
+import sys
+import time
+
+SUBMISSION_DIR = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'model'))
+sys.path.append(SUBMISSION_DIR)
+import checkpoint  # noqa: E402
+import dispatch  # noqa: E402
+import parse  # noqa: E402
+import steplog  # noqa: E402
+
+
+DISPATCHERS = dict(sarsa=dispatch.Sarsa, dql=dispatch.Dql)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('logs', nargs='+', help='step log directories, oldest first')
+    parser.add_argument('--checkpoint-dir', required=True)
+    parser.add_argument('--resume', action='store_true', help='start from the checkpoint in --checkpoint-dir')
+    parser.add_argument('--dispatcher', default='sarsa', choices=list(DISPATCHERS))
+    parser.add_argument('--alpha', type=float, default=2 / (5 * 60))
+    parser.add_argument('--gamma', type=float, default=0.9)
+    parser.add_argument('--idle-reward', type=float, default=0.)
+    parser.add_argument('--chunk-steps', type=int, default=steplog.CHUNK_STEPS)
+    args = parser.parse_args()
+
+    cls = DISPATCHERS[args.dispatcher]
+    snapshot = checkpoint.load(args.checkpoint_dir, parse.HEX_GRID.ids, cls.__name__) if args.resume else None
+    dispatcher = cls(args.alpha, args.gamma, args.idle_reward, initial_values=snapshot.values if snapshot else None)
+    if snapshot:
+        dispatcher.restore_state(snapshot.state)
+
+    for directory in args.logs:
+        start = time.perf_counter()
+        steps = steplog.replay(steplog.StepLogReader(directory), dispatcher, args.chunk_steps)
+        print(f'{directory}: {steps} dispatch steps in {time.perf_counter() - start:.1f}s')
+    name = checkpoint.Checkpointer(args.checkpoint_dir).save(dispatcher, full=True)
+    print(f'Saved {os.path.join(args.checkpoint_dir, name)}')
+
+
+if __name__ == '__main__':
+    main()
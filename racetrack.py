@@ -0,0 +1,746 @@
+# -*- coding: utf-8 -*-
+# @File: racetrack.py
+""" Sutton & Barto Exercise 5.12: Racetrack, the environment and control loops of racetrack_monte_carlo.ipynb
+
+Drive steps one episode at a time through DriverState objects, as in the notebook. DriveBatch steps many
+episodes in lockstep on arrays of positions and velocities, and mc_control_batch and td_control_batch learn
+a Driver from it, with array updates in place of the per-step loops of mc_control and td_control:
+
+    python racetrack.py --track a --iterations 10000
+
+Both learn with the default --crash-reward -1, td_control_batch from 10 times as many episodes as
+mc_control_batch and with a step size of 0.1, which are the defaults of --control td. With --crash-reward -10 and
+gamma 0.9, standing still at the start (a return of -10) is worth about as much as the crashes an epsilon-greedy
+driver keeps making on the way, and the greedy policies mc_control_batch learns often never leave.
+
+Plotting needs matplotlib, which is imported on first use.
+"""
+import argparse
+import random
+import time
+from enum import Enum
+from itertools import product
+from typing import Tuple
+
+import numpy as np
+from scipy.signal import lfilter
+
+
+MAX_VELOCITY = 5
+VELOCITIES = 2 * MAX_VELOCITY + 1  # Negative velocities index from the end of their axis, as in the notebook
+N_ACTIONS = 9  # action % 3 picks the acceleration in x and action // 3 in y: 0 ACCEL, 1 STEADY, 2 DECEL
+ACCEL_X = 1 - np.arange(N_ACTIONS) % 3  # By action, Driver.itoa as arrays
+ACCEL_Y = 1 - np.arange(N_ACTIONS) // 3
+CRASH, TRACK, FINISH = range(3)  # Where a move can end, DriveBatch cells
+BATCH_T = 1000  # Steps before mc_control_batch gives up an episode; the optimal laps take ~10
+UPDATE_STEPS = 100  # Steps between policy improvements of mc_control_batch, at the latest
+
+
+class ActionX(Enum):
+    """+X is East"""
+    ACCEL = 'AX', 0, lambda x, y: (min(x + 1, MAX_VELOCITY), y), (1, 0)
+    STEADY = 'SX', 1, lambda x, y: (x, y), (0, 0)
+    DECEL = 'DX', 2, lambda x, y: (max(x - 1, -MAX_VELOCITY), y), (-1, 0)
+
+    def __init__(self, display_name, index, transition, unit_vector):
+        self.display_name = display_name
+        self.index = index
+        self.transition = transition  # matplotlib coordinates
+        self.unit_vector = unit_vector  # matplotlib coordinates
+
+    def __str__(self):
+        return self.display_name
+
+
+class ActionY(Enum):
+    """+Y is North"""
+    ACCEL = 'AY', 0, lambda x, y: (x, min(y + 1, MAX_VELOCITY)), (0, 1)
+    STEADY = 'SY', 1, lambda x, y: (x, y), (0, 0)
+    DECEL = 'DY', 2, lambda x, y: (x, max(y - 1, -MAX_VELOCITY)), (0, -1)
+
+    def __init__(self, display_name, index, transition, unit_vector):
+        self.display_name = display_name
+        self.index = index
+        self.transition = transition  # matplotlib coordinates
+        self.unit_vector = unit_vector  # matplotlib coordinates
+
+    def __str__(self):
+        return self.display_name
+
+
+class Track(object):
+    def __init__(self, coords):
+        # Everything is in matplotlib coordinates (origin is bottom-left), coords[x, y]
+        self.coords = np.rot90(coords, 3)
+
+        # Assumes start from bottom row
+        self.starts = list(product([x for x, val in enumerate(coords[-1]) if val > 0], [0]))
+
+        # Assumes right handed turn ending in North East corner
+        end_y = set([i for i, val in enumerate(self.coords[-1]) if val > 0])
+        self.is_end = lambda x, y: y in end_y and x >= coords.shape[1] - 1
+        self.end_rows = np.isin(np.arange(self.coords.shape[1]), list(end_y))  # end_rows[y] is y in end_y
+
+    def is_valid_position(self, x, y):
+        return self.coords[(x, y)] > 0
+
+
+TRACK_A = Track(np.array([
+    [0, 0, 0, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1],
+    [0, 0, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1],
+    [0, 0, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1],
+    [0, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1],
+    [1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1],
+    [1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1],
+    [1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 0, 0, 0, 0, 0, 0, 0],
+    [1, 1, 1, 1, 1, 1, 1, 1, 1, 0, 0, 0, 0, 0, 0, 0, 0],
+    [1, 1, 1, 1, 1, 1, 1, 1, 1, 0, 0, 0, 0, 0, 0, 0, 0],
+    [1, 1, 1, 1, 1, 1, 1, 1, 1, 0, 0, 0, 0, 0, 0, 0, 0],
+    [1, 1, 1, 1, 1, 1, 1, 1, 1, 0, 0, 0, 0, 0, 0, 0, 0],
+    [1, 1, 1, 1, 1, 1, 1, 1, 1, 0, 0, 0, 0, 0, 0, 0, 0],
+    [1, 1, 1, 1, 1, 1, 1, 1, 1, 0, 0, 0, 0, 0, 0, 0, 0],
+    [1, 1, 1, 1, 1, 1, 1, 1, 1, 0, 0, 0, 0, 0, 0, 0, 0],
+    [0, 1, 1, 1, 1, 1, 1, 1, 1, 0, 0, 0, 0, 0, 0, 0, 0],
+    [0, 1, 1, 1, 1, 1, 1, 1, 1, 0, 0, 0, 0, 0, 0, 0, 0],
+    [0, 1, 1, 1, 1, 1, 1, 1, 1, 0, 0, 0, 0, 0, 0, 0, 0],
+    [0, 1, 1, 1, 1, 1, 1, 1, 1, 0, 0, 0, 0, 0, 0, 0, 0],
+    [0, 1, 1, 1, 1, 1, 1, 1, 1, 0, 0, 0, 0, 0, 0, 0, 0],
+    [0, 1, 1, 1, 1, 1, 1, 1, 1, 0, 0, 0, 0, 0, 0, 0, 0],
+    [0, 1, 1, 1, 1, 1, 1, 1, 1, 0, 0, 0, 0, 0, 0, 0, 0],
+    [0, 1, 1, 1, 1, 1, 1, 1, 1, 0, 0, 0, 0, 0, 0, 0, 0],
+    [0, 0, 1, 1, 1, 1, 1, 1, 1, 0, 0, 0, 0, 0, 0, 0, 0],
+    [0, 0, 1, 1, 1, 1, 1, 1, 1, 0, 0, 0, 0, 0, 0, 0, 0],
+    [0, 0, 1, 1, 1, 1, 1, 1, 1, 0, 0, 0, 0, 0, 0, 0, 0],
+    [0, 0, 1, 1, 1, 1, 1, 1, 1, 0, 0, 0, 0, 0, 0, 0, 0],
+    [0, 0, 1, 1, 1, 1, 1, 1, 1, 0, 0, 0, 0, 0, 0, 0, 0],
+    [0, 0, 1, 1, 1, 1, 1, 1, 1, 0, 0, 0, 0, 0, 0, 0, 0],
+    [0, 0, 1, 1, 1, 1, 1, 1, 1, 0, 0, 0, 0, 0, 0, 0, 0],
+    [0, 0, 0, 1, 1, 1, 1, 1, 1, 0, 0, 0, 0, 0, 0, 0, 0],
+    [0, 0, 0, 1, 1, 1, 1, 1, 1, 0, 0, 0, 0, 0, 0, 0, 0],
+    [0, 0, 0, 1, 1, 1, 1, 1, 1, 0, 0, 0, 0, 0, 0, 0, 0],
+]))
+
+TRACK_B = Track(np.array([
+    [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1],
+    [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1],
+    [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1],
+    [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1],
+    [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1],
+    [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1],
+    [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1],
+    [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1],
+    [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1],
+    [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1],
+    [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 0, 0],
+    [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 0, 0, 0, 0, 0],
+    [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 0, 0, 0, 0, 0, 0],
+    [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 0, 0, 0, 0, 0, 0, 0, 0],
+    [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 1, 1, 1, 1, 1, 1, 1, 1, 1, 0, 0, 0, 0, 0, 0, 0, 0, 0],
+    [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 0, 0, 0, 0, 0, 0, 0, 0, 0],
+    [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 0, 0, 0, 0, 0, 0, 0, 0, 0],
+    [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 0, 0, 0, 0, 0, 0, 0, 0, 0],
+    [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 0, 0, 0, 0, 0, 0, 0, 0, 0],
+    [0, 0, 0, 0, 0, 0, 0, 0, 0, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 0, 0, 0, 0, 0, 0, 0, 0, 0],
+    [0, 0, 0, 0, 0, 0, 0, 0, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 0, 0, 0, 0, 0, 0, 0, 0, 0],
+    [0, 0, 0, 0, 0, 0, 0, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 0, 0, 0, 0, 0, 0, 0, 0, 0],
+    [0, 0, 0, 0, 0, 0, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 0, 0, 0, 0, 0, 0, 0, 0, 0],
+    [0, 0, 0, 0, 0, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 0, 0, 0, 0, 0, 0, 0, 0, 0],
+    [0, 0, 0, 0, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 0, 0, 0, 0, 0, 0, 0, 0, 0],
+    [0, 0, 0, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 0, 0, 0, 0, 0, 0, 0, 0, 0],
+    [0, 0, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 0, 0, 0, 0, 0, 0, 0, 0, 0],
+    [0, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 0, 0, 0, 0, 0, 0, 0, 0, 0],
+    [1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 0, 0, 0, 0, 0, 0, 0, 0, 0],
+    [1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 0, 0, 0, 0, 0, 0, 0, 0, 0],
+    [1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 0, 0, 0, 0, 0, 0, 0, 0, 0],
+]))
+
+
+def fill_square(x, y, ax, color, alpha=1.0):
+    square_x = [x, x, x + 1, x + 1]
+    square_y = [y, y + 1, y + 1, y]
+    ax.fill(square_x, square_y, color, alpha=alpha)
+
+
+def plot_track(track, state=None, action=None, title='Race Track', padding=1, offset=0, alpha=0.5):
+    import matplotlib.lines as mlines
+    import matplotlib.pyplot as plt
+
+    fig, ax = plt.subplots(figsize=(5, 4))
+    if title:
+        ax.set_title(title)
+    ax.set_xlim(-padding + offset, track.coords.shape[0] + padding + offset)
+    ax.set_ylim(-padding + offset, track.coords.shape[1] + padding + offset)
+
+    for x_ind, y_ind in product(range(-padding, track.coords.shape[0] + padding),
+                                range(-padding, track.coords.shape[1] + padding)):
+        x, y = x_ind + offset, y_ind + offset
+        if (0 <= x_ind < track.coords.shape[0] and
+                0 <= y_ind < track.coords.shape[1] and
+                track.coords[(x_ind, y_ind)] > 0):
+            ax.add_line(mlines.Line2D([x, x + 1], [y, y], color='k', linewidth=0.5))
+            ax.add_line(mlines.Line2D([x, x], [y, y + 1], color='k', linewidth=0.5))
+            ax.add_line(mlines.Line2D([x + 1, x + 1], [y, y + 1], color='k', linewidth=0.5))
+            ax.add_line(mlines.Line2D([x, x + 1], [y + 1, y + 1], color='k', linewidth=0.5))
+
+        if track.is_end(x_ind, y_ind):
+            fill_square(x, y, ax, 'g', alpha=alpha)
+
+    for x_ind, y_ind in track.starts:
+        x, y = x_ind + offset, y_ind + offset
+        fill_square(x, y, ax, 'r', alpha=alpha)
+
+    if state:
+        x, y = state.position
+        x += offset
+        y += offset
+        fill_square(x, y, ax, 'b', alpha=0.9)
+        dx, dy = state.velocity
+
+        # Plot after-state instead of current state if action is available
+        if action:
+            accel_X, accel_Y = Driver.itoa(action)
+            accel_x, accel_y = accel_X.unit_vector[0], accel_Y.unit_vector[1]
+
+            if accel_x != 0:
+                x_color = 'green' if accel_x > 0 else 'red'
+                ax.arrow(x + 0.5, y + 0.5, accel_x, 0, head_width=0.4, color=x_color)
+
+            if accel_y != 0:
+                y_color = 'green' if accel_y > 0 else 'red'
+                ax.arrow(x + 0.5, y + 0.5, 0, accel_y, head_width=0.4, color=y_color)
+
+            ax.arrow(x + 0.5, y + 0.5, dx + accel_x, dy + accel_y, head_width=0.5)
+        else:
+            ax.arrow(x + 0.5, y + 0.5, dx, dy, head_width=0.5)
+
+    return fig, ax
+
+
+class DriverState(object):
+    def __init__(self, position, velocity=(0, 0), terminal=False):
+        self.position = position
+        self.velocity = velocity
+        self.terminal = terminal
+
+    def __str__(self):
+        s = f'x=({self.position[0]},{self.position[1]}),v=({self.velocity[0]},{self.velocity[1]})'
+        if self.terminal:
+            s += ',TERMINAL'
+        return s
+
+
+class Drive(object):
+    crash_reward = -1
+
+    def __init__(self, track, slippage=0):
+        self.track = track
+        self.state = DriverState(random.choice(track.starts))
+        self.slippage = slippage
+
+    def set_state(self, state):
+        self.state = state
+
+    def _transition_state(self, ax, ay):
+        """Try to apply the ACTION and check whether it is valid."""
+        x, y = self.state.position
+        vx, vy = self.state.velocity
+        new_vx, new_vy = ay.transition(*ax.transition(vx, vy))
+
+        # Tire slippage in X
+        if random.random() < self.slippage:
+            new_vx = vx
+
+        # Tire slippage in Y
+        if random.random() < self.slippage:
+            new_vy = vy
+
+        new_x, new_y = x + new_vx, y + new_vy
+
+        terminal = False
+        if self.track.is_end(new_x, new_y):
+            # Terminal state, episode ends
+            terminal = True
+        elif (new_x < 0 or new_x >= self.track.coords.shape[0] or
+              new_y < 0 or new_y >= self.track.coords.shape[1] or
+              not self.track.is_valid_position(new_x, new_y)):
+            # CRASH
+            return None
+        return DriverState((new_x, new_y), (new_vx, new_vy), terminal=terminal)
+
+    def transition(self, ax, ay):
+        """Apply the given ACTION to the current state and return the new state and reward."""
+        reward = -1
+        new_state = self._transition_state(ax, ay)
+
+        if new_state is None:
+            # CRASH
+            new_state = DriverState(random.choice(self.track.starts))
+            reward = self.crash_reward
+        elif new_state.terminal:
+            # End of episode
+            reward = 0
+
+        self.state = new_state
+        return self.state, reward
+
+    def plot(self, action=None):
+        plot_track(self.track, self.state, action=action)
+
+
+class DriveRevised(Drive):
+    crash_reward = -10  # The new penalty for crashing
+
+
+class DriveBatch(object):
+    """ n Drives stepped together, lane k at (x[k], y[k]) with velocity (vx[k], vy[k])
+
+    Transitions follow Drive.transition: slippage keeps the old velocity of each axis independently, reaching
+    the finish ends the episode with reward 0, and leaving the track costs crash_reward (-1 like Drive, -10 like
+    DriveRevised) and restarts the lane from a random start at rest. A lane that finishes starts its next
+    episode the same way.
+    """
+    def __init__(self, track: Track, n: int = 100, slippage: float = 0., crash_reward: float = -1,
+                 seed: int = None):
+        self.track = track
+        self.n = n
+        self.slippage = slippage
+        self.rng = np.random.RandomState(seed)
+        self.x, self.y, self.vx, self.vy = (np.zeros(n, dtype=int) for _ in range(4))
+        self._starts = np.array(track.starts)
+
+        # What moving to (x, y) leads to, at [x + MAX_VELOCITY, y + MAX_VELOCITY] for any reachable x and y
+        width, height = track.coords.shape
+        self._cells = np.full((width + 2 * MAX_VELOCITY, height + 2 * MAX_VELOCITY), CRASH, dtype=int)
+        self._cells[MAX_VELOCITY:MAX_VELOCITY + width, MAX_VELOCITY:MAX_VELOCITY + height][track.coords > 0] = TRACK
+        finish = self._cells[MAX_VELOCITY + width - 1:, MAX_VELOCITY:MAX_VELOCITY + height]
+        finish[:, track.end_rows] = FINISH
+        self._rewards = np.array([crash_reward, -1., 0.])  # By cell
+        self._strides = np.array([height * VELOCITIES * VELOCITIES, VELOCITIES * VELOCITIES, VELOCITIES])
+        self.reset(np.arange(n))
+
+    def reset(self, lanes: np.ndarray) -> None:
+        """ Put lanes at random starts, at rest """
+        if len(lanes):
+            self.x[lanes], self.y[lanes] = self._starts[self.rng.randint(len(self._starts), size=len(lanes))].T
+            self.vx[lanes] = 0
+            self.vy[lanes] = 0
+
+    def states(self, lanes: np.ndarray = None) -> np.ndarray:
+        """ Flat indices of the (x, y, vx, vy) states of lanes (all by default) into Driver.action_values[..., a] """
+        if lanes is None:
+            x, y, vx, vy = self.x, self.y, self.vx, self.vy
+        else:
+            x, y, vx, vy = self.x[lanes], self.y[lanes], self.vx[lanes], self.vy[lanes]
+        return x * self._strides[0] + y * self._strides[1] + vx % VELOCITIES * self._strides[2] + vy % VELOCITIES
+
+    def step(self, actions: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """ Apply the action of each lane; returns the rewards and whether each lane finished its episode """
+        vx = np.minimum(np.maximum(self.vx + ACCEL_X[actions], -MAX_VELOCITY), MAX_VELOCITY)
+        vy = np.minimum(np.maximum(self.vy + ACCEL_Y[actions], -MAX_VELOCITY), MAX_VELOCITY)
+        if self.slippage > 0:
+            slip_x, slip_y = self.rng.random_sample((2, self.n)) < self.slippage
+            vx = np.where(slip_x, self.vx, vx)
+            vy = np.where(slip_y, self.vy, vy)
+        self.x += vx
+        self.y += vy
+        self.vx, self.vy = vx, vy
+
+        cells = self._cells[self.x + MAX_VELOCITY, self.y + MAX_VELOCITY]
+        self.reset(np.flatnonzero(cells != TRACK))
+        return self._rewards[cells], cells == FINISH
+
+
+class Driver(object):
+    """Learn the Optimal Policy beginning with a random policy and no priors."""
+    def __init__(self, track, name='Learned', epsilon=0):
+        self.action_values = np.zeros((track.coords.shape[0],  # state: x
+                                       track.coords.shape[1],  # state: y
+                                       VELOCITIES,             # state: vx
+                                       VELOCITIES,             # state: vy
+                                       len(ActionX) * len(ActionY)))
+        self._policy = np.random.randint(0, N_ACTIONS, self.action_values.shape[:-1])
+        self.track = track
+        self.name = name
+        self.epsilon = epsilon
+
+    @staticmethod
+    def itoa(i):
+        """Int to Action"""
+        if i < 0 or i > 8:
+            raise RuntimeError(i)
+
+        ax = ActionX.STEADY
+        vx = i % 3
+        if vx == 0:
+            ax = ActionX.ACCEL
+        elif vx == 2:
+            ax = ActionX.DECEL
+
+        ay = ActionY.STEADY
+        vy = i // 3
+        if vy == 0:
+            ay = ActionY.ACCEL
+        elif vy == 2:
+            ay = ActionY.DECEL
+
+        return ax, ay
+
+    def policy(self, state, explore=True):
+        if explore and random.random() < self.epsilon:
+            i = np.random.randint(0, N_ACTIONS)
+        else:
+            i = self._policy[state]
+        return i
+
+    def policies(self, states: np.ndarray, rng: np.random.RandomState, explore: bool = True) -> np.ndarray:
+        """ policy of each flat state index from DriveBatch.states """
+        actions = self._policy.reshape(-1)[states]
+        if explore and self.epsilon > 0:
+            explored = rng.random_sample(len(states)) < self.epsilon
+            actions[explored] = rng.randint(0, N_ACTIONS, np.count_nonzero(explored))
+        return actions
+
+    def update_state_policy(self, s):
+        old_i = self._policy[s]
+        new_i = np.argmax(self.action_values[s])
+
+        # Not stable
+        if new_i != old_i:
+            self._policy[s] = new_i
+            return False
+
+        # Stable
+        return True
+
+    def update_state_policies(self, states: np.ndarray) -> None:
+        """ update_state_policy of each flat state index from DriveBatch.states """
+        self._policy.reshape(-1)[states] = np.argmax(self.action_values.reshape(-1, N_ACTIONS)[states], axis=1)
+
+    def policy_improvement(self):
+        """Update our policy based on our latest action_values"""
+        policy = np.argmax(self.action_values, axis=-1)
+        policy_stable = np.array_equal(policy, self._policy)
+        self._policy = policy
+        return policy_stable
+
+    def plot_action_values(self, state=None, action=None, title=None, padding=1,
+                           save_path=None, value_alpha=0.2, vmin=None, vmax=None):
+        """
+        Display a colormap using the highest explored outcome for each position,
+        or the mean value if no state in the position has been observed
+        """
+        import matplotlib.pyplot as plt
+
+        if title is None:
+            title = f'{self.name}: Mean Action Values'
+        fig, ax = plot_track(self.track, state=state, action=action,
+                             title=title, padding=padding, offset=0.5, alpha=value_alpha)
+        mean_action_values = np.zeros((self.action_values.shape[0] + 2 * padding,
+                                       self.action_values.shape[1] + 2 * padding))
+        for x, y in product(range(self.action_values.shape[0]), range(self.action_values.shape[1])):
+            q = self.action_values[(x, y)]
+            explored = q[np.nonzero(q)]
+            display_val = 0  # Default: 0 (white)
+            if explored.size > 0:  # Position has observations: plot the optimistic estimate
+                display_val = np.max(explored)
+            elif self.track.is_valid_position(x, y):  # Unexplored position: plot the mean
+                display_val = np.mean(self.action_values)
+            mean_action_values[(x + padding, y + padding)] = display_val
+
+        im = ax.imshow(mean_action_values.T, cmap='hot', alpha=0.9, vmin=vmin, vmax=vmax)
+        fig.colorbar(im, ax=ax)
+        if save_path:
+            plt.savefig(f'{save_path}/{title}.png')
+            plt.close()
+
+
+def mc_control(drive, agent=None, every_visit=True, gamma=0.9, epsilon=0.1,
+               T=int(1e5), iterations=int(1e4), iterations_start=0, log_frequency=None):
+    if log_frequency is None:
+        log_frequency = iterations // 5 if iterations > 10 else iterations + 1
+
+    if agent is None:
+        agent = Driver(drive.track, name='Max Verstappen', epsilon=epsilon)
+    mean_return = np.zeros(agent.action_values.shape)
+    return_count = np.zeros(agent.action_values.shape)
+    for i in range(iterations_start, iterations + 1):
+        title = f'MC Control: Iteration {i:05d}'
+        if i % log_frequency == 0:
+            print(f'\tIteration {i} of {iterations}...')
+            agent.plot_action_values(title=title)
+
+        # Simulate episode from random (state, action)
+        x0, y0 = random.choice(drive.track.starts)
+        vx0, vy0 = (0, 0)
+        drive.set_state(DriverState(position=(x0, y0), velocity=(vx0, vy0)))
+        s0 = (x0, y0, vx0, vy0)  # position_x, position_y, velocity_x, velocity_y
+        episode = [s0]  # s0, a0, s1, r1, a1, s2, r2, a2, s3...
+
+        a0 = np.random.randint(0, N_ACTIONS)
+        steps = 0
+        terminated = False
+        while steps < T:
+            state, r1 = drive.transition(*Driver.itoa(a0))
+            s1 = (state.position[0], state.position[1], state.velocity[0], state.velocity[1])
+            episode.extend([a0, s1, r1])
+            if r1 >= 0:  # terminal state
+                terminated = True
+                break
+            a0 = agent.policy(s1)
+            steps += 1
+
+        if not terminated:
+            continue
+
+        # Replay backwards from the end of the episode
+        ret = 0
+        j = steps - 1
+        episode_returns = {}
+        while j > 0:
+            r1 = episode[3 * j + 3]
+            a0 = episode[3 * j + 1]
+            s0 = episode[3 * j - 1]
+            j -= 1
+
+            ret = r1 + gamma * ret
+            key = (s0[0], s0[1], s0[2], s0[3], a0)
+            episode_returns[key] = ret
+            if every_visit:
+                mean_ret = mean_return[key]
+                c = return_count[key]
+                mean_return[key] = (mean_ret * c + ret) / (c + 1)
+                return_count[key] = c + 1
+
+        # Update action values q(s,a)
+        for key, ret in episode_returns.items():
+            if not every_visit:
+                mean_ret = mean_return[key]
+                c = return_count[key]
+                mean_return[key] = (mean_ret * c + ret) / (c + 1)
+                return_count[key] = c + 1
+            agent.action_values[key] = mean_return[key]
+
+        # Update policy
+        agent.policy_improvement()
+    return agent
+
+
+def td_control(drive, alpha, every_visit=True, gamma=0.9, epsilon=0.1,
+               T=int(1e5), iterations=int(1e4), log_frequency=None):
+    if log_frequency is None:
+        log_frequency = iterations // 5 if iterations > 10 else iterations + 1
+
+    agent = Driver(drive.track, name='Max Verstappen', epsilon=epsilon)
+    for i in range(1, iterations):
+        if i % log_frequency == 0:
+            print(f'\tIteration {i} of {iterations}...')
+            agent.plot_action_values(title=f'TD Control: Iteration {i}')
+
+        # Simulate episode from random (state, action)
+        x0, y0 = random.choice(drive.track.starts)
+        vx0, vy0 = (0, 0)
+        drive.set_state(DriverState(position=(x0, y0), velocity=(vx0, vy0)))
+
+        s0 = (x0, y0, vx0, vy0)
+        a0 = np.random.randint(0, N_ACTIONS)
+        sa0 = (s0[0], s0[1], s0[2], s0[3], a0)
+
+        steps = 0
+        while steps < T:
+            state, r1 = drive.transition(*Driver.itoa(a0))
+            s1 = (state.position[0], state.position[1], state.velocity[0], state.velocity[1])
+            if r1 >= 0:  # terminal state
+                break
+
+            a1 = agent.policy(s1)
+            sa1 = (s1[0], s1[1], s1[2], s1[3], a1)
+            q0 = agent.action_values[sa0]
+            q1 = agent.action_values[sa1]
+
+            # On-Policy update, mid-episode
+            agent.action_values[sa0] = q0 + alpha * (r1 + gamma * q1 - q0)
+            agent.update_state_policy((sa0[0], sa0[1], sa0[2], sa0[3]))
+
+            # Prep the next timestep
+            a0 = a1
+            sa0 = sa1
+            steps += 1
+    return agent
+
+
+def discounted_returns(rewards: np.ndarray, gamma: float) -> np.ndarray:
+    """ Return from each step of each row of rewards, rewards[:, t] being the reward of step t """
+    return lfilter([1.], [1., -gamma], rewards[:, ::-1], axis=1)[:, ::-1]
+
+
+def mc_control_batch(drive: DriveBatch, agent: Driver = None, every_visit: bool = True, gamma: float = 0.9,
+                     epsilon: float = 0.1, T: int = BATCH_T, iterations: int = int(1e4),
+                     update_steps: int = UPDATE_STEPS, tol: float = 1e-3) -> Driver:
+    """ mc_control over the lanes of drive, each running episodes back to back
+
+    Every episode starts with a random action and then follows the latest policy. The returns of the episodes
+    that end are scatter-added into running sums per (state, action); once drive.n more episodes have ended, or
+    update_steps steps have passed, action_values is set to the mean return of each (state, action) seen and the
+    policy is improved.
+
+    Unlike mc_control, episodes given up after T steps still count, up to the last step whose return the missing
+    rewards move by less than tol times the largest reward: otherwise a policy that circles, or stands still,
+    forever is never charged for it, and keeps its untried value of 0.
+    """
+    if agent is None:
+        agent = Driver(drive.track, name='Max Verstappen', epsilon=epsilon)
+    action_values = agent.action_values.reshape(-1)
+    return_sum = np.zeros(action_values.size)
+    return_count = np.zeros(action_values.size)
+    pending_keys, pending_returns, pending = [], [], 0
+
+    def update():
+        keys, returns = np.concatenate(pending_keys), np.concatenate(pending_returns)
+        np.add.at(return_sum, keys, returns)
+        np.add.at(return_count, keys, 1)
+        keys = np.unique(keys)
+        action_values[keys] = return_sum[keys] / return_count[keys]
+        agent.policy_improvement()
+        pending_keys.clear()
+        pending_returns.clear()
+
+    # Steps at the end of a truncated episode whose return is not known to within tol
+    horizon = min(T, int(np.ceil(np.log(tol * (1 - gamma)) / np.log(gamma)))) if gamma < 1 else T
+    lanes = np.arange(drive.n)
+    drive.reset(lanes)
+    running = lanes < iterations  # Lanes whose episode counts towards iterations
+    started = np.count_nonzero(running)
+    states = drive.states()
+    actions = drive.rng.randint(0, N_ACTIONS, drive.n)
+    keys, rewards = np.zeros((drive.n, 64), dtype=int), np.zeros((drive.n, 64))  # Steps of the running episodes
+    steps = np.zeros(drive.n, dtype=int)
+    since_update = 0
+    while running.any():
+        if steps.max() == keys.shape[1]:
+            keys, rewards = np.hstack([keys, np.zeros_like(keys)]), np.hstack([rewards, np.zeros_like(rewards)])
+        keys[lanes, steps] = states * N_ACTIONS + actions
+        rewards[lanes, steps], terminal = drive.step(actions)
+        steps += running
+
+        since_update += 1
+        done = np.flatnonzero(running & (terminal | (steps >= T)))
+        if len(done):
+            # Replay backwards from the end of the episodes that ended
+            length = steps[done]
+            observed = np.arange(length.max()) < length[:, None]
+            returns = discounted_returns(np.where(observed, rewards[done, :observed.shape[1]], 0.), gamma)
+            known = np.where(terminal[done], length, length - horizon)
+            episode, step = np.nonzero(np.arange(observed.shape[1]) < known[:, None])
+            episode_keys, episode_returns = keys[done[episode], step], returns[episode, step]
+            if not every_visit:
+                # The first visit of each (state, action) in each episode, steps being in order
+                _, first = np.unique(episode * action_values.size + episode_keys, return_index=True)
+                episode_keys, episode_returns = episode_keys[first], episode_returns[first]
+            pending_keys.append(episode_keys)
+            pending_returns.append(episode_returns)
+
+            # Start the next episodes in the lanes that finished or ran out of steps
+            pending += len(done)
+            drive.reset(done[~terminal[done]])
+            steps[done] = 0
+            running[done[iterations - started:]] = False
+            started = min(iterations, started + len(done))
+        if pending >= drive.n or (since_update >= update_steps and pending):
+            update()
+            pending = since_update = 0
+        states = drive.states()
+        actions = agent.policies(states, drive.rng)
+        actions[done] = drive.rng.randint(0, N_ACTIONS, len(done))
+    if pending:
+        update()
+    return agent
+
+
+def td_control_batch(drive: DriveBatch, alpha: float, gamma: float = 0.9, epsilon: float = 0.1,
+                     T: int = int(1e5), iterations: int = int(1e4)) -> Driver:
+    """ td_control over the lanes of drive, each running episodes back to back
+
+    Every step applies the SARSA update of all lanes at once: TD errors come from the action values before the
+    step and are scatter-added, so lanes updating the same (state, action) both count. The step that reaches
+    the finish updates towards its reward alone.
+    """
+    agent = Driver(drive.track, name='Max Verstappen', epsilon=epsilon)
+    action_values = agent.action_values.reshape(-1)
+    lanes = np.arange(drive.n)
+    drive.reset(lanes)
+    running = lanes < iterations  # Lanes whose episode counts towards iterations
+    started = np.count_nonzero(running)
+    states = drive.states()
+    actions = drive.rng.randint(0, N_ACTIONS, drive.n)
+    steps = np.zeros(drive.n, dtype=int)
+    while running.any():
+        sa0 = states * N_ACTIONS + actions
+        rewards, terminal = drive.step(actions)
+        steps += running
+        states = drive.states()
+        actions = agent.policies(states, drive.rng)
+
+        # On-Policy update of the running lanes
+        q1 = np.where(terminal, 0., action_values[states * N_ACTIONS + actions])
+        update = np.flatnonzero(running)
+        np.add.at(action_values, sa0[update], alpha * (rewards + gamma * q1 - action_values[sa0])[update])
+        agent.update_state_policies(sa0[update] // N_ACTIONS)
+
+        # Start the next episodes in the lanes that finished or ran out of steps
+        done = np.flatnonzero(running & (terminal | (steps >= T)))
+        if len(done):
+            truncated = done[~terminal[done]]
+            drive.reset(truncated)
+            states[truncated] = drive.states(truncated)
+            actions[done] = drive.rng.randint(0, N_ACTIONS, len(done))
+            steps[done] = 0
+            running[done[iterations - started:]] = False
+            started = min(iterations, started + len(done))
+    return agent
+
+
+def time_trial(track: Track, driver: Driver, max_steps: int = 100) -> np.ndarray:
+    """ Steps the greedy policy of driver takes to the finish from each start, max_steps when it never does """
+    drive = DriveBatch(track, len(track.starts))
+    drive.x[:], drive.y[:] = drive._starts.T
+    steps = np.full(drive.n, max_steps)
+    running = np.ones(drive.n, dtype=bool)
+    for step in range(1, max_steps + 1):
+        _, terminal = drive.step(driver.policies(drive.states(), drive.rng, explore=False))
+        steps[running & terminal] = step
+        running &= ~terminal
+    return steps
+
+
+ITERATIONS = dict(mc=int(1e4), td=int(1e5))  # Default episodes of each --control
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--track', default='a', choices=['a', 'b'])
+    parser.add_argument('--control', default='mc', choices=['mc', 'td'])
+    parser.add_argument('--iterations', type=int, help=f'episodes, by --control: {ITERATIONS}')
+    parser.add_argument('--lanes', type=int, default=100, help='episodes stepped together')
+    parser.add_argument('--slippage', type=float, default=0.)
+    parser.add_argument('--crash-reward', type=float, default=-1.)
+    parser.add_argument('--alpha', type=float, default=0.1, help='td step size')
+    parser.add_argument('-T', type=int, help='steps before an episode is given up')
+    parser.add_argument('--seed', type=int)
+    args = parser.parse_args(argv)
+
+    iterations = args.iterations or ITERATIONS[args.control]
+    track = TRACK_A if args.track == 'a' else TRACK_B
+    np.random.seed(args.seed)
+    drive = DriveBatch(track, args.lanes, args.slippage, args.crash_reward, args.seed)
+    kwargs = dict() if args.T is None else dict(T=args.T)
+    start = time.perf_counter()
+    if args.control == 'mc':
+        driver = mc_control_batch(drive, iterations=iterations, **kwargs)
+    else:
+        driver = td_control_batch(drive, args.alpha, iterations=iterations, **kwargs)
+    print(f'{iterations} {args.control} episodes in {time.perf_counter() - start:.1f}s')
+    print(f'Greedy steps to the finish from each start: {time_trial(track, driver).tolist()}')
+
+
+if __name__ == '__main__':
+    main()
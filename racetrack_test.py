@@ -0,0 +1,76 @@
+import io
+import json
+import random
+import unittest
+from contextlib import redirect_stdout
+
+import numpy as np
+
+import racetrack
+
+
+class RacetrackTest(unittest.TestCase):
+    def test_step_matches_drive(self):
+        rng = random.Random(7)
+        for track in [racetrack.TRACK_A, racetrack.TRACK_B]:
+            positions = list(zip(*np.nonzero(track.coords)))
+            cases = [(*rng.choice(positions), rng.randint(-5, 5), rng.randint(-5, 5), rng.randrange(9))
+                     for _ in range(5000)]
+            x, y, vx, vy, actions = np.array(cases).T
+            drive = racetrack.DriveBatch(track, len(cases), crash_reward=-10, seed=0)
+            drive.x[:], drive.y[:], drive.vx[:], drive.vy[:] = x, y, vx, vy
+            rewards, terminal = drive.step(actions)
+
+            serial = racetrack.DriveRevised(track)
+            for k, (x0, y0, vx0, vy0, a) in enumerate(cases):
+                serial.set_state(racetrack.DriverState((x0, y0), (vx0, vy0)))
+                state, reward = serial.transition(*racetrack.Driver.itoa(a))
+                assert rewards[k] == reward and terminal[k] == state.terminal, cases[k]
+                if reward == -1:
+                    assert (drive.x[k], drive.y[k]) == state.position, cases[k]
+                    assert (drive.vx[k], drive.vy[k]) == state.velocity, cases[k]
+                else:
+                    assert (drive.x[k], drive.y[k]) in track.starts and drive.vx[k] == drive.vy[k] == 0, cases[k]
+
+    def test_slippage_keeps_velocity(self):
+        drive = racetrack.DriveBatch(racetrack.TRACK_A, 50, slippage=1., seed=0)
+        drive.vy[:] = 1
+        drive.step(np.zeros(50, dtype=int))
+        assert (drive.vx == 0).all() and (drive.vy == 1).all()
+        assert (drive.y == 1).all()
+
+    def test_discounted_returns(self):
+        rewards = np.random.RandomState(0).uniform(-10, 0, (3, 50))
+        expected = np.zeros_like(rewards)
+        ret = np.zeros(3)
+        for t in range(49, -1, -1):
+            ret = rewards[:, t] + 0.9 * ret
+            expected[:, t] = ret
+        assert np.allclose(racetrack.discounted_returns(rewards, 0.9), expected)
+
+    def test_mc_control_batch(self):
+        np.random.seed(0)
+        for every_visit in [True, False]:
+            driver = racetrack.mc_control_batch(racetrack.DriveBatch(racetrack.TRACK_A, 20, seed=0), T=2000,
+                                                every_visit=every_visit, iterations=100)
+            assert (driver.action_values <= 0).all() and (driver.action_values < 0).any()
+            assert (driver._policy == np.argmax(driver.action_values, axis=-1)).all()
+
+    def test_mc_control_batch_learns(self):
+        np.random.seed(0)
+        drive = racetrack.DriveBatch(racetrack.TRACK_A, 100, seed=0)
+        driver = racetrack.mc_control_batch(drive, iterations=10000)
+        assert (racetrack.time_trial(racetrack.TRACK_A, driver) < 100).all()
+
+    def test_td_control_batch_learns(self):
+        np.random.seed(0)
+        drive = racetrack.DriveBatch(racetrack.TRACK_A, 100, crash_reward=-10, seed=0)
+        driver = racetrack.td_control_batch(drive, 0.05, iterations=10000)
+        assert (racetrack.time_trial(racetrack.TRACK_A, driver) < 100).all()
+
+    def test_td_defaults_learn(self):
+        output = io.StringIO()
+        with redirect_stdout(output):
+            racetrack.main(['--control', 'td', '--seed', '0'])
+        steps = output.getvalue().splitlines()[-1].split(': ')[1]
+        assert all(step < 100 for step in json.loads(steps)), steps
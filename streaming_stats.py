@@ -0,0 +1,289 @@
+# -*- coding: utf-8 -*-
+# @File: streaming_stats.py
+""" Mergeable streaming statistics, from the StreamingStats actor of ray.ipynb
+
+The actor kept a count, sum and sum of squares, took one remote call per value and computed the variance as
+squared_sum / count - mean ** 2, which cancels catastrophically once the mean is large next to the spread. Here
+a stream is summarised by its count, mean and sum of squared deviations (m2): single values go in by Welford's
+update, arrays are summarised in one pass and folded in by Chan's parallel merge, and any two summaries merge
+the same way. StreamingStats keeps one summary per producer, optionally in shared memory, so producers never
+contend; the shards are merged when read. An optional QuantileSketch, a log-bucketed histogram, adds quantiles
+with bounded relative error for latency-like data:
+
+    python streaming_stats.py --values 100000000 --producers 1 2 4
+"""
+import argparse
+import multiprocessing
+import time
+from multiprocessing import shared_memory
+from typing import Sequence, Tuple
+
+import numpy as np
+
+
+MOMENTS = 3  # count, mean, m2
+VALUE_RANGE = (1e-6, 1e6)
+
+
+def merge_moments(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """ [count, mean, m2] of the union of two streams, from those of each (Chan et al.) """
+    count = a[0] + b[0]
+    if count == 0:
+        return np.zeros(MOMENTS)
+    delta = b[1] - a[1]
+    return np.array([count, a[1] + delta * b[0] / count, a[2] + b[2] + delta * delta * a[0] * b[0] / count])
+
+
+def summarize(values: np.ndarray) -> np.ndarray:
+    """ [count, mean, m2] of an array of values, in two passes over it """
+    values = np.asarray(values, dtype=float).ravel()
+    if not len(values):
+        return np.zeros(MOMENTS)
+    mean = values.mean()
+    deviations = values - mean
+    return np.array([len(values), mean, np.dot(deviations, deviations)])
+
+
+class Moments(object):
+    """ Count, mean and sum of squared deviations of a stream, held in state = [count, mean, m2]
+
+    state may be a view, e.g. the row of a shared array, which is then updated in place.
+    """
+    def __init__(self, state: np.ndarray = None):
+        self.state = np.zeros(MOMENTS) if state is None else state
+
+    @property
+    def count(self) -> int:
+        return int(self.state[0])
+
+    @property
+    def mean(self) -> float:
+        return self.state[1] if self.state[0] else np.nan
+
+    def variance(self, ddof: int = 0) -> float:
+        return self.state[2] / (self.state[0] - ddof) if self.state[0] > ddof else np.nan
+
+    def std(self, ddof: int = 0) -> float:
+        return np.sqrt(self.variance(ddof))
+
+    def push(self, value: float) -> None:
+        """ Welford's update for a single value """
+        count, mean, m2 = self.state
+        count += 1
+        delta = value - mean
+        mean += delta / count
+        self.state[:] = count, mean, m2 + delta * (value - mean)
+
+    def update(self, values: np.ndarray) -> None:
+        self.state[:] = merge_moments(self.state, summarize(values))
+
+    def merge(self, other: 'Moments') -> 'Moments':
+        self.state[:] = merge_moments(self.state, other.state)
+        return self
+
+    def __str__(self):
+        return f'count={self.count}, mean={self.mean:.6g}, std={self.std():.6g}'
+
+
+class QuantileSketch(object):
+    """ Histogram of non-negative values in buckets growing geometrically over value_range
+
+    Every quantile is estimated within relative_accuracy of a value of the stream, as in DDSketch, as long as it
+    falls within value_range: values below it share the first bucket and values above it the last. Sketches of
+    the same parameters merge by adding their counts.
+    """
+    def __init__(self, relative_accuracy: float = 0.01, value_range: Tuple[float, float] = VALUE_RANGE,
+                 counts: np.ndarray = None):
+        if not 0 < relative_accuracy < 1:
+            raise ValueError(f'relative_accuracy must be in (0, 1), not {relative_accuracy}')
+        self.relative_accuracy = relative_accuracy
+        self.min_value, self.max_value = value_range
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.n_buckets = self.buckets(relative_accuracy, value_range)
+        self.counts = np.zeros(self.n_buckets) if counts is None else counts
+
+    @staticmethod
+    def buckets(relative_accuracy: float, value_range: Tuple[float, float]) -> int:
+        gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        return int(np.ceil(np.log(value_range[1] / value_range[0]) / np.log(gamma))) + 2
+
+    def update(self, values: np.ndarray) -> None:
+        values = np.asarray(values, dtype=float).ravel()
+        if (values < 0).any():
+            raise ValueError('QuantileSketch only takes non-negative values')
+        with np.errstate(divide='ignore'):
+            buckets = np.ceil(np.log(values / self.min_value) / np.log(self.gamma))
+        buckets = np.clip(np.nan_to_num(buckets, neginf=0), 0, self.n_buckets - 1).astype(int)
+        self.counts += np.bincount(buckets, minlength=self.n_buckets)
+
+    def merge(self, other: 'QuantileSketch') -> 'QuantileSketch':
+        if other.n_buckets != self.n_buckets or other.gamma != self.gamma or other.min_value != self.min_value:
+            raise ValueError('only sketches of the same relative_accuracy and value_range merge')
+        self.counts += other.counts
+        return self
+
+    def quantile(self, q):
+        """ Estimated q-quantile(s) of the values seen, nan when there are none """
+        q = np.asarray(q, dtype=float)
+        total = self.counts.sum()
+        if not total:
+            return np.full(q.shape, np.nan)[()]
+        cumulative = np.cumsum(self.counts)
+        buckets = np.searchsorted(cumulative, q * (total - 1), side='right')
+        # Middle of bucket i, (min_value gamma^(i-1), min_value gamma^i], in relative terms
+        values = self.min_value * 2 * self.gamma ** buckets / (self.gamma + 1)
+        return np.where(buckets == 0, self.min_value, values)[()]
+
+
+class StreamingStats(object):
+    """ Moments, and optionally a QuantileSketch, of a stream written by n_shards producers
+
+    Each producer updates its own shard, a row of one array, and reads merge the shards. Created with
+    shared=True, the array lives in shared memory: pickling the StreamingStats then only sends the name of the
+    block, and a producer process attached this way writes straight into the parent's array. Shards are read
+    without locking, so reads taken while producers are writing may see a shard half updated.
+    """
+    def __init__(self, n_shards: int = 1, relative_accuracy: float = None,
+                 value_range: Tuple[float, float] = VALUE_RANGE, shared: bool = False, name: str = None):
+        self.n_shards = n_shards
+        self.relative_accuracy = relative_accuracy
+        self.value_range = value_range
+        width = MOMENTS + (0 if relative_accuracy is None else QuantileSketch.buckets(relative_accuracy, value_range))
+        self.memory = None
+        self._owner = shared and name is None
+        if shared or name is not None:
+            size = n_shards * width * 8
+            self.memory = shared_memory.SharedMemory(name=name, create=name is None, size=size)
+            self.shards = np.ndarray((n_shards, width), dtype=float, buffer=self.memory.buf)
+            if name is None:
+                self.shards[:] = 0
+        else:
+            self.shards = np.zeros((n_shards, width))
+
+    def __getstate__(self):
+        if self.memory is None:
+            return self.__dict__
+        return dict(n_shards=self.n_shards, relative_accuracy=self.relative_accuracy, value_range=self.value_range,
+                    name=self.memory.name)
+
+    def __setstate__(self, state):
+        if 'name' in state:
+            self.__init__(**state)
+        else:
+            self.__dict__.update(state)
+
+    def shard_moments(self, shard: int) -> Moments:
+        return Moments(self.shards[shard, :MOMENTS])
+
+    def shard_sketch(self, shard: int) -> QuantileSketch:
+        if self.relative_accuracy is None:
+            raise ValueError('StreamingStats created without a relative_accuracy keep no quantile sketch')
+        return QuantileSketch(self.relative_accuracy, self.value_range, self.shards[shard, MOMENTS:])
+
+    def push(self, value: float, shard: int = 0) -> None:
+        self.shard_moments(shard).push(value)
+        if self.relative_accuracy is not None:
+            self.shard_sketch(shard).update([value])
+
+    def update(self, values: np.ndarray, shard: int = 0) -> None:
+        self.shard_moments(shard).update(values)
+        if self.relative_accuracy is not None:
+            self.shard_sketch(shard).update(values)
+
+    def moments(self) -> Moments:
+        """ Moments of all shards, merged into a copy """
+        state = np.zeros(MOMENTS)
+        for shard in self.shards:
+            state = merge_moments(state, shard[:MOMENTS])
+        return Moments(state)
+
+    @property
+    def count(self) -> int:
+        return self.moments().count
+
+    def mean(self) -> float:
+        return self.moments().mean
+
+    def std(self, ddof: int = 0) -> float:
+        return self.moments().std(ddof)
+
+    def sketch(self) -> QuantileSketch:
+        """ QuantileSketch of all shards, merged into a copy """
+        merged = self.shard_sketch(0)
+        merged.counts = self.shards[:, MOMENTS:].sum(axis=0)
+        return merged
+
+    def quantile(self, q):
+        return self.sketch().quantile(q)
+
+    def close(self) -> None:
+        """ Detach from the shared memory, and free it if this is the StreamingStats that created it """
+        if self.memory is None:
+            return
+        self.shards = self.shards.copy()
+        self.memory.close()
+        if self._owner:
+            self.memory.unlink()
+        self.memory = None
+
+
+def stream_chunk(chunk: int, size: int, loc: float = 0., seed: int = 0) -> np.ndarray:
+    """ Chunk of a synthetic latency stream: lognormal seconds, shifted by loc """
+    return loc + np.random.RandomState(seed + chunk).lognormal(-3., 1., size)
+
+
+def _produce(stats: StreamingStats, producer: int, chunks: Sequence[int], chunk_size: int, loc: float,
+             seed: int) -> None:
+    for chunk in chunks:
+        stats.update(stream_chunk(chunk, chunk_size, loc, seed), shard=producer)
+
+
+def produce(stats: StreamingStats, n_values: int, chunk_size: int, loc: float = 0., seed: int = 0) -> float:
+    """ Stream n_values into shared stats from one process per shard; returns the seconds taken """
+    n_chunks = n_values // chunk_size
+    processes = [multiprocessing.Process(target=_produce, args=(stats, producer,
+                                                                range(producer, n_chunks, stats.n_shards),
+                                                                chunk_size, loc, seed))
+                 for producer in range(stats.n_shards)]
+    start = time.perf_counter()
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+        if process.exitcode:
+            raise RuntimeError(f'producer exited with {process.exitcode}')
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--values', type=int, default=10 ** 7)
+    parser.add_argument('--chunk-size', type=int, default=10 ** 6)
+    parser.add_argument('--producers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--loc', type=float, default=0., help='shift of the stream, to check stability')
+    parser.add_argument('--relative-accuracy', type=float, default=0.01)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    n_chunks = args.values // args.chunk_size
+    reference = np.concatenate([stream_chunk(chunk, args.chunk_size, args.loc, args.seed)
+                                for chunk in range(n_chunks)])
+    print(f'numpy: mean={reference.mean():.12g}, std={reference.std():.12g}')
+    value_range = (VALUE_RANGE[0], max(VALUE_RANGE[1], 10 * args.loc))
+    base = None
+    for producers in args.producers:
+        stats = StreamingStats(producers, args.relative_accuracy, value_range, shared=True)
+        seconds = produce(stats, args.values, args.chunk_size, args.loc, args.seed)
+        throughput = stats.count / seconds
+        base = base or throughput
+        print(f'{producers} producers: {throughput / 1e6:.1f}M values/s, '
+              f'scaling efficiency {throughput / (base * producers):.0%}, '
+              f'relative error mean={abs(stats.mean() / reference.mean() - 1):.1e} '
+              f'std={abs(stats.std() / reference.std() - 1):.1e}, '
+              f'p50={stats.quantile(0.5):.4g} p99={stats.quantile(0.99):.4g}')
+        stats.close()
+    print(f'numpy: p50={np.quantile(reference, 0.5):.4g} p99={np.quantile(reference, 0.99):.4g}')
+
+
+if __name__ == '__main__':
+    main()
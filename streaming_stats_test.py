@@ -0,0 +1,67 @@
+import pickle
+import unittest
+
+import numpy as np
+
+import streaming_stats
+
+
+class StreamingStatsTest(unittest.TestCase):
+    def test_moments_match_numpy(self):
+        values = np.random.RandomState(0).normal(1e9, 0.1, 100000)  # Too large a mean for sum of squares
+        pushed, updated, merged = [streaming_stats.Moments() for _ in range(3)]
+        for value in values[:1000]:
+            pushed.push(value)
+        for chunk in np.array_split(values, 7):
+            updated.update(chunk)
+            merged.merge(streaming_stats.Moments(streaming_stats.summarize(chunk)))
+        assert np.isclose(pushed.mean, values[:1000].mean(), rtol=1e-15, atol=0)
+        assert np.isclose(pushed.std(ddof=1), values[:1000].std(ddof=1), rtol=1e-6, atol=0)
+        naive = abs(np.mean(values ** 2) - values.mean() ** 2) ** 0.5  # The notebook's std
+        assert not np.isclose(naive, values.std(), rtol=0.1)
+        for moments in [updated, merged]:
+            assert moments.count == len(values)
+            assert np.isclose(moments.mean, values.mean(), rtol=1e-15, atol=0)
+            assert np.isclose(moments.std(), values.std(), rtol=1e-7, atol=0)
+        assert np.isnan(streaming_stats.Moments().mean) and np.isnan(streaming_stats.Moments().std(ddof=1))
+
+    def test_quantile_sketch(self):
+        values = np.random.RandomState(0).lognormal(-3., 1., 100000)
+        sketches = [streaming_stats.QuantileSketch(0.01) for _ in range(2)]
+        sketches[0].update(values[:30000])
+        sketches[1].update(values[30000:])
+        sketch = sketches[0].merge(sketches[1])
+        q = np.array([0., 0.01, 0.5, 0.9, 0.99, 0.999, 1.])
+        expected = np.quantile(values, q, method='lower')
+        assert np.all(np.abs(sketch.quantile(q) / expected - 1) <= 0.01), sketch.quantile(q) / expected
+        assert sketch.quantile(0.5).shape == () and sketch.counts.sum() == len(values)
+        with self.assertRaises(ValueError):
+            sketch.update([-1.])
+        with self.assertRaises(ValueError):
+            sketch.merge(streaming_stats.QuantileSketch(0.02))
+
+    def test_shards(self):
+        stats = streaming_stats.StreamingStats(3, relative_accuracy=0.01)
+        values = np.random.RandomState(0).rand(3000)
+        for shard in range(3):
+            stats.update(values[shard::3][1:], shard)
+            stats.push(values[shard], shard)
+        assert stats.count == 3000 and np.isclose(stats.mean(), values.mean()) and np.isclose(stats.std(), values.std())
+        assert abs(stats.quantile(0.5) / np.median(values) - 1) < 0.011
+        copy = pickle.loads(pickle.dumps(stats))
+        assert copy.std(ddof=1) == stats.std(ddof=1)
+        with self.assertRaises(ValueError):
+            streaming_stats.StreamingStats().quantile(0.5)
+
+    def test_shared_producers(self):
+        stats = streaming_stats.StreamingStats(2, relative_accuracy=0.01, shared=True)
+        try:
+            streaming_stats.produce(stats, 40000, 10000, loc=1e6)
+            values = np.concatenate([streaming_stats.stream_chunk(chunk, 10000, 1e6) for chunk in range(4)])
+            assert stats.count == 40000 and stats.shards[:, 0].tolist() == [20000, 20000]
+            assert np.isclose(stats.mean(), values.mean(), rtol=1e-15) and np.isclose(stats.std(), values.std())
+            attached = pickle.loads(pickle.dumps(stats))
+            assert attached.memory.name == stats.memory.name and attached.count == 40000
+            attached.close()
+        finally:
+            stats.close()